@@ -2,9 +2,9 @@
 Streamlit App for ISA, a powerful prompts generator'''
 
 import os
+import hashlib
 import json
 import random
-import re
 import time
 from typing import List
 import uuid
@@ -12,44 +12,63 @@ import pyperclip
 import streamlit as st
 import ollama
 from PIL import Image
-from pydantic import BaseModel, Field, ValidationError
+from pydantic import BaseModel, ValidationError
 
 
 from modules.prompts_system import (
-    prompt_system_chat, 
-    prompt_system_finetuned, 
-    prompt_system_create, 
-    prompt_system_flux, 
-    prompt_system_flux2, 
-    prompt_system_lolo,
-    prompt_system_vision
+    prompt_system_chat
 )
+from modules.schemas import PromptsList, PromptsFluxList, PROMPT_MODES, STRUCTURED_MODES
+from modules.cache import DiskCache
+from modules.inventory import ModelInventory
+from modules.images import DEFAULT_QUALITY, get_native_size, preprocess_image, preprocess_in_background, format_bytes
+from modules.pipeline import Pipeline
+from modules.store import PromptStore
+from modules.writer import PromptsWriter
+from modules.comfyui import DEFAULT_URL, submit_in_background
+from modules.dedup import DEFAULT_THRESHOLD, DuplicateIndex, find_duplicates, get_hasher
+from modules.residency import RESIDENCY_POLICIES, KEEP_HOT_MINUTES, get_keep_alive, get_text_keep_alive, get_memory_pressure, apply_policy, unload
+from modules.telemetry import Telemetry, seconds
+from modules.context import ContextManager, DEFAULT_BUDGET, expected_output
+from modules.json_repair import get_repair_stats
+from modules.metrics import GENERATION_REQUESTS, GENERATION_LATENCY, IN_FLIGHT, TOKENS_GENERATED, start_server, touch_session
+from modules.engine import NUM_CTX, MAX_IN_FLIGHT, get_prompt_system, calculate_seed, generate_prompts, dump_prompts, split_request, fan_out, get_retry_stats, \
+    get_generation_key, get_cached_prompts, set_cached_prompts, get_description, get_vision_content
 from modules.subjects import subjects
-from modules.version import version, isa_latest, ollama_version, ollama_latest, streamlit_version, strealit_latest, compare_version
+from modules.version import get_versions, compare_version
 
 BASEDIR = os.path.dirname(os.path.abspath(__file__))
-PATH_OUTPUT = os.path.join(BASEDIR, "output")
+# The benchmark runs the app in a temporary folder, so the prompts and the telemetry of the user are not touched
+PATH_OUTPUT = os.environ.get("ISA_OUTPUT") or os.path.join(BASEDIR, "output")
 PATH_POSTIVE = os.path.join(PATH_OUTPUT, "prompts_positive.txt")
 PATH_NEGATIVE = os.path.join(PATH_OUTPUT, "prompts_negative.txt")
 PATH_BACKUP = os.path.join(PATH_OUTPUT, "prompts_backup.txt")
+PATH_STORE = os.path.join(PATH_OUTPUT, "prompts.sqlite")
+PATH_WORKFLOW = os.path.join(BASEDIR, "workflow", "wf_ISA_1.json")
 PATH_SETTINGS = os.path.join(BASEDIR, "settings.json")
+PATH_CACHE = os.path.join(PATH_OUTPUT, "cache", "generation.sqlite")
+PATH_VISION_CACHE = os.path.join(PATH_OUTPUT, "cache", "vision.sqlite")
+PATH_TELEMETRY = os.path.join(PATH_OUTPUT, "telemetry.jsonl")
+PATH_VERSIONS = os.path.join(PATH_OUTPUT, "cache", "versions.json")
 
 FAVICON = os.path.join(BASEDIR, "favicon.png")
 
-# create class to strore prompts
-class Prompt(BaseModel):
-    positive: str = Field(..., description="Positive prompt to generate image from query")
-    negative: str = Field(..., description="Negative prompt to generate image from query")
+DEDUP_MODES = {
+    "off": "Off",
+    "flag": "Flag",
+    "regenerate": "Regenerate",
+}
 
-class PromptsList(BaseModel):
-    prompts: List[Prompt] = Field(..., description="List of prompts")
+SAVE_MODES = {
+    "replace": "Replace the prompts",
+    "append": "Append the prompts",
+}
 
+# Turns of the history displayed, the older ones are displayed on request
+HISTORY_PAGE = 10
 
-class PromptFlux(BaseModel):
-    positive: str = Field(..., description="Positive prompt to generate image from query")
-
-class PromptsFluxList(BaseModel):
-    prompts: List[PromptFlux] = Field(..., description="List of prompts")
+# Regenerations of a near-duplicate prompt before keeping it flagged
+MAX_DEDUP_RETRIES = 2
 
 @st.cache_data
 def load_settings() -> dict:
@@ -70,7 +89,7 @@ def load_settings() -> dict:
     if "model_vision" not in settings or settings["model_vision"] not in models_vision:
         settings["model_vision"] = None
     
-    if "prompt_mode" not in settings or settings["prompt_mode"] not in ["None", "SDXL", "Flux", "Flux2", "Sequential"]:
+    if "prompt_mode" not in settings or settings["prompt_mode"] not in PROMPT_MODES:
         settings["prompt_mode"] = "SDXL"
     
     if "mode" not in settings or not isinstance(settings["mode"], bool):
@@ -81,6 +100,51 @@ def load_settings() -> dict:
 
     if "temperature" not in settings:
         settings["temperature"] = 0.8
+
+    if "parallel" not in settings or not isinstance(settings["parallel"], int):
+        settings["parallel"] = 1
+
+    if "constrained" not in settings or not isinstance(settings["constrained"], bool):
+        settings["constrained"] = True
+
+    if "use_cache" not in settings or not isinstance(settings["use_cache"], bool):
+        settings["use_cache"] = True
+
+    if "context_budget" not in settings or not isinstance(settings["context_budget"], int):
+        settings["context_budget"] = DEFAULT_BUDGET
+
+    if "vision_residency" not in settings or settings["vision_residency"] not in RESIDENCY_POLICIES:
+        settings["vision_residency"] = "keep_hot"
+
+    if "vision_keep_minutes" not in settings or not isinstance(settings["vision_keep_minutes"], int):
+        settings["vision_keep_minutes"] = KEEP_HOT_MINUTES
+
+    if "max_vram" not in settings or not isinstance(settings["max_vram"], (int, float)):
+        settings["max_vram"] = 0.0
+
+    if "preprocess_images" not in settings or not isinstance(settings["preprocess_images"], bool):
+        settings["preprocess_images"] = True
+
+    if "jpeg_quality" not in settings or not isinstance(settings["jpeg_quality"], int):
+        settings["jpeg_quality"] = DEFAULT_QUALITY
+
+    if "dedup" not in settings or settings["dedup"] not in DEDUP_MODES:
+        settings["dedup"] = "flag"
+
+    if "dedup_threshold" not in settings or not isinstance(settings["dedup_threshold"], (int, float)):
+        settings["dedup_threshold"] = DEFAULT_THRESHOLD
+
+    if "dedup_model" not in settings or not isinstance(settings["dedup_model"], str):
+        settings["dedup_model"] = ""
+
+    if "save_mode" not in settings or settings["save_mode"] not in SAVE_MODES:
+        settings["save_mode"] = "replace"
+
+    if "comfyui_queue" not in settings or not isinstance(settings["comfyui_queue"], bool):
+        settings["comfyui_queue"] = False
+
+    if "comfyui_url" not in settings or not isinstance(settings["comfyui_url"], str):
+        settings["comfyui_url"] = os.environ.get("COMFYUI_URL", DEFAULT_URL)
     
     return settings
 
@@ -92,116 +156,134 @@ def save_settings() -> None:
         "prompt_mode": st.session_state["prompt_mode"],
         "mode": st.session_state["mode"],
         "seed": st.session_state["seed"],
-        "temperature": st.session_state["temperature"]
+        "temperature": st.session_state["temperature"],
+        "parallel": st.session_state["parallel"],
+        "constrained": st.session_state["constrained"],
+        "use_cache": st.session_state["use_cache"],
+        "context_budget": st.session_state["context_budget"],
+        "vision_residency": st.session_state["vision_residency"],
+        "vision_keep_minutes": st.session_state["vision_keep_minutes"],
+        "max_vram": st.session_state["max_vram"],
+        "preprocess_images": st.session_state["preprocess_images"],
+        "jpeg_quality": st.session_state["jpeg_quality"],
+        "dedup": st.session_state["dedup"],
+        "dedup_threshold": st.session_state["dedup_threshold"],
+        "dedup_model": st.session_state["dedup_model"],
+        "save_mode": st.session_state["save_mode"],
+        "comfyui_queue": st.session_state["comfyui_queue"],
+        "comfyui_url": st.session_state["comfyui_url"]
     }
     with open(PATH_SETTINGS, "w") as f:
         json.dump(settings, f, indent=4)
         st.toast("Settings saved", icon=":material/save:")
 
-@st.cache_data
 def get_version() -> tuple[str, str, str, str, str, str]:
     '''
     Returns the versions of ISA, ISA latest, Ollama, Ollama latest, Streamlit and Streamlit latest.
 
+    The versions are read from a cache on disk and checked again in background when
+    the cache expires, so the sidebar never waits for the network.
+
     Returns:
         str: a tuple of the versions of ISA, ISA latest, Ollama, Ollama latest, Streamlit and Streamlit latest.
     '''
-    return version(), isa_latest(), ollama_version(), ollama_latest(), streamlit_version(), strealit_latest()
+    return get_versions(PATH_VERSIONS)
 
-# cache the json schema for the prompts list
-@st.cache_data
-def get_prompt_schema() -> str:
+@st.cache_resource
+def get_cache() -> DiskCache:
     '''
-    Returns the JSON schema for the prompts list.
+    Returns the persistent cache of the generations.'''
+    return DiskCache(PATH_CACHE)
 
-    Returns:
-        str: The JSON schema for the prompts list.
+@st.cache_resource
+def get_vision_cache() -> DiskCache:
     '''
-    return json.dumps(PromptsList.model_json_schema())
+    Returns the persistent cache of the image descriptions.'''
+    return DiskCache(PATH_VISION_CACHE, max_size=16 * 1024 * 1024)
 
-@st.cache_data
-def get_prompt_flux_schema() -> str:
+@st.cache_resource
+def get_prompt_store() -> PromptStore:
     '''
-    Returns the JSON schema for the prompts flux list.
+    Returns the store of the saved prompts, with the prompts of prompts_backup.txt imported at creation.'''
+    store = PromptStore(PATH_STORE)
+    if os.path.exists(PATH_BACKUP) and store.count() == 0:
+        store.import_backup(PATH_BACKUP)
+    return store
+
+@st.cache_resource
+def get_prompts_writer() -> PromptsWriter:
+    '''
+    Returns the writer of the files read by the ComfyUI workflow.'''
+    return PromptsWriter(PATH_POSTIVE, PATH_NEGATIVE)
 
-    Returns:
-        str: The JSON schema for the prompts flux list.
+@st.cache_resource
+def get_duplicate_index(model: str, threshold: float) -> DuplicateIndex:
     '''
-    return json.dumps(PromptsFluxList.model_json_schema())
+    Returns the index of the saved prompts for the detection of near-duplicates, the prompts not indexed yet are indexed in background.
+
+    Args:
+        model (str): The Ollama embedding model, empty for MinHash.
+        threshold (float): The similarity from which prompts are duplicates.
+    '''
+    get_prompt_store()
+    index = DuplicateIndex(PATH_STORE, get_hasher(model), threshold)
+    index.sync_in_background()
+    return index
+
+@st.cache_resource
+def get_telemetry() -> Telemetry:
+    '''
+    Returns the telemetry of the Ollama requests.'''
+    return Telemetry(PATH_TELEMETRY)
+
+@st.cache_resource
+def get_inventory() -> ModelInventory:
+    '''
+    Returns the inventory of the Ollama models, shared by all the sessions.'''
+    return ModelInventory()
+
+def get_digest(model: str) -> str:
+    '''
+    Returns the digest of a model, used in the cache keys.'''
+    return get_inventory().digest(model)
+
+@st.cache_resource
+def start_metrics_server() -> None:
+    '''
+    Starts the OpenMetrics endpoint if ISA_METRICS_PORT is set.'''
+    start_server()
+
+def get_generation_cache() -> DiskCache | None:
+    '''
+    Returns the generation cache, None if the cache is bypassed.'''
+    return get_cache() if st.session_state['use_cache'] else None
 
-@st.cache_data
 def get_models_list() -> List[str]:
     '''
     Returns a list of available LLM models.
 
-    This function retrieves the list of available LLM models from the ollama.list()
-    function and filters out those models that are not suitable for generating prompts.
-    The models that are filtered out are:
+    The models come from the shared model inventory, refreshed in background so the
+    models pulled after the start are listed. The models that are filtered out are:
         - Models that contain the word "embed" in their name (case-insensitive).
-        - Models that start with "llava" or "moondream".
+        - Vision only models, starting with "llava", "moondream", "minicpm-v" or "GFalcon-UA/nous-hermes-2-vision".
 
     Returns:
-        List[str]: A list of available LLM models.
+        List[str]: A list of available LLM models, without the ":latest" suffix.
     '''
-    # Pattern to search for in model names
-    patern = "embed"
-    
-    # Get the list of available models and filter out the ones that are not suitable
-    models = [model['model'] for model in ollama.list()['models'] 
-        if not re.search(patern, model['model'], re.IGNORECASE) and
-        (
-            not model['model'].startswith('llava') and
-            not model['model'].startswith('moondream') and 
-            not model['model'].startswith('GFalcon-UA/nous-hermes-2-vision') and
-            not model['model'].startswith('minicpm-v')
-        )
-    ]
-
-    # Remove the ":latest" suffix from the model names
-    for index, model in enumerate(models):
-        if model.endswith(':latest'):
-            models[index] = model[:-7]
-    
-    return models
+    return get_inventory().text_models()
 
-@st.cache_data
 def get_vision_models_list() -> List[str]:
     """
     Returns a list of available Vision models that are suitable for image reading.
 
-    This function retrieves the list of available LLM models from the ollama.list()
-    function and filters out those models that are not suitable for image vision.
-    The models that are filtered out are:
-        - Models that do not start with "llava" or "moondream".
-        - Models that contain the word "embed" in their name (case-insensitive).
+    The models come from the shared model inventory. The models kept are the ones
+    starting with one of the VISION_PREFIXES of modules/inventory.py (llava, moondream, gemma3...),
+    without the word "embed" in their name.
 
     Returns:
-        List[str]: A list of available LLM models for image vision.
-    """
-    # List of models that are suitable for image vision
-    # models_list = ['llava', 'llava-phi3', 'llava-llama3', 'moondream', 'GFalcon-UA/nous-hermes-2-vision', 'minicpm-v']
-    models_list = ['test']
-
-    # Get the list of available models and filter out the ones that are not suitable
-    models = [model['model'] for model in ollama.list()['models'] 
-              if (
-                  model['model'].startswith('llava') or 
-                  model['model'].startswith('moondream') or 
-                  model['model'].startswith('GFalcon-UA/nous-hermes-2-vision') or
-                  model['model'].startswith('minicpm-v') or
-                  model['model'].startswith('granite3.2-vision') or
-                  model['model'].startswith('llama3.2-vision') or 
-                  model['model'].startswith('gemma3'),
-                  model['model'].startswith('mistral-small3.1'),
-                ) and
-              not re.search('embed', model['model'], re.IGNORECASE)]
-
-    # Remove the ":latest" suffix from the model names
-    for index, model in enumerate(models):
-        if model.endswith(':latest'):
-            models[index] = model[:-7]
-    
-    return models
+        List[str]: A list of available LLM models for image vision, without the ":latest" suffix.
+    """
+    return get_inventory().vision_models()
 
 def get_subjects_try() -> tuple[str, str, str]:
     """
@@ -217,45 +299,6 @@ def get_subjects_try() -> tuple[str, str, str]:
 
     return prompts.pop(), prompts.pop(), prompts.pop()
 
-def get_prompt_system(generate_prompt: bool = True, prompt_model: str = 'SDXL') -> str:
-    """
-    Get prompt system.
-
-    This function returns the prompt system based on the value of the generate_prompt
-    parameter.
-
-    Args:
-        generate_prompt (bool, optional): Whether to generate the prompt system. Defaults to True.
-
-    Returns:
-        str: The prompt system.
-    """
-    if generate_prompt:
-        if prompt_model == 'SDXL':
-            schema = get_prompt_schema()
-            prompt_system = prompt_system_create.replace(r'{schema}', schema)
-        elif prompt_model == 'Flux':
-            schema = get_prompt_flux_schema()
-            prompt_system = prompt_system_flux.replace(r'{schema}', schema)
-        elif prompt_model == 'Flux2':
-            schema = get_prompt_flux_schema()
-            prompt_system = prompt_system_flux2.replace(r'{schema}', schema)
-        elif prompt_model == 'Sequential':
-            prompt_system = prompt_system_lolo
-        elif prompt_model == 'None':
-            prompt_system = prompt_system_finetuned
-        return prompt_system
-    else:
-        return prompt_system_chat
-
-def calculate_seed(seed: int) -> int:
-    """
-    Calculate seed."""
-    if seed == 0:
-        return random.randint(0, 2**32)
-
-    return seed
-
 def stream_data():
     """
     Stream data from ollama.
@@ -270,100 +313,238 @@ def stream_data():
     # Set the seed
     st.session_state['last_seed'] = calculate_seed(st.session_state['seed'])
 
-    stream = ollama.chat(
-        model=st.session_state.model,
-        messages=st.session_state['messages'],
-        stream=True,
-        options={
-            "seed": st.session_state['last_seed'],
-            "temperature": st.session_state['temperature'],
-            "num_ctx": 4096
-        }
+    prompt_mode = st.session_state.prompt_mode if st.session_state.mode else "chat"
+    messages, num_ctx = get_context_messages(prompt_mode)
+    cache = get_generation_cache()
+    key = get_generation_key(
+        st.session_state.model,
+        get_digest(st.session_state.model),
+        messages,
+        prompt_mode,
+        st.session_state['last_seed'],
+        st.session_state['temperature'],
+        num_ctx=num_ctx
     )
+    cached = cache.get(key) if cache is not None else None
+    st.session_state['cache_hit'] = cached is not None if cache is not None else None
+    if cached is not None:
+        st.session_state.response = cached
+        yield cached
+        return
+
+    start = time.time()
+    chunk = None
+    with IN_FLIGHT.track():
+        stream = ollama.chat(
+            model=st.session_state.model,
+            messages=messages,
+            stream=True,
+            options={
+                "seed": st.session_state['last_seed'],
+                "temperature": st.session_state['temperature'],
+                "num_ctx": num_ctx
+            },
+            keep_alive=get_text_keep_alive(st.session_state['vision_residency'])
+        )
+
+        # Iterate over each chunk of data
+        for chunk in stream:
+            # Append the content of the chunk to the session state response
+            st.session_state.response += chunk['message']['content']
+
+            # Yield the content of the chunk
+            yield chunk['message']['content']
+
+    GENERATION_REQUESTS.inc(mode=prompt_mode)
+    GENERATION_LATENCY.observe(time.time() - start, mode=prompt_mode)
+    apply_residency()
 
-    # Iterate over each chunk of data
-    for chunk in stream:
-        # Append the content of the chunk to the session state response
-        st.session_state.response += chunk['message']['content']
+    # Empty stream, e.g. a cancelled request: no timings and nothing to cache
+    if chunk is None:
+        return
 
-        # Yield the content of the chunk
-        yield chunk['message']['content']
+    TOKENS_GENERATED.inc(chunk.get('eval_count') or 0, model=st.session_state.model, mode=prompt_mode)
 
-def get_prompts() -> tuple[BaseModel,str]:
+    # The last chunk contains the number of tokens of the prompt and the timings
+    st.session_state['context'].calibrate(messages, chunk.get('prompt_eval_count'))
+    get_telemetry().record(chunk, st.session_state.model, prompt_mode, st.session_state['last_seed'])
+
+    if cache is not None:
+        cache.set(key, st.session_state.response)
+
+def get_context_messages(prompt_mode: str, count: int = 1) -> tuple[List[dict], int]:
+    """
+    Get the messages sent to the model and the size of the context.
+
+    The prompt system and the last request are always kept, the oldest turns are dropped
+    to keep the conversation inside the context budget. The size of the context is
+    selected from the size of the messages and of the expected response.
+
+    Args:
+        prompt_mode (str): The prompt mode, "chat" for the chat mode.
+        count (int, optional): The number of prompts requested. Defaults to 1.
+
+    Returns:
+        tuple[List[dict], int]: The messages to send and the num_ctx of the request.
+    """
+    context = st.session_state['context']
+    context.budget = st.session_state['context_budget']
+    messages = context.fit(st.session_state['messages'], reserve=expected_output(prompt_mode, count))
+    return messages, context.get_num_ctx(messages, prompt_mode, count)
+
+def get_prompts(preview=None) -> tuple[BaseModel,str]:
     """
     Get prompts from the ollama chat API.
 
     This function sends a chat request to the ollama chat API and retrieves the prompts
-    generated by the model. The function takes no parameters and returns the prompts
-    as a string in JSON format.
+    generated by the model. The function returns the prompts as a string in JSON format.
+
+    Args:
+        preview (optional): A st.empty() placeholder where each prompt is displayed as soon as it is
+            streamed, before the validation of the whole list. Defaults to None (no streaming).
 
     Returns:
         str: The prompts generated by the model. the prompt mode used for the generation
     """
-    messages = st.session_state['messages']
-    attempt = 0
-
     st.session_state['last_seed'] = calculate_seed(st.session_state['seed'])
 
-    while True:
-        if st.session_state.prompt_mode == 'SDXL' or st.session_state.prompt_mode == 'Flux' or st.session_state.prompt_mode == 'Flux2':
-            format = 'json'
-        else:
-            format = ''
-        response = ollama.chat(
+    count, single_request = split_request(st.session_state['messages'][-1]['content'])
+    fan = st.session_state['parallel'] > 1 and count > 1
+    messages, num_ctx = get_context_messages(st.session_state.prompt_mode, 1 if fan else count)
+    context = st.session_state['context']
+    telemetry = get_telemetry()
+
+    def on_response(response: dict, attempt: int, seed: int | None = None) -> None:
+        context.calibrate(messages, response.get('prompt_eval_count'))
+        telemetry.record(
+            response, 
+            st.session_state.model, 
+            st.session_state.prompt_mode, 
+            st.session_state['last_seed'] if seed is None else seed, 
+            attempt
+        )
+
+    cache = get_generation_cache()
+    key = get_generation_key(
+        st.session_state.model,
+        get_digest(st.session_state.model),
+        messages,
+        st.session_state.prompt_mode,
+        st.session_state['last_seed'],
+        st.session_state['temperature'],
+        st.session_state['constrained'],
+        count if fan else 1,
+        num_ctx
+    )
+    prompts = get_cached_prompts(cache, key, st.session_state.prompt_mode)
+    st.session_state['cache_hit'] = prompts is not None if cache is not None else None
+
+    if prompts is None and fan:
+        # One request per prompt, with different seeds, sent concurrently
+        prompts = fan_out(
+            model=st.session_state.model,
+            messages=messages[:-1] + [{'role': 'user', 'content': single_request}],
+            prompt_mode=st.session_state.prompt_mode,
+            seeds=[st.session_state['last_seed'] + index for index in range(count)],
+            temperature=st.session_state['temperature'],
+            max_in_flight=st.session_state['parallel'],
+            on_retry=lambda attempt, e: st.error("Error when parsing prompts. Retry..."),
+            constrained=st.session_state['constrained'],
+            on_response=on_response,
+            num_ctx=num_ctx,
+            keep_alive=get_text_keep_alive(st.session_state['vision_residency'])
+        )
+    elif prompts is None:
+        streamed = []
+
+        def on_prompt(prompt: dict) -> None:
+            streamed.append(prompt)
+            with preview.container():
+                display_streamed_prompts(streamed)
+
+        def on_retry(attempt: int, e: ValidationError) -> None:
+            streamed.clear()
+            if preview is not None:
+                preview.empty()
+            st.error("Error when parsing prompts. Retry...")
+
+        prompts = generate_prompts(
             model=st.session_state.model,
             messages=messages,
-            stream=False,
-            format=format,
-            options={
-                "seed": st.session_state['last_seed'],
-                "temperature": st.session_state['temperature'],
-                "num_ctx": 4096
-            }
+            prompt_mode=st.session_state.prompt_mode,
+            seed=st.session_state['last_seed'],
+            temperature=st.session_state['temperature'],
+            on_retry=on_retry,
+            constrained=st.session_state['constrained'],
+            on_prompt=on_prompt if preview is not None else None,
+            on_response=on_response,
+            num_ctx=num_ctx,
+            keep_alive=get_text_keep_alive(st.session_state['vision_residency'])
         )
+    apply_residency()
+    if prompts is None:
+        st.error("Error when parsing prompts. Aborded.")
+        return None, None
 
-        # validate response
-        try:
-            if st.session_state.prompt_mode == 'SDXL':
-                prompts = PromptsList.model_validate_json(response['message']['content'])
-            elif st.session_state.prompt_mode == 'Flux' or st.session_state.prompt_mode == 'Flux2':
-                prompts = PromptsFluxList.model_validate_json(response['message']['content'])
-            elif st.session_state.prompt_mode == 'None':
-                prompts = response['message']['content']
-                prompts = {
-                    "prompts":
-                        [
-                            {"positive": prompts}
-                        ]
-                }
-            if (
-                st.session_state.prompt_mode == 'SDXL' or \
-                st.session_state.prompt_mode == 'Flux' or \
-                st.session_state.prompt_mode == 'Flux2'
-            ):
-                st.session_state.response = prompts.model_dump_json()
-            else:
-                st.session_state.response = json.dumps(prompts)
-            return prompts, st.session_state.prompt_mode
-        except ValidationError as e:
-            attempt += 1
-            if attempt > 3:
-                st.error("Error when parsing prompts. Aborded.")
-                print()
-                print("Error when parsing prompts.")
-                print(e)
-                print("Aborded.")
-                print()
-                return None, None
-            st.error("Error when parsing prompts. Retry...")
-            print()
-            print("Error when parsing prompts.")
-            print(e)
-            print("Attempt", attempt, "Retrying...")
-            print()
-            messages = st.session_state['messages'] + [{'role': 'user', 'content': f"Please correct the JSON output; errors encountered:\n{e}"}]
+    if not st.session_state['cache_hit']:
+        set_cached_prompts(cache, key, prompts)
+
+    prompts = check_duplicates(prompts, messages[:-1] + [{'role': 'user', 'content': single_request}], num_ctx, on_response)
+
+    st.session_state.response = dump_prompts(prompts)
+    return prompts, st.session_state.prompt_mode
+
+def check_duplicates(prompts: BaseModel, messages: List[dict], num_ctx: int, on_response=None) -> BaseModel:
+    """
+    Find the prompts that are near-duplicates of a saved prompt or of another prompt of the list.
+
+    The duplicates are flagged in st.session_state['duplicates'] and, in the Regenerate mode,
+    generated again with another seed before being kept flagged.
+
+    Args:
+        prompts (BaseModel): The validated prompts.
+        messages (List[dict]): The messages asking for a single prompt, used for the regenerations.
+        num_ctx (int): The size of the context.
+        on_response (Callable, optional): Called with each response of the regenerations, its attempt number and its seed. Defaults to None.
 
-def get_content(vision_model: str, image: str, prompt: str) -> str:
+    Returns:
+        BaseModel: The prompts, with the duplicates replaced in the Regenerate mode.
+    """
+    st.session_state['duplicates'] = {}
+    if st.session_state['dedup'] == "off" or st.session_state.prompt_mode not in STRUCTURED_MODES:
+        # The None mode returns the raw text of the model, not a list of prompts
+        return prompts
+
+    try:
+        index = get_duplicate_index(st.session_state['dedup_model'], st.session_state['dedup_threshold'])
+        duplicates = find_duplicates(index, [prompt.positive for prompt in prompts.prompts])
+        for attempt in range(MAX_DEDUP_RETRIES if st.session_state['dedup'] == "regenerate" else 0):
+            if not duplicates:
+                break
+            for position in duplicates:
+                seed = st.session_state['last_seed'] + (attempt + 1) * len(prompts.prompts) + position
+                regenerated = generate_prompts(
+                    model=st.session_state.model,
+                    messages=messages,
+                    prompt_mode=st.session_state.prompt_mode,
+                    seed=seed,
+                    temperature=st.session_state['temperature'],
+                    constrained=st.session_state['constrained'],
+                    on_response=None if on_response is None else lambda response, retry, seed=seed: on_response(response, retry, seed),
+                    num_ctx=num_ctx,
+                    keep_alive=get_text_keep_alive(st.session_state['vision_residency'])
+                )
+                if regenerated is not None and regenerated.prompts:
+                    prompts.prompts[position] = regenerated.prompts[0]
+            duplicates = find_duplicates(index, [prompt.positive for prompt in prompts.prompts])
+    except (ollama.ResponseError, ConnectionError) as e:
+        st.warning(f"Detection of duplicates failed: {e}")
+        return prompts
+
+    st.session_state['duplicates'] = duplicates
+    return prompts
+
+def get_content(vision_model: str, image: str, prompt: str, description: str | None = None) -> str:
     """
     Get content from the ollama generate API.
 
@@ -375,44 +556,297 @@ def get_content(vision_model: str, image: str, prompt: str) -> str:
         vision_model (str): The name of the vision model to use.
         image (str): The path to the image to use.
         prompt (str): The prompt to use.
+        description (str, optional): The description of the image, already computed by the
+            vision stage of a pipeline. Defaults to None (the image is described here).
 
     Returns:
         str: The content generated by the model.
     """
     if image is not None and vision_model is not None:
-            bytes_data = uploaded_file.getvalue()
-            vision_response = ollama.generate(
-                model=st.session_state.model_vision,
-                prompt="""You are an art expert specializing in the appraisal of pictures and paintings. You will be able to extract relevant information from the image provided.
-Analyse the image provided and extract a subject, a style (including medium, composition, lightning, artist influence) and a brief description.
-If necessary, you can add adult content, nudity or explicit content.""",
-                images=[bytes_data],
-                system=prompt_system_vision,
-                stream=False,
-                keep_alive=0,
-            )
-
-            content = \
-"""
-{query}
-
-Reply to user's query using the following context:
-
-{context}"""
-
-            content = content.format(
-                context = vision_response['response'],
-                query = st.session_state.prompt
-            )
+            if description is None:
+                bytes_data, preprocessed = get_image(image)
+                description = describe_image(bytes_data, "vision" if preprocessed else "vision (original)")
+            content = get_vision_content(st.session_state.prompt, description)
             if st.session_state.display_vision_response:
                 with st.chat_message("assistant"):  
-                    st.write("**Vision response**")
-                    st.write(vision_response['response'])
+                    st.write("**Vision response** (cached)" if st.session_state['vision_cache_hit'] else "**Vision response**")
+                    st.write(description)
     else:
         content = st.session_state.prompt
 
     return content
 
+def start_preprocessing(image) -> None:
+    """
+    Start the preprocessing of an uploaded image in the worker thread.
+
+    The preprocessing runs while the page is rendered. It is started once per
+    image, vision model and quality.
+
+    Args:
+        image (UploadedFile): The uploaded image.
+    """
+    if not st.session_state['preprocess_images'] or st.session_state.model_vision is None:
+        return
+    key = (image.file_id, get_native_size(st.session_state.model_vision), st.session_state['jpeg_quality'])
+    job = st.session_state['image_job']
+    if job is not None and job[0] == key:
+        return
+    future = preprocess_in_background(image.getvalue(), key[1], key[2])
+    st.session_state['image_job'] = (key, future)
+
+def get_image(image) -> tuple[bytes, bool]:
+    """
+    Get the image to send to the vision model.
+
+    Args:
+        image (UploadedFile): The uploaded image.
+
+    Returns:
+        tuple[bytes, bool]: The image and whether it was preprocessed.
+    """
+    if not st.session_state['preprocess_images']:
+        return image.getvalue(), False
+    start_preprocessing(image)
+    try:
+        data, stats = st.session_state['image_job'][1].result()
+    except Exception as e:
+        print(f"Error when preprocessing the image: {e}")
+        return image.getvalue(), False
+    st.session_state['image_stats'] = stats
+    return data, True
+
+def describe_image(image: bytes, mode: str = "vision") -> str:
+    """
+    Describe an image with the vision model.
+
+    The descriptions are cached by image, vision model and prompt system, so asking
+    several requests about the same image runs the vision model once.
+
+    Args:
+        image (bytes): The image.
+        mode (str, optional): The mode of the telemetry record, "vision (original)" for an image
+            sent without preprocessing. Defaults to "vision".
+
+    Returns:
+        str: The description of the image.
+    """
+    model = st.session_state.model_vision
+    cache = get_vision_cache() if st.session_state['use_cache'] else None
+    description, vision_response = get_description(
+        model,
+        image,
+        get_digest(model),
+        cache,
+        keep_alive=get_vision_keep_alive(),
+        telemetry=get_telemetry(),
+        mode=mode
+    )
+    st.session_state['vision_cache_hit'] = vision_response is None if cache is not None else None
+    if vision_response is not None:
+        update_vision_status(vision_response)
+    return description
+
+def get_vision_keep_alive() -> int | str:
+    """
+    Get the keep_alive of the vision requests from the residency policy.
+
+    With the memory_pressure policy, the vision model is unloaded after the request
+    if the loaded models already do not fit in the GPU memory.
+    """
+    pressure = False
+    if st.session_state['vision_residency'] == "memory_pressure":
+        try:
+            pressure = bool(get_memory_pressure(max_vram=st.session_state['max_vram']))
+        except (ollama.ResponseError, ConnectionError) as e:
+            print(f"Error when reading the loaded models: {e}")
+    return get_keep_alive(st.session_state['vision_residency'], st.session_state['vision_keep_minutes'], pressure)
+
+def apply_residency() -> None:
+    """
+    Apply the residency policy of the vision model after a generation of the LLM, which may not fit next to it.
+    """
+    if st.session_state.model_vision is None:
+        return
+    unloaded = apply_policy(
+        st.session_state['vision_residency'],
+        st.session_state.model_vision,
+        max_vram=st.session_state['max_vram']
+    )
+    if unloaded is not None:
+        st.session_state['vision_unloaded'] = unloaded
+
+def update_vision_status(vision_response: dict) -> None:
+    """
+    Show the load time of the vision model and apply its residency policy after a vision request.
+
+    Args:
+        vision_response (dict): The response of the vision model.
+    """
+    st.session_state['vision_load'] = seconds(vision_response.get('load_duration') or 0)
+    st.session_state['vision_unloaded'] = apply_policy(
+        st.session_state['vision_residency'],
+        st.session_state.model_vision,
+        max_vram=st.session_state['max_vram']
+    )
+
+def get_images_describer():
+    """
+    Get the vision stage of the images pipeline.
+
+    The stage runs in a background thread, so the settings are read here,
+    in the thread of the script.
+
+    Returns:
+        Callable[[tuple], tuple[str, dict | None]]: The function preprocessing and describing an (index, image) entry,
+            returning the description and the response of the vision model (None if cached).
+    """
+    model = st.session_state.model_vision
+    digest = get_digest(model)
+    cache = get_vision_cache() if st.session_state['use_cache'] else None
+    keep_alive = get_vision_keep_alive()
+    preprocess = st.session_state['preprocess_images']
+    max_size = get_native_size(model)
+    quality = st.session_state['jpeg_quality']
+    telemetry = get_telemetry()
+
+    def describe(entry: tuple) -> tuple[str, dict | None]:
+        _, image = entry
+        data = image.getvalue()
+        if preprocess:
+            data, _ = preprocess_image(data, max_size, quality)
+        return get_description(
+            model,
+            data,
+            digest,
+            cache,
+            keep_alive=keep_alive,
+            telemetry=telemetry,
+            mode="vision" if preprocess else "vision (original)"
+        )
+    return describe
+
+def generate_from_images(images: list, request: str) -> None:
+    """
+    Answer a request for each image.
+
+    The images go through a two-stage pipeline: the vision model describes the
+    next image while the LLM answers with the description of the current one.
+
+    Args:
+        images (list): The uploaded images.
+        request (str): The user request.
+    """
+    responses = []
+
+    def generate(entry: tuple, result: tuple[str, dict | None]) -> None:
+        index, image = entry
+        description, vision_response = result
+        if vision_response is not None:
+            responses.append(vision_response)
+        # The label of the vision response is per image
+        st.session_state['vision_cache_hit'] = vision_response is None if st.session_state['use_cache'] else None
+        content = get_content(st.session_state.model_vision, image, request, description)
+        generate_response(content, f"{request} ({image.name})", index)
+
+    pipeline = Pipeline(get_images_describer(), generate)
+    for (_, image), _, error in pipeline.run(list(enumerate(images))):
+        if error is not None:
+            st.error(f"Error with the image {image.name}: {error}")
+
+    if responses:
+        update_vision_status(responses[-1])
+    st.caption(f"Pipeline: {pipeline.summary()}")
+
+def generate_response(content: str, request: str, index: int = 0) -> None:
+    """
+    Send a request to the model and display the response.
+
+    Args:
+        content (str): The content sent to the model, with the description of the image if any.
+        request (str): The user request, kept in the history instead of the content.
+        index (int, optional): The index of the image in a request about several images. Defaults to 0.
+    """
+    st.session_state['messages'].append({'role': 'user', 'content': content})
+
+    st.session_state.response = ""  
+    parsed = None
+    if st.session_state.mode:
+        with st.chat_message("assistant"):
+            with st.spinner("Generating..."):
+                if st.session_state.prompt_mode == 'Sequential':
+                    st.write_stream(stream_data)
+                else:
+                    preview = st.empty()
+                    prompts_list, mode = get_prompts(preview)
+                    parsed = (prompts_list, mode) if prompts_list is not None else None
+                    preview.empty()
+                    if display_prompts(prompts_list, output_error=True, prompt_mode=mode, duplicates=st.session_state['duplicates'], key=f"response_{index}"):
+                        col_1, col_2 = st.columns(2)
+
+                        with col_1:
+                            st.button("Save", on_click=save_response, args=[st.session_state.response, get_metadata(request)], key="save_response" if not index else f"save_response_image_{index}")
+                        with col_2:
+                            st.markdown(f"<p style='text-align: right; font-size: 14px; color: #CCCCCC'>Seed: {st.session_state['last_seed']} - Temperature: {st.session_state['temperature']}{cache_status()}{context_status()}</p>", unsafe_allow_html=True)
+        
+    else:
+        with st.chat_message("assistant"):
+            st.write_stream(stream_data)
+            st.markdown(f"<p style='text-align: right; font-size: 14px; color: #CCCCCC'>Seed: {st.session_state['last_seed']}{cache_status()}{context_status()}</p>", unsafe_allow_html=True)
+    
+    st.session_state['messages'][-1]['content'] = request
+    message = {'role': 'assistant', 'content': st.session_state.response, 'metadata': get_metadata(request)}
+    if parsed is not None:
+        # The prompts are already validated, the history does not parse them again
+        message['hash'] = get_message_hash(message['content'])
+        message['parsed'] = parsed
+    st.session_state['messages'].append(message)
+
+def get_message_hash(content: str) -> str:
+    """
+    Get the hash of the content of a message, identifying its parsed prompts.
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+def parse_message(message: dict) -> tuple[BaseModel, str] | None:
+    """
+    Get the prompts of an assistant message.
+
+    The prompts are parsed and validated once, then kept in the message with the hash
+    of its content: the following reruns read them without parsing the JSON again.
+
+    Args:
+        message (dict): The message.
+
+    Returns:
+        tuple[BaseModel, str] | None: The prompts and the prompt mode, None if the message has no valid prompts.
+    """
+    content = message['content']
+    key = message.get('hash')
+    if key is None or 'parsed' not in message or key != get_message_hash(content):
+        stripped = content.strip()
+        message['hash'] = get_message_hash(content)
+        message['parsed'] = validate_message(content) if stripped.startswith("{") and stripped.endswith("}") else None
+    return message['parsed']
+
+def get_metadata(request: str) -> dict:
+    """
+    Get the settings of the last generation, saved with its prompts.
+
+    Args:
+        request (str): The user request.
+
+    Returns:
+        dict: The request, the model, the prompt mode, the seed and the temperature.
+    """
+    return {
+        "request": request,
+        "model": st.session_state.model,
+        "mode": st.session_state.prompt_mode,
+        "seed": st.session_state['last_seed'],
+        "temperature": st.session_state['temperature'],
+    }
+
 def copy_prompt(prompt: str) -> None:
     """
     Copy prompt.
@@ -469,7 +903,7 @@ def validate_message(message: str) -> tuple[BaseModel, str]:
         except ValidationError as e:
             st.error("Error when parsing prompts. Aborded.")
     
-def display_prompts(prompts_list: PromptsList, output_error: bool = False, prompt_mode: str = "SDXL") -> bool:
+def display_prompts(prompts_list: PromptsList, output_error: bool = False, prompt_mode: str = "SDXL", duplicates: dict | None = None, key: str = "response") -> bool:
     """
     Display prompts.
 
@@ -478,6 +912,8 @@ def display_prompts(prompts_list: PromptsList, output_error: bool = False, promp
     Args:
         prompts_list (PromptsList): The prompts_list object to display.
         output_error (bool, optional): Whether to output an error message if no prompts are found. Defaults to False.
+        duplicates (dict, optional): The near-duplicate prompts by position, as returned by find_duplicates. Defaults to None.
+        key (str, optional): The key of the copy buttons, stable between reruns. Defaults to "response".
 
     Returns:
         bool: True if prompts are found and displayed, False otherwise.
@@ -501,11 +937,15 @@ def display_prompts(prompts_list: PromptsList, output_error: bool = False, promp
                     ":material/content_copy:", 
                     on_click=copy_prompt, 
                     args=[prompt_], 
-                    key=f"copy_{uuid.uuid4()}", 
+                    key=f"copy_{key}_{index}_positive", 
                     use_container_width=True,
                     help="Copy positive prompt"
                 )                
             st.write(f"{prompt_}", unsafe_allow_html=True)
+            if duplicates and index in duplicates:
+                duplicate, similarity = duplicates[index]
+                of = "a saved prompt" if duplicate is not None else "a previous prompt"
+                st.caption(f":orange[Near-duplicate of {of} ({similarity:.0%} similar)]")
             
             if prompt_mode == "SDXL":
                 col_1, col_2 = st.columns((10, 1))
@@ -516,7 +956,7 @@ def display_prompts(prompts_list: PromptsList, output_error: bool = False, promp
                         ":material/content_copy:", 
                         on_click=copy_prompt, 
                         args=[prompt.negative], 
-                        key=f"copy_{uuid.uuid4()}", 
+                        key=f"copy_{key}_{index}_negative", 
                         use_container_width=True, 
                         help="Copy negative prompt"
                     )                
@@ -550,6 +990,21 @@ def display_prompts(prompts_list: PromptsList, output_error: bool = False, promp
             st.write("No prompt found. Aborded.")
         return False
 
+def display_streamed_prompts(prompts: List[dict]) -> None:
+    """
+    Display the prompts received so far, while the model is still generating.
+
+    Args:
+        prompts (List[dict]): The prompts streamed so far, not yet validated.
+    """
+    for index, prompt in enumerate(prompts):
+        st.write(f":green[Positive {index + 1}]", unsafe_allow_html=True)
+        st.write(f"{prompt.get('positive', '')}", unsafe_allow_html=True)
+        if 'negative' in prompt:
+            st.write(f":red[Negative {index + 1}]", unsafe_allow_html=True)
+            st.write(f"{prompt['negative']}", unsafe_allow_html=True)
+        st.markdown("<hr style='margin-top: 0px; margin-bottom: 0px;'>", unsafe_allow_html=True)
+
 def reload_prompt(request: str) -> None:
     """
     Reload prompt.
@@ -561,7 +1016,7 @@ def reload_prompt(request: str) -> None:
     """
     st.session_state.prompt = request
 
-def display_request(request: str) -> None:
+def display_request(request: str, key: str) -> None:
     """
     Display request.
 
@@ -569,6 +1024,7 @@ def display_request(request: str) -> None:
 
     Args:
         request (str): The request to display.
+        key (str): The key of the buttons, stable between reruns.
     """
     with st.chat_message("user"):
         col_1, col_2, col_3 = st.columns((9, 1, 1), vertical_alignment="top")
@@ -579,7 +1035,7 @@ def display_request(request: str) -> None:
                 ":material/restart_alt:", 
                 on_click=reload_prompt, 
                 args=[request], 
-                key=f"edit_{uuid.uuid4()}", 
+                key=f"reload_{key}", 
                 use_container_width=True,
                 help="Reload prompt"
             )
@@ -588,49 +1044,121 @@ def display_request(request: str) -> None:
                 ":material/edit:", 
                 on_click=edit_prompt, 
                 args=[request, st.session_state.prompt_mode], 
-                key=f"edit_{uuid.uuid4()}", 
+                key=f"edit_{key}", 
                 use_container_width=True,
                 help="Edit prompt"
             )
 
-def save_response(response: str) -> None:
+def get_history_start(messages: List[dict], pages: int) -> int:
+    """
+    Get the first message of the history displayed.
+
+    Args:
+        messages (List[dict]): The conversation, starting with the prompt system.
+        pages (int): The number of pages of HISTORY_PAGE turns displayed.
+
+    Returns:
+        int: The index of the first message displayed, 1 for the whole history.
+    """
+    start = max(1, len(messages) - pages * HISTORY_PAGE * 2)
+    # A turn starts with a request
+    while start > 1 and messages[start]['role'] != 'user':
+        start -= 1
+    return start
+
+def show_older_messages() -> None:
+    '''Display one more page of the history.'''
+    st.session_state['history_pages'] += 1
+
+@st.fragment
+def display_history_prompts(index: int, message: dict) -> None:
+    """
+    Display the prompts of a message of the history.
+
+    The prompts are displayed in a fragment: a copy or a save only reruns this message,
+    not the whole history. The keys of the buttons come from the index and the hash of
+    the message, so they are the same at each rerun.
+
+    Args:
+        index (int): The index of the message.
+        message (dict): The message, parsed with parse_message.
+    """
+    prompt_validated, mode = message['parsed']
+    if display_prompts(prompt_validated, output_error=True, prompt_mode=mode, key=f"{index}_{message['hash']}"):
+        st.button("Save", on_click=save_response, args=[message['content'], message.get('metadata')], key=f"save_response_{index}")
+
+def display_search_result(result: dict) -> None:
+    """
+    Display a saved prompt found by the search, with a button to generate again from its request.
+
+    Args:
+        result (dict): The prompt, as returned by PromptStore.search.
+    """
+    date = time.strftime("%Y-%m-%d", time.localtime(result['created']))
+    details = " - ".join(value for value in (date, result['model'], result['mode']) if value)
+    st.markdown(f"<p style='font-size: 12px; color: #CCCCCC; margin-bottom: 0;'>{details}</p>", unsafe_allow_html=True)
+    col_1, col_2 = st.columns((5, 1), vertical_alignment="top")
+    with col_1:
+        st.write(result['positive'])
+    with col_2:
+        if result['request']:
+            st.button(
+                ":material/restart_alt:",
+                on_click=reload_prompt,
+                args=[result['request']],
+                key=f"search_{result['id']}",
+                help=f"Reload the request: {result['request']}"
+            )
+        else:
+            st.button(
+                ":material/restart_alt:",
+                on_click=preload_prompt,
+                args=[result['positive']],
+                key=f"search_{result['id']}",
+                help="Send this prompt as a request"
+            )
+
+def save_response(response: str, metadata: dict | None = None) -> None:
     '''
     Save response.
 
+    The prompts are added to the prompt store with their metadata, and written to the
+    files read by the ComfyUI workflow.
+
     Args:
         response (str): The response to be saved.
+        metadata (dict, optional): The request, model, prompt mode, seed and temperature of the response. Defaults to None.
     '''
     # Load response from the JSON string
     content, mode = validate_message(response)
     content = content.model_dump()
 
-    # create folder output if not exists
-    if not os.path.exists(PATH_OUTPUT):
-        os.makedirs(PATH_OUTPUT)
-    
-    # Write positive prompts to the file
-    with open(PATH_POSTIVE, 'w') as f:
-        for prompt in content['prompts']:
-            f.write(prompt['positive'] + '\n')
-    
-    with open(PATH_NEGATIVE, 'w') as f:
-        for prompt in content['prompts']:
-            if 'negative' in prompt:
-                f.write(prompt['negative'] + '\n')
-            else:
-                f.write("")
-
-    # Append prompts to the backup file
-    with open(PATH_BACKUP, 'a') as f:
-        for prompt in content['prompts']:
-            f.write(prompt['positive'] + '\n')
-            if 'negative' in prompt:
-                f.write(prompt['negative'] + '\n')
-            # if mode == "SDXL":
-            #     f.write(prompt['negative'] + '\n')
-            f.write('-'*20 + '\n')
+    prompts = content['prompts']
+    signatures, duplicates = None, {}
+    if st.session_state['dedup'] != "off":
+        index = get_duplicate_index(st.session_state['dedup_model'], st.session_state['dedup_threshold'])
+        try:
+            signatures = index.hasher.signatures([prompt['positive'] for prompt in prompts])
+            duplicates = find_duplicates(index, [prompt['positive'] for prompt in prompts], signatures)
+        except (ollama.ResponseError, ConnectionError) as e:
+            st.toast(f"Detection of duplicates failed: {e}", icon=":material/warning:")
+            signatures, duplicates = None, {}
+
+    store = get_prompt_store()
+    # The messages saved before the metadata had the mode have only the one inferred from the content
+    ids = store.add(prompts, **{'mode': mode, **(metadata or {})})
+    if signatures is not None:
+        index.add(ids, signatures)
+    saved = store.get(ids)
+    writer = get_prompts_writer()
+    if st.session_state['save_mode'] == "append":
+        writer.append(saved)
+    else:
+        writer.write(saved)
+    if st.session_state['comfyui_queue']:
+        submit_in_background(st.session_state['comfyui_url'], PATH_WORKFLOW, saved, [calculate_seed(0) for _ in saved])
     
-    st.toast("Saved!", icon=":material/save:")
+    st.toast(f"Saved! ({len(duplicates)} near-duplicates)" if duplicates else "Saved!", icon=":material/save:")
         
 def preload_prompt(prompt: str) -> None:
     """
@@ -645,6 +1173,23 @@ def preload_prompt(prompt: str) -> None:
     # Store the prompt in the session state
     st.session_state.prompt = prompt
 
+def cache_status() -> str:
+    '''Returns the cache status of the last generation for the footer.'''
+    if st.session_state['cache_hit'] is None:
+        return ""
+    return " - Cache: hit" if st.session_state['cache_hit'] else " - Cache: miss"
+
+def context_status() -> str:
+    '''Returns the prompt tokens of the last generation for the footer.'''
+    context = st.session_state['context']
+    status = f" - Context: {context.num_ctx}" if context.num_ctx else ""
+    if context.prompt_tokens is None:
+        return status
+    status += f" - Prompt tokens: {context.prompt_tokens}"
+    if context.dropped:
+        status += f" ({context.dropped} old messages dropped)"
+    return status
+
 def last_seed() -> None:
     '''Last seed'''
     if st.session_state['last_seed']:
@@ -658,6 +1203,8 @@ def clear_history() -> None:
             "content": prompt_system_chat
         }
     ]
+    st.session_state['context'].reset()
+    st.session_state['history_pages'] = 1
     st.toast("History cleared", icon=":material/delete_history:") 
 
 def clear_memory() -> None:
@@ -668,9 +1215,12 @@ def clear_memory() -> None:
         options={
             "seed": st.session_state['last_seed'],
             "temperature": st.session_state['temperature'],
-            "num_ctx": 4096
+            "num_ctx": st.session_state['context'].num_ctx or NUM_CTX
         }
     )
+    # The vision model may be kept in memory by its residency policy
+    if st.session_state.model_vision is not None and st.session_state['vision_residency'] != "unload":
+        unload(st.session_state.model_vision)
     st.toast("Memory cleared", icon=":material/memory:") 
 
 ##############
@@ -732,6 +1282,56 @@ if "seed" not in st.session_state:
     st.session_state["seed"] = settings["seed"]
 if "temperature" not in st.session_state:
     st.session_state["temperature"] = settings["temperature"]
+if "parallel" not in st.session_state:
+    st.session_state["parallel"] = settings["parallel"]
+if "constrained" not in st.session_state:
+    st.session_state["constrained"] = settings["constrained"]
+if "use_cache" not in st.session_state:
+    st.session_state["use_cache"] = settings["use_cache"]
+if "context_budget" not in st.session_state:
+    st.session_state["context_budget"] = settings["context_budget"]
+if "context" not in st.session_state:
+    st.session_state["context"] = ContextManager(settings["context_budget"])
+if "cache_hit" not in st.session_state:
+    st.session_state["cache_hit"] = None
+if "vision_residency" not in st.session_state:
+    st.session_state["vision_residency"] = settings["vision_residency"]
+if "vision_keep_minutes" not in st.session_state:
+    st.session_state["vision_keep_minutes"] = settings["vision_keep_minutes"]
+if "max_vram" not in st.session_state:
+    st.session_state["max_vram"] = float(settings["max_vram"])
+if "vision_load" not in st.session_state:
+    st.session_state["vision_load"] = None
+if "vision_unloaded" not in st.session_state:
+    st.session_state["vision_unloaded"] = None
+if "vision_cache_hit" not in st.session_state:
+    st.session_state["vision_cache_hit"] = None
+if "preprocess_images" not in st.session_state:
+    st.session_state["preprocess_images"] = settings["preprocess_images"]
+if "jpeg_quality" not in st.session_state:
+    st.session_state["jpeg_quality"] = settings["jpeg_quality"]
+if "dedup" not in st.session_state:
+    st.session_state["dedup"] = settings["dedup"]
+if "dedup_threshold" not in st.session_state:
+    st.session_state["dedup_threshold"] = float(settings["dedup_threshold"])
+if "dedup_model" not in st.session_state:
+    st.session_state["dedup_model"] = settings["dedup_model"]
+if "save_mode" not in st.session_state:
+    st.session_state["save_mode"] = settings["save_mode"]
+if "comfyui_queue" not in st.session_state:
+    st.session_state["comfyui_queue"] = settings["comfyui_queue"]
+if "comfyui_url" not in st.session_state:
+    st.session_state["comfyui_url"] = settings["comfyui_url"]
+if "history_pages" not in st.session_state:
+    st.session_state["history_pages"] = 1
+if "duplicates" not in st.session_state:
+    st.session_state["duplicates"] = {}
+if "image_job" not in st.session_state:
+    st.session_state["image_job"] = None
+if "image_stats" not in st.session_state:
+    st.session_state["image_stats"] = None
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = str(uuid.uuid4())
 if "last_seed" not in st.session_state:
     st.session_state["last_seed"] = None
 if "model" not in st.session_state:
@@ -743,6 +1343,9 @@ if "prompt_mode" not in st.session_state:
 if "mode" not in st.session_state:
     st.session_state["mode"] = settings["mode"]
 
+start_metrics_server()
+touch_session(st.session_state["session_id"])
+
 #################
 # SIDE BAR MENU #
 #################
@@ -772,7 +1375,7 @@ with st.sidebar:
         )
         st.selectbox(
             "Mode", 
-            ["None", "SDXL", "Flux", "Flux2", "Sequential"], 
+            PROMPT_MODES, 
             placeholder="Select a mode",
             key="prompt_mode",
             label_visibility="collapsed",
@@ -787,6 +1390,96 @@ with st.sidebar:
         st.number_input("Seed", min_value=0, max_value=2**32, step=1, key="seed")
     with col_2:
         st.button("Last seed", on_click=last_seed, key="randomize", use_container_width=True)
+    st.number_input(
+        "Parallel requests", 
+        min_value=1, 
+        max_value=32, 
+        step=1, 
+        key="parallel",
+        help=f"Split a request for several prompts into concurrent requests, one per prompt. Set it to OLLAMA_NUM_PARALLEL of the server ({MAX_IN_FLIGHT}). 1 to disable."
+    )
+    st.number_input(
+        "Context budget (tokens)", 
+        min_value=1024, 
+        max_value=131072, 
+        step=1024, 
+        key="context_budget",
+        help="Maximum size of the context (num_ctx). The size is selected for each request from the size of the conversation and of the expected response. The oldest messages are dropped to stay inside the budget, the prompt system is always kept."
+    )
+    st.toggle(
+        "JSON schema", 
+        key="constrained", 
+        help="Constrain the SDXL and Flux responses with the JSON schema of the prompts. Disable to only request JSON."
+    )
+    st.toggle(
+        "Use cache", 
+        key="use_cache", 
+        help="Reuse the response of an identical request (same model, messages, seed and temperature) and the description of an image already analysed. Disable to always generate."
+    )
+    with st.expander("Metrics"):
+        metrics = get_telemetry().summary()
+        if metrics:
+            st.dataframe(metrics, hide_index=True, use_container_width=True)
+            st.caption("Timings of the Ollama requests, logged in output/telemetry.jsonl")
+        else:
+            st.caption("No request yet.")
+    with st.expander("Duplicates"):
+        st.selectbox(
+            "Near-duplicates",
+            list(DEDUP_MODES),
+            format_func=DEDUP_MODES.get,
+            key="dedup",
+            help="Compare each new prompt with the saved prompts and the other prompts of the response. Flag marks the near-duplicates, Regenerate asks for another prompt first."
+        )
+        st.slider("Similarity threshold", min_value=0.5, max_value=1.0, step=0.05, key="dedup_threshold", disabled=st.session_state['dedup'] == "off")
+        st.text_input(
+            "Embedding model",
+            key="dedup_model",
+            placeholder="nomic-embed-text",
+            disabled=st.session_state['dedup'] == "off",
+            help="Ollama embedding model comparing the meaning of the prompts. Empty to compare their words (MinHash), without model."
+        )
+
+    with st.expander("ComfyUI"):
+        st.selectbox(
+            "Prompts files",
+            list(SAVE_MODES),
+            format_func=SAVE_MODES.get,
+            key="save_mode",
+            help="Save replaces the prompts of prompts_positive.txt and prompts_negative.txt, or appends them. The appended files are moved to numbered shards (prompts_positive.0001.txt...) when they reach 16 MB."
+        )
+        st.toggle(
+            "Queue saved prompts",
+            key="comfyui_queue",
+            help="Queue one job of workflow/wf_ISA_1.json per saved prompt in ComfyUI, with a random seed. The jobs are submitted in background, a few at a time."
+        )
+        st.text_input("ComfyUI URL", key="comfyui_url", disabled=not st.session_state['comfyui_queue'])
+
+    with st.expander("Retry statistics"):
+        stats = get_retry_stats()
+        if stats:
+            st.dataframe(stats, hide_index=True, use_container_width=True)
+        else:
+            st.caption("No prompt generated yet.")
+        repairs = get_repair_stats()
+        if repairs:
+            st.caption("Responses repaired locally, without asking the model again")
+            st.dataframe([{"repair": name, "count": count} for name, count in repairs.items()], hide_index=True, use_container_width=True)
+
+    with st.expander("Search prompts"):
+        search = st.text_input(
+            "Search", 
+            key="search_prompts", 
+            placeholder="steampunk airship",
+            label_visibility="collapsed",
+            help="Search the saved prompts and their requests."
+        )
+        if search:
+            start = time.perf_counter()
+            results = get_prompt_store().search(search)
+            st.caption(f"{len(results)} prompts in {(time.perf_counter() - start) * 1000:.0f} ms")
+            for result in results:
+                display_search_result(result)
 
     st.markdown('---')
 
@@ -797,18 +1490,69 @@ with st.sidebar:
     
 
 
-    uploaded_file = st.file_uploader(
+    uploaded_files = st.file_uploader(
         "Select image", 
         type=["jpg", "jpeg", "png"],
-        accept_multiple_files=False,
+        accept_multiple_files=True,
         key="image",
-        label_visibility="collapsed"
+        label_visibility="collapsed",
+        help="Several images are answered one after the other, the next image being described while the prompts of the current one are generated."
     )
+    uploaded_file = uploaded_files[0] if uploaded_files else None
 
     st.toggle("Display vision response", value=False, key="display_vision_response")
 
-    if uploaded_file is not None:
+    with st.expander("Vision model residency"):
+        st.selectbox(
+            "Policy",
+            list(RESIDENCY_POLICIES),
+            format_func=RESIDENCY_POLICIES.get,
+            key="vision_residency",
+            help="How long the vision model stays in memory after an image analysis. Unloading frees the memory for the LLM but the next image pays the full model load."
+        )
+        if st.session_state['vision_residency'] == "keep_hot":
+            st.number_input("Keep hot (minutes)", min_value=1, max_value=1440, step=1, key="vision_keep_minutes")
+        if st.session_state['vision_residency'] == "memory_pressure":
+            st.number_input(
+                "GPU memory (GB)",
+                min_value=0.0,
+                max_value=1024.0,
+                step=1.0,
+                key="max_vram",
+                help="Unload the vision model when the loaded models use more GPU memory. 0 to only unload when a model spills into the system memory."
+            )
+        if st.session_state['vision_load'] is not None:
+            st.caption(f"Last vision model load: {st.session_state['vision_load']:.2f}s")
+        if st.session_state['vision_unloaded']:
+            st.caption(f"Vision model unloaded: {st.session_state['vision_unloaded']}")
+
+    if len(uploaded_files or []) > 1:
+        st.image(uploaded_files, width=96)
+    elif uploaded_file is not None:
         st.image(uploaded_file)
+        start_preprocessing(uploaded_file)
+
+    with st.expander("Image preprocessing"):
+        st.toggle(
+            "Preprocess images",
+            key="preprocess_images",
+            help="Apply the EXIF orientation, downscale the image to the input size of the vision model and encode it in JPEG before the analysis."
+        )
+        st.slider("JPEG quality", min_value=50, max_value=95, step=5, key="jpeg_quality", disabled=not st.session_state['preprocess_images'])
+        stats = st.session_state['image_stats']
+        if stats is not None:
+            saved = 1 - stats['bytes'] / stats['original_bytes']
+            st.caption(
+                f"Last image: {stats['original_size'][0]}×{stats['original_size'][1]} → {stats['size'][0]}×{stats['size'][1]}, "
+                f"{format_bytes(stats['original_bytes'])} → {format_bytes(stats['bytes'])} ({saved:.0%} saved) in {stats['seconds']:.2f}s"
+            )
+        latencies = {row['mode']: row['p50 (s)'] for row in get_telemetry().summary()
+                     if row['model'] == st.session_state.model_vision and row['mode'].startswith('vision')}
+        if latencies:
+            st.caption("Vision latency p50: " + ", ".join(
+                f"{latencies[mode]}s {label}" for mode, label in (("vision", "preprocessed"), ("vision (original)", "original"))
+                if latencies.get(mode) is not None
+            ))
 
     st.markdown('---')
 
@@ -822,7 +1566,7 @@ with st.sidebar:
         color_i = 'green' if compare_i >= 0 else 'red'
         str_isa_latest = "ISA is up to date" if compare_i >= 0 else f"A new version of ISA is available: {i_latest}"
 
-    if o_latest == 'unknown':
+    if o_latest == 'unknown' or o_version == 'unknown':
         color_o = 'red'
         str_o_latest = 'Latest version of Ollama not available'
     else:
@@ -888,47 +1632,32 @@ if len(st.session_state.messages) < 2 and st.session_state.prompt is None:
         with col_button:
             st.button('Random', on_click=clear_history, key="next_subject", use_container_width=True, type='primary')
 else:
-    for index, message in enumerate(st.session_state.messages):
+    messages = st.session_state.messages
+    start = get_history_start(messages, st.session_state['history_pages'])
+    if start > 1:
+        st.button(
+            f"Show older messages ({(start - 1) // 2} turns hidden)",
+            on_click=show_older_messages,
+            key="show_older_messages",
+            type="tertiary",
+            icon=":material/expand_less:"
+        )
+    for index in range(start, len(messages)):
+        message = messages[index]
         if message['role'] == 'user':
-            display_request(message['content'])
-        elif message['role'] == 'assistant' and \
-            message['content'].strip().startswith("{") and \
-            message['content'].strip().endswith("}"):
-                with st.chat_message("assistant"):    
-                    prompt_validated, mode = validate_message(message['content'])     
-                    if display_prompts(prompt_validated, output_error=True, prompt_mode=mode): 
-                        st.button("Save", on_click=save_response, args=[message['content']], key=f"save_response_{index}")
-            
+            display_request(message['content'], f"{index}_{get_message_hash(message['content'])}")
+        elif message['role'] == 'assistant' and parse_message(message) is not None:
+            with st.chat_message("assistant"):
+                display_history_prompts(index, message)
         elif message['role'] == 'assistant':
             st.chat_message(message['role']).write(message['content'])
 
     if st.session_state.prompt:
-        display_request(st.session_state.prompt)
+        display_request(st.session_state.prompt, "pending")
                         
-        content = get_content(vision_model=st.session_state.model_vision, image=uploaded_file, prompt=st.session_state.prompt)
-
-        st.session_state['messages'].append({'role': 'user', 'content': content})
-
-        st.session_state.response = ""  
-        if st.session_state.mode:
-            with st.chat_message("assistant"):
-                with st.spinner("Generating..."):
-                    if st.session_state.prompt_mode == 'Sequential':
-                        st.write_stream(stream_data)
-                    else:
-                        prompts_list, mode = get_prompts()
-                        if display_prompts(prompts_list, output_error=True, prompt_mode=mode):
-                            col_1, col_2 = st.columns(2)
-
-                            with col_1:
-                                st.button("Save", on_click=save_response, args=[st.session_state.response], key="save_response")
-                            with col_2:
-                                st.markdown(f"<p style='text-align: right; font-size: 14px; color: #CCCCCC'>Seed: {st.session_state['last_seed']} - Temperature: {st.session_state['temperature']}</p>", unsafe_allow_html=True)
-            
+        if len(uploaded_files) > 1 and st.session_state.model_vision is not None:
+            generate_from_images(uploaded_files, st.session_state.prompt)
         else:
-            with st.chat_message("assistant"):
-                st.write_stream(stream_data)
-        
-        st.session_state['messages'][-1]['content'] = st.session_state.prompt
-        st.session_state['messages'].append({'role': 'assistant', 'content': st.session_state.response})
+            content = get_content(vision_model=st.session_state.model_vision, image=uploaded_file, prompt=st.session_state.prompt)
+            generate_response(content, st.session_state.prompt)
         st.session_state.prompt = None
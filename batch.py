@@ -0,0 +1,114 @@
+''' batch.py
+Command line tool to generate prompts in batch with ISA, without the Streamlit UI.
+
+Example:
+    python batch.py modules/subjects.py --model llama3 --mode SDXL
+'''
+
+import argparse
+import os
+import time
+from typing import Iterator
+
+import ollama
+
+from modules.cache import DiskCache
+from modules.telemetry import Telemetry
+from modules.json_repair import get_repair_stats
+from modules.metrics import start_server
+from modules.engine import BATCH_MODES, MAX_RETRIES, get_retry_stats, load_subjects, run_batch, run_batch_concurrent, write_batch
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+PATH_OUTPUT = os.path.join(BASEDIR, "output")
+PATH_CACHE = os.path.join(PATH_OUTPUT, "cache", "generation.sqlite")
+PATH_TELEMETRY = os.path.join(PATH_OUTPUT, "telemetry.jsonl")
+
+def parse_args() -> argparse.Namespace:
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser(description="Generate prompts in batch with ISA.")
+    parser.add_argument("subjects", help="File of subjects: Python module like modules/subjects.py, JSON list or text file (one subject per line)")
+    parser.add_argument("-m", "--model", required=True, help="LLM model used to generate the prompts")
+    parser.add_argument("--mode", choices=BATCH_MODES, default="SDXL", help="Prompt mode (default: SDXL)")
+    parser.add_argument("-o", "--output", default=None, help="Output JSONL file (default: output/batch_<date>.jsonl)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed, 0 for a random seed per subject (default: 0)")
+    parser.add_argument("--temperature", type=float, default=0.8, help="Temperature (default: 0.8)")
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES, help=f"Maximum retries per subject (default: {MAX_RETRIES})")
+    parser.add_argument("--no-schema", action="store_true", help="Ask for JSON output without constraining it with the prompts schema")
+    parser.add_argument("--no-cache", action="store_true", help="Always generate, do not reuse the cached responses of identical requests")
+    parser.add_argument("-p", "--parallel", type=int, default=1, help="Subjects generated concurrently, should match OLLAMA_NUM_PARALLEL of the server (default: 1)")
+    parser.add_argument("--host", default=None, help="Ollama host (default: OLLAMA_HOST or http://localhost:11434)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve OpenMetrics on http://127.0.0.1:<port>/metrics during the batch (default: ISA_METRICS_PORT, disabled if not set)")
+    return parser.parse_args()
+
+def log_progress(records: Iterator[dict], total: int) -> Iterator[dict]:
+    '''Print the progress of the batch generation.'''
+    for index, record in enumerate(records):
+        status = "OK" if record['prompts'] is not None else "FAILED"
+        print(f"[{index + 1}/{total}] {status} - {record['subject']}")
+        yield record
+
+def main() -> None:
+    '''Run the batch generation.'''
+    args = parse_args()
+
+    subjects = load_subjects(args.subjects)
+    output = args.output or os.path.join(PATH_OUTPUT, f"batch_{time.strftime('%Y%m%d_%H%M%S')}.jsonl")
+
+    print(f"{len(subjects)} subjects, model {args.model}, mode {args.mode}")
+    print(f"Output: {output}")
+
+    cache = None if args.no_cache else DiskCache(PATH_CACHE)
+    telemetry = Telemetry(PATH_TELEMETRY)
+    start_server(args.metrics_port)
+
+    start = time.time()
+    if args.parallel > 1:
+        records = run_batch_concurrent(
+            subjects,
+            model=args.model,
+            prompt_mode=args.mode,
+            seed=args.seed,
+            temperature=args.temperature,
+            host=args.host,
+            max_in_flight=args.parallel,
+            max_retries=args.retries,
+            constrained=not args.no_schema,
+            cache=cache,
+            telemetry=telemetry
+        )
+    else:
+        records = run_batch(
+            subjects,
+            model=args.model,
+            prompt_mode=args.mode,
+            seed=args.seed,
+            temperature=args.temperature,
+            client=ollama.Client(host=args.host),
+            max_retries=args.retries,
+            constrained=not args.no_schema,
+            cache=cache,
+            telemetry=telemetry
+        )
+    success, failed = write_batch(log_progress(records, len(subjects)), output)
+
+    print(f"Done in {time.time() - start:.1f}s: {success} succeeded, {failed} failed")
+    for stats in get_retry_stats():
+        print(f"{stats['model']} {stats['mode']} ({stats['format']}): {stats['retries']} retries, retry rate {stats['retry_rate']:.1%}")
+    if cache is not None:
+        print(f"Cache: {cache.hits} hits, {cache.misses} misses")
+    for metrics in telemetry.summary():
+        if metrics['model'] == args.model and metrics['mode'] == args.mode:
+            # The load time is None when the model was already loaded
+            parts = [
+                f"{metrics['tokens/s']} tokens/s" if metrics['tokens/s'] is not None else None,
+                f"load {metrics['load (s)']}s" if metrics['load (s)'] is not None else None,
+                f"p50 {metrics['p50 (s)']}s" if metrics['p50 (s)'] is not None else None,
+                f"p95 {metrics['p95 (s)']}s" if metrics['p95 (s)'] is not None else None,
+            ]
+            print(f"{metrics['model']} {metrics['mode']}: {', '.join(part for part in parts if part is not None)}")
+    repairs = get_repair_stats()
+    if repairs:
+        print("Local JSON repairs:", ", ".join(f"{name} {count}" for name, count in repairs.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+''' benchmark.py
+Benchmark of ISA against a local mock of Ollama, runs on a CPU-only machine without any model.
+
+The Streamlit app is driven with the Streamlit testing API, so each request goes through
+get_prompts() or stream_data() exactly like in the UI. For each prompt mode, the benchmark
+measures the time to first token, the total latency of a request and the number of retries.
+
+Example:
+    python benchmark.py --runs 5 --malformed-rate 0.2
+    python benchmark.py --baseline output/benchmark_baseline.json --tolerance 0.2
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from streamlit.testing.v1 import AppTest
+
+from modules.mock_ollama import MALFORMATIONS, MockOllamaServer, iter_requests
+from modules.subjects import subjects
+from modules.telemetry import percentile
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+PATH_APP = os.path.join(BASEDIR, "app.py")
+PATH_OUTPUT = os.path.join(BASEDIR, "output")
+
+# Modes benchmarked, "chat" is the chat mode (Create prompt off)
+BENCHMARK_MODES = ["chat", "None", "SDXL", "Flux", "Flux2", "Sequential"]
+
+# Model of the mock used for the benchmark
+MODEL = "llama3.2"
+
+def parse_args() -> argparse.Namespace:
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser(description="Benchmark ISA against a mock Ollama server.")
+    parser.add_argument("--modes", nargs="+", choices=BENCHMARK_MODES, default=BENCHMARK_MODES, help="Modes benchmarked (default: all)")
+    parser.add_argument("--runs", type=int, default=3, help="Requests per mode (default: 3)")
+    parser.add_argument("--count", type=int, default=2, help="Prompts requested per request (default: 2)")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="Generated tokens per second of the mock (default: 100)")
+    parser.add_argument("--prompt-rate", type=float, default=2000.0, help="Prompt tokens evaluated per second of the mock (default: 2000)")
+    parser.add_argument("--load-delay", type=float, default=0.5, help="Model load time of the mock in seconds (default: 0.5)")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Probability of a malformed JSON response (default: 0)")
+    parser.add_argument("--malformations", nargs="+", choices=MALFORMATIONS, default=MALFORMATIONS, help="Malformations injected")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the requests and of the malformed responses (default: 42)")
+    parser.add_argument("-o", "--output", default=None, help="Output JSON file (default: output/benchmark_<date>.json)")
+    parser.add_argument("--baseline", default=None, help="Previous benchmark output, exit with an error if a mode is slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown of the p50 latency against the baseline (default: 0.2)")
+    return parser.parse_args()
+
+def start_app(mode: str, seed: int) -> AppTest:
+    '''Start a session of the app in a mode, the cache and the fan-out are disabled to measure each request.'''
+    app = AppTest.from_file(PATH_APP, default_timeout=300)
+    app.session_state["model"] = MODEL
+    app.session_state["mode"] = mode != "chat"
+    app.session_state["prompt_mode"] = mode if mode != "chat" else "SDXL"
+    app.session_state["seed"] = seed
+    app.session_state["parallel"] = 1
+    app.session_state["use_cache"] = False
+    app.run()
+    return app
+
+def run_mode(mock: MockOllamaServer, mode: str, runs: int, count: int, seed: int) -> dict:
+    '''Send the requests of a mode and measure them.'''
+    mock.reset()
+    app = start_app(mode, seed)
+
+    ttft, latencies, retries, failures = [], [], 0, 0
+    for index in range(runs):
+        request = f"Create {count} prompts about: {subjects[(seed + index) % len(subjects)]}"
+        start = time.perf_counter()
+        app.chat_input(key="prompt_input").set_value(request).run()
+        latencies.append(time.perf_counter() - start)
+
+        if app.exception:
+            raise RuntimeError(f"{mode}: {app.exception[0].message}")
+
+        chats = list(iter_requests(mock, start, "/api/chat"))
+        first = [record["first_token"] for record in chats if record["first_token"] is not None]
+        if first:
+            ttft.append(min(first) - start)
+        retries += max(0, len(chats) - 1)
+        failures += any("Aborded" in error.value for error in app.error)
+
+        # One request per turn, without the history of the previous requests
+        app.button(key="clear_history").click().run()
+
+    ttft.sort()
+    latencies.sort()
+    return {
+        "mode": mode,
+        "runs": runs,
+        "ttft p50 (s)": percentile(ttft, 50),
+        "ttft p95 (s)": percentile(ttft, 95),
+        "latency p50 (s)": percentile(latencies, 50),
+        "latency p95 (s)": percentile(latencies, 95),
+        "retries": retries,
+        "failures": failures,
+    }
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    '''Get the modes slower than the baseline.'''
+    previous = {row["mode"]: row for row in baseline}
+    regressions = []
+    for row in results:
+        base = previous.get(row["mode"])
+        if base is None or not base["latency p50 (s)"]:
+            continue
+        if row["latency p50 (s)"] > base["latency p50 (s)"] * (1 + tolerance):
+            regressions.append(f"{row['mode']}: p50 {row['latency p50 (s)']}s, baseline {base['latency p50 (s)']}s")
+    return regressions
+
+def main() -> None:
+    '''Run the benchmark.'''
+    args = parse_args()
+    output = args.output or os.path.join(PATH_OUTPUT, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+
+    mock = MockOllamaServer(
+        token_rate=args.token_rate,
+        prompt_rate=args.prompt_rate,
+        load_delay=args.load_delay,
+        malformed_rate=args.malformed_rate,
+        malformations=args.malformations,
+        seed=args.seed
+    ).start()
+    # The ollama client reads OLLAMA_HOST when it is imported by the app
+    os.environ["OLLAMA_HOST"] = mock.url
+    print(f"Mock Ollama on {mock.url}: {args.token_rate} tokens/s, load {args.load_delay}s, malformed rate {args.malformed_rate}")
+
+    results, errors = [], []
+    # The app writes its store, caches and telemetry in a temporary folder, not in output/
+    with tempfile.TemporaryDirectory(prefix="isa_benchmark_", ignore_cleanup_errors=True) as folder:
+        os.environ["ISA_OUTPUT"] = folder
+        try:
+            for mode in args.modes:
+                try:
+                    row = run_mode(mock, mode, args.runs, args.count, args.seed)
+                except RuntimeError as e:
+                    errors.append(str(e))
+                    print(f"{mode}: FAILED {e}")
+                    continue
+                results.append(row)
+                print(f"{mode}: TTFT p50 {row['ttft p50 (s)']}s, latency p50 {row['latency p50 (s)']}s "
+                      f"p95 {row['latency p95 (s)']}s, {row['retries']} retries, {row['failures']} failures")
+        finally:
+            mock.stop()
+
+    folder = os.path.dirname(output)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Output: {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression - {regression}")
+        if regressions:
+            sys.exit(1)
+
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+''' comfyui.py
+Command line tool to queue saved prompts in ComfyUI, one job of workflow/wf_ISA_1.json per prompt.
+
+Example:
+    python comfyui.py --mode SDXL --since 2025-04-01
+    python comfyui.py --from-files --url http://127.0.0.1:8188
+'''
+
+import argparse
+import os
+import time
+
+from modules.comfyui import MAX_IN_FLIGHT, MAX_QUEUE, ComfyUIClient, Submitter, get_url, load_template
+from modules.engine import calculate_seed
+from modules.store import PromptStore
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+PATH_OUTPUT = os.path.join(BASEDIR, "output")
+PATH_STORE = os.path.join(PATH_OUTPUT, "prompts.sqlite")
+PATH_POSTIVE = os.path.join(PATH_OUTPUT, "prompts_positive.txt")
+PATH_NEGATIVE = os.path.join(PATH_OUTPUT, "prompts_negative.txt")
+PATH_WORKFLOW = os.path.join(BASEDIR, "workflow", "wf_ISA_1.json")
+
+def parse_date(value: str) -> float:
+    '''Parse a date like 2025-04-01 into a timestamp.'''
+    return time.mktime(time.strptime(value, "%Y-%m-%d"))
+
+def parse_args() -> argparse.Namespace:
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser(description="Queue saved prompts in ComfyUI.")
+    parser.add_argument("--url", default=None, help="URL of ComfyUI (default: COMFYUI_URL or http://127.0.0.1:8188)")
+    parser.add_argument("-w", "--workflow", default=PATH_WORKFLOW, help="Workflow used as template, saved from the UI or exported in API format (default: workflow/wf_ISA_1.json)")
+    parser.add_argument("--from-files", action="store_true", help="Queue the prompts of prompts_positive.txt and prompts_negative.txt instead of the store")
+    parser.add_argument("-m", "--model", default=None, help="Only the prompts of this model")
+    parser.add_argument("--mode", default=None, help="Only the prompts of this mode (SDXL, Flux or Flux2)")
+    parser.add_argument("--since", type=parse_date, default=None, help="Only the prompts saved from this date (YYYY-MM-DD)")
+    parser.add_argument("--until", type=parse_date, default=None, help="Only the prompts saved before this date (YYYY-MM-DD)")
+    parser.add_argument("-n", "--limit", type=int, default=None, help="Only the most recent prompts")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the images, 0 for a random seed per prompt (default: 0)")
+    parser.add_argument("-p", "--parallel", type=int, default=MAX_IN_FLIGHT, help=f"Requests to ComfyUI in flight (default: {MAX_IN_FLIGHT})")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE, help=f"Jobs running or pending in ComfyUI before waiting (default: {MAX_QUEUE})")
+    return parser.parse_args()
+
+def read_files(path_positive: str, path_negative: str) -> list[dict]:
+    '''Read the prompts of the files of the workflow, the Flux prompts have no negative.'''
+    with open(path_positive, encoding='utf-8') as f:
+        positives = [line.rstrip('\n') for line in f if line.strip()]
+    negatives = []
+    if os.path.exists(path_negative):
+        with open(path_negative, encoding='utf-8') as f:
+            negatives = [line.rstrip('\n') for line in f]
+    return [
+        {"positive": positive, "negative": negatives[index] if index < len(negatives) and negatives[index] else None}
+        for index, positive in enumerate(positives)
+    ]
+
+def main() -> None:
+    '''Queue the prompts.'''
+    args = parse_args()
+
+    if args.from_files:
+        prompts = read_files(PATH_POSTIVE, PATH_NEGATIVE)
+    else:
+        prompts = PromptStore(PATH_STORE).query(model=args.model, mode=args.mode, since=args.since, until=args.until, limit=args.limit)
+    if not prompts:
+        print("No prompt to queue")
+        return
+
+    client = ComfyUIClient(args.url or get_url())
+    submitter = Submitter(client, load_template(args.workflow), max_in_flight=args.parallel, max_queue=args.max_queue)
+    seeds = [calculate_seed(args.seed) for _ in prompts] if args.seed == 0 else [args.seed + index for index in range(len(prompts))]
+
+    print(f"{len(prompts)} prompts, ComfyUI {client.url}, workflow {args.workflow}")
+    start = time.time()
+    failed = 0
+    try:
+        for record in submitter.run(prompts, seeds):
+            prompt = prompts[record['index']]
+            if record['error'] is None:
+                print(f"[{record['index'] + 1}/{len(prompts)}] QUEUED {record['prompt_id']} - seed {record['seed']} - {prompt['positive'][:60]}")
+            else:
+                failed += 1
+                print(f"[{record['index'] + 1}/{len(prompts)}] FAILED {record['error']} - {prompt['positive'][:60]}")
+    except KeyboardInterrupt:
+        print("Stopped")
+    print(f"{len(prompts) - failed} prompts queued in {time.time() - start:.1f}s, {failed} failed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+''' hotfolder.py
+Command line tool watching a folder of images: each new image is described by the vision model and turned into prompts.
+
+Example:
+    python hotfolder.py input/ --model llama3 --vision-model llava --mode SDXL
+'''
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ollama
+
+from modules.engine import BATCH_MODES, MAX_RETRIES
+from modules.hotfolder import Checkpoint, process_images, scan, write_records
+from modules.images import DEFAULT_QUALITY, get_native_size
+from modules.metrics import start_server
+from modules.residency import KEEP_HOT_MINUTES
+from modules.telemetry import Telemetry
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+PATH_OUTPUT = os.path.join(BASEDIR, "output")
+PATH_TELEMETRY = os.path.join(PATH_OUTPUT, "telemetry.jsonl")
+
+def parse_args() -> argparse.Namespace:
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser(description="Generate prompts from the images dropped in a folder.")
+    parser.add_argument("folder", help="Folder watched for new images")
+    parser.add_argument("-m", "--model", required=True, help="LLM model used to generate the prompts")
+    parser.add_argument("-v", "--vision-model", required=True, help="Vision model used to describe the images")
+    parser.add_argument("--mode", choices=BATCH_MODES, default="SDXL", help="Prompt mode (default: SDXL)")
+    parser.add_argument("--request", default="Create 1 prompt about: the image", help="Request sent with each image description (default: 'Create 1 prompt about: the image')")
+    parser.add_argument("-o", "--output", default=os.path.join(PATH_OUTPUT, "hotfolder.jsonl"), help="Output JSONL file (default: output/hotfolder.jsonl)")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint of the processed images (default: <output>.done)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed, 0 for a random seed per image (default: 0)")
+    parser.add_argument("--temperature", type=float, default=0.8, help="Temperature (default: 0.8)")
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES, help=f"Maximum retries per image (default: {MAX_RETRIES})")
+    parser.add_argument("--no-schema", action="store_true", help="Ask for JSON output without constraining it with the prompts schema")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help=f"JPEG quality of the images sent to the vision model (default: {DEFAULT_QUALITY})")
+    parser.add_argument("--workers", type=int, default=None, help="Processes decoding the images (default: number of CPUs)")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between two scans of the folder (default: 5)")
+    parser.add_argument("--once", action="store_true", help="Process the images of the folder and exit, without watching it")
+    parser.add_argument("--host", default=None, help="Ollama host (default: OLLAMA_HOST or http://localhost:11434)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve OpenMetrics on http://127.0.0.1:<port>/metrics (default: ISA_METRICS_PORT, disabled if not set)")
+    return parser.parse_args()
+
+def main() -> None:
+    '''Watch the folder and process the new images.'''
+    args = parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint or f"{args.output}.done")
+    telemetry = Telemetry(PATH_TELEMETRY)
+    client = ollama.Client(host=args.host)
+    start_server(args.metrics_port)
+
+    print(f"Watching {args.folder}: vision model {args.vision_model}, model {args.model}, mode {args.mode}")
+    print(f"Output: {args.output} ({len(checkpoint.done)} images already processed)")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        try:
+            while True:
+                paths = scan(args.folder, checkpoint)
+                if paths:
+                    start = time.time()
+                    records = process_images(
+                        paths,
+                        executor,
+                        model=args.model,
+                        vision_model=args.vision_model,
+                        prompt_mode=args.mode,
+                        request=args.request,
+                        max_size=get_native_size(args.vision_model),
+                        quality=args.quality,
+                        seed=args.seed,
+                        temperature=args.temperature,
+                        client=client,
+                        keep_alive=f"{KEEP_HOT_MINUTES}m",
+                        max_retries=args.retries,
+                        constrained=not args.no_schema,
+                        telemetry=telemetry
+                    )
+                    success, failed = write_records(records, args.output, checkpoint)
+                    print(f"{len(paths)} images in {time.time() - start:.1f}s: {success} succeeded, {failed} failed")
+                if args.once:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            print("Stopped")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+''' cache.py
+
+This module contains a persistent cache stored in a SQLite file, with size and age based eviction.
+'''
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator
+
+class DiskCache:
+    """
+    Persistent key-value cache.
+
+    The entries older than max_age are removed and, when the total size of the
+    values exceeds max_size, the least recently used entries are removed.
+    """
+
+    def __init__(self, path: str, max_size: int = 64 * 1024 * 1024, max_age: float = 30 * 24 * 3600) -> None:
+        """
+        Args:
+            path (str): The path of the SQLite file, the folder is created if needed.
+            max_size (int, optional): The maximum size of the values in bytes. Defaults to 64 MB.
+            max_age (float, optional): The maximum age of an entry in seconds. Defaults to 30 days.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a connection, one per operation so the cache can be used from several threads.
+
+        The operation is committed (or rolled back on error) and the connection is closed at the end of the block.
+        """
+        with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as connection, connection:
+            yield connection
+
+    def get(self, key: str) -> str | None:
+        """
+        Get a value.
+
+        Args:
+            key (str): The key.
+
+        Returns:
+            str | None: The value, None if the key is not in the cache or has expired.
+        """
+        now = time.time()
+        with self.lock, self.connect() as connection:
+            row = connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND created >= ?", (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Store a value and evict the old entries if needed.
+
+        Args:
+            key (str): The key.
+            value (str): The value.
+        """
+        now = time.time()
+        with self.lock, self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            self.evict(connection, now)
+
+    def evict(self, connection: sqlite3.Connection, now: float) -> None:
+        """
+        Remove the expired entries, then the least recently used ones until the cache fits in max_size.
+        """
+        connection.execute("DELETE FROM entries WHERE created < ?", (now - self.max_age,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self) -> None:
+        """
+        Remove all the entries.
+        """
+        with self.lock, self.connect() as connection:
+            connection.execute("DELETE FROM entries")
+
+def hash_key(data: dict) -> str:
+    """
+    Hash a JSON serializable dict into a cache key.
+
+    Args:
+        data (dict): The data identifying the cached value.
+
+    Returns:
+        str: The SHA-256 of the data.
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
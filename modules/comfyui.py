@@ -0,0 +1,303 @@
+''' comfyui.py
+
+This module contains the submission of prompts to a ComfyUI server: the workflow workflow/wf_ISA_1.json is
+used as a template, its CLIPTextEncode texts and KSampler seed are patched for each prompt and the jobs are
+queued with /prompt, with a bounded number of requests in flight and a bounded queue on the server.
+'''
+import copy
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+import requests
+
+DEFAULT_URL = 'http://127.0.0.1:8188'
+
+# Timeout of the requests to ComfyUI, in seconds
+TIMEOUT = 10
+
+# Jobs running or pending on the server before the submission waits
+MAX_QUEUE = 4
+
+# Requests to /prompt in flight
+MAX_IN_FLIGHT = 2
+
+# Time between two checks of the queue of the server, in seconds
+POLL_INTERVAL = 1.0
+
+# Names of the widgets of the nodes of the template, in the order of widgets_values.
+# None is a widget of the UI only, e.g. "control after generate" of the seed.
+WIDGETS = {
+    "CheckpointLoaderSimple": ["ckpt_name"],
+    "CLIPTextEncode": ["text"],
+    "KSampler": ["seed", None, "steps", "cfg", "sampler_name", "scheduler", "denoise"],
+    "EmptyLatentImage": ["width", "height", "batch_size"],
+    "VAEDecode": [],
+    "SaveImage": ["filename_prefix"],
+}
+
+def get_url() -> str:
+    """
+    Get the URL of ComfyUI from COMFYUI_URL.
+    """
+    return os.environ.get('COMFYUI_URL', DEFAULT_URL).rstrip('/')
+
+def load_template(path: str) -> dict:
+    """
+    Load a workflow and convert it to the API format of /prompt if needed.
+
+    Workflows saved from the ComfyUI menu with "Export (API)" are used as is. Workflows saved
+    from the UI, like wf_ISA_1.json, are converted: the reroutes are followed, the texts of the
+    CLIPTextEncode nodes become widgets (they are patched for each prompt) and the nodes not
+    needed by the outputs, like the NX::MultiPromptsLoader group and the notes, are dropped.
+
+    Args:
+        path (str): The path of the workflow.
+
+    Returns:
+        dict: The workflow in API format, by node id.
+
+    Raises:
+        ValueError: If the workflow uses a node the conversion does not know.
+    """
+    with open(path, encoding='utf-8') as f:
+        workflow = json.load(f)
+    if 'nodes' not in workflow:
+        return workflow
+
+    nodes = {node['id']: node for node in workflow['nodes']}
+    links = {link[0]: (link[1], link[2]) for link in workflow['links']}
+
+    def origin(link: int) -> tuple[int, int]:
+        node, slot = links[link]
+        while nodes[node]['type'] == 'Reroute':
+            node, slot = links[nodes[node]['inputs'][0]['link']]
+        return node, slot
+
+    converted = {}
+    for id, node in nodes.items():
+        if node['type'] not in WIDGETS:
+            continue
+        inputs = {}
+        for name, value in zip(WIDGETS[node['type']], node.get('widgets_values') or []):
+            if name is not None:
+                inputs[name] = value
+        for input in node.get('inputs', []):
+            if input.get('link') is None or input['name'] in inputs or input.get('widget'):
+                continue
+            source, slot = origin(input['link'])
+            inputs[input['name']] = [str(source), slot]
+        converted[str(id)] = {"class_type": node['type'], "inputs": inputs, "_meta": {"title": node.get('title', node['type'])}}
+
+    # Keep the nodes needed by the outputs
+    needed, pending = set(), [id for id, node in converted.items() if node['class_type'] == 'SaveImage']
+    while pending:
+        id = pending.pop()
+        if id in needed:
+            continue
+        if id not in converted:
+            raise ValueError(f"Node {nodes[int(id)]['type']} of {path} is not supported, export the workflow in API format")
+        needed.add(id)
+        pending.extend(value[0] for value in converted[id]['inputs'].values() if isinstance(value, list))
+    return {id: node for id, node in converted.items() if id in needed}
+
+def build_workflow(template: dict, positive: str, negative: str | None, seed: int) -> dict:
+    """
+    Patch the template for a prompt.
+
+    The texts of the CLIPTextEncode nodes linked to the positive and negative inputs of the
+    KSampler nodes are replaced, and their seeds set.
+
+    Args:
+        template (dict): The workflow in API format.
+        positive (str): The positive prompt.
+        negative (str | None): The negative prompt, None for the Flux prompts (empty text).
+        seed (int): The seed of the image.
+
+    Returns:
+        dict: The workflow to submit.
+    """
+    workflow = copy.deepcopy(template)
+    for node in workflow.values():
+        if node['class_type'] != 'KSampler':
+            continue
+        node['inputs']['seed'] = seed
+        for name, text in (('positive', positive), ('negative', negative or "")):
+            source = node['inputs'].get(name)
+            if isinstance(source, list) and workflow[source[0]]['class_type'] == 'CLIPTextEncode':
+                workflow[source[0]]['inputs']['text'] = text
+    return workflow
+
+class ComfyUIClient:
+    """
+    Client of the ComfyUI HTTP API.
+    """
+
+    def __init__(self, url: str | None = None, timeout: float = TIMEOUT) -> None:
+        """
+        Args:
+            url (str, optional): The URL of ComfyUI. Defaults to COMFYUI_URL or http://127.0.0.1:8188.
+            timeout (float, optional): The timeout of the requests, in seconds. Defaults to TIMEOUT.
+        """
+        self.url = (url or get_url()).rstrip('/')
+        self.timeout = timeout
+        self.client_id = uuid.uuid4().hex
+        self.session = requests.Session()
+
+    def submit(self, workflow: dict) -> str:
+        """
+        Queue a workflow.
+
+        Returns:
+            str: The id of the job.
+
+        Raises:
+            requests.RequestException: If the server is not available or rejects the workflow.
+        """
+        response = self.session.post(
+            f"{self.url}/prompt",
+            json={"prompt": workflow, "client_id": self.client_id},
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise requests.HTTPError(f"{response.status_code} {response.text[:200]}", response=response)
+        return response.json()['prompt_id']
+
+    def queue_depth(self) -> int:
+        """
+        Get the number of jobs running or pending on the server.
+        """
+        response = self.session.get(f"{self.url}/queue", timeout=self.timeout)
+        response.raise_for_status()
+        queue = response.json()
+        return len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+class Submitter:
+    """
+    Submit the prompts to ComfyUI without flooding its queue.
+
+    At most max_in_flight requests to /prompt run at once, and a new job is only
+    submitted when the server has less than max_queue jobs running or pending, so
+    the GPU stays busy while the jobs not submitted yet can still be cancelled.
+    """
+
+    def __init__(
+            self,
+            client: ComfyUIClient,
+            template: dict,
+            max_in_flight: int = MAX_IN_FLIGHT,
+            max_queue: int = MAX_QUEUE,
+            poll_interval: float = POLL_INTERVAL
+        ) -> None:
+        """
+        Args:
+            client (ComfyUIClient): The client of the server.
+            template (dict): The workflow in API format.
+            max_in_flight (int, optional): The requests to /prompt running at once. Defaults to MAX_IN_FLIGHT.
+            max_queue (int, optional): The jobs running or pending on the server. Defaults to MAX_QUEUE.
+            poll_interval (float, optional): The time between two checks of the queue, in seconds. Defaults to POLL_INTERVAL.
+        """
+        self.client = client
+        self.template = template
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.submitted = 0
+
+    def wait_for_room(self) -> bool:
+        """
+        Wait until the queue of the server, with the jobs being submitted, is under max_queue.
+
+        The depth is read outside the lock, so the workers do not wait for each other's
+        request to /queue; the jobs submitted since the read are added to it.
+
+        Returns:
+            bool: True if a slot was taken, False if the submission was stopped.
+        """
+        while not self.stop.is_set():
+            submitted = self.submitted
+            depth = self.client.queue_depth()
+            with self.lock:
+                if depth + self.submitted - submitted + self.queued < self.max_queue:
+                    self.queued += 1
+                    return True
+            self.stop.wait(self.poll_interval)
+        return False
+
+    def submit(self, prompt: dict, seed: int) -> str:
+        """
+        Wait for room in the queue of the server and submit a prompt.
+        """
+        if not self.wait_for_room():
+            raise InterruptedError("submission stopped")
+        prompt_id = None
+        try:
+            prompt_id = self.client.submit(build_workflow(self.template, prompt['positive'], prompt.get('negative'), seed))
+            return prompt_id
+        finally:
+            with self.lock:
+                self.queued -= 1
+                if prompt_id is not None:
+                    self.submitted += 1
+
+    def run(self, prompts: List[dict], seeds: List[int]) -> Iterator[dict]:
+        """
+        Submit prompts.
+
+        Args:
+            prompts (List[dict]): The prompts, with a positive and, except for Flux, a negative.
+            seeds (List[int]): The seed of each prompt.
+
+        Yields:
+            dict: For each prompt, in order, its position, seed, the id of the job and the error if the submission failed.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="comfyui") as executor:
+            futures = [executor.submit(self.submit, prompt, seed) for prompt, seed in zip(prompts, seeds)]
+            try:
+                for index, (future, seed) in enumerate(zip(futures, seeds)):
+                    record = {"index": index, "seed": seed, "prompt_id": None, "error": None}
+                    try:
+                        record["prompt_id"] = future.result()
+                    except Exception as e:
+                        record["error"] = str(e)
+                    yield record
+            finally:
+                self.stop.set()
+                for future in futures:
+                    future.cancel()
+
+def submit_in_background(url: str, path: str, prompts: List[dict], seeds: List[int], **kwargs) -> threading.Thread:
+    """
+    Submit prompts in a background thread, the errors are printed.
+
+    Args:
+        url (str): The URL of ComfyUI.
+        path (str): The path of the workflow.
+        prompts (List[dict]): The prompts.
+        seeds (List[int]): The seed of each prompt.
+        **kwargs: The options of the Submitter.
+
+    Returns:
+        threading.Thread: The thread.
+    """
+    def run() -> None:
+        try:
+            submitter = Submitter(ComfyUIClient(url), load_template(path), **kwargs)
+            start = time.perf_counter()
+            failed = [record for record in submitter.run(prompts, seeds) if record['error'] is not None]
+            for record in failed:
+                print(f"Error when queuing prompt {record['index'] + 1} in ComfyUI: {record['error']}")
+            print(f"{len(prompts) - len(failed)}/{len(prompts)} prompts queued in ComfyUI in {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            print(f"Error when queuing the prompts in ComfyUI: {e}")
+
+    thread = threading.Thread(target=run, daemon=True, name="comfyui-submit")
+    thread.start()
+    return thread
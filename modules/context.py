@@ -0,0 +1,206 @@
+''' context.py
+
+This module contains the context manager keeping the conversation sent to the model inside a token budget.
+'''
+from typing import List
+
+# Tokens added by the chat template around each message
+MESSAGE_OVERHEAD = 4
+
+# Length of the summary of the dropped requests
+SUMMARY_LENGTH = 500
+
+# Bounds of the calibrated characters per token, outside them the value of Ollama is not trusted
+MIN_CHARS_PER_TOKEN = 1.0
+MAX_CHARS_PER_TOKEN = 10.0
+
+# Default maximum size of the context
+DEFAULT_BUDGET = 16384
+
+# Sizes of context used, Ollama reloads the model when num_ctx changes
+NUM_CTX_BUCKETS = [2048, 4096, 8192, 16384, 32768, 65536, 131072]
+
+# Expected tokens of the response, per prompt for the structured modes
+EXPECTED_OUTPUT = {
+    "chat": 1024,
+    "Sequential": 1024,
+    "None": 300,
+    "SDXL": 250,
+    "Flux": 300,
+    "Flux2": 350,
+}
+
+class ContextManager:
+    """
+    Keep the messages sent to the model inside a token budget.
+
+    The tokens of each message are estimated from its length. The number of characters
+    per token is calibrated with the prompt_eval_count returned by Ollama, so the
+    estimation follows the tokenizer of the model in use.
+    The prompt system and the last request are always kept. The oldest turns are dropped
+    first and a short reminder of the dropped requests is added to the prompt system.
+    """
+
+    def __init__(self, budget: int = DEFAULT_BUDGET, reserve: int = 1024) -> None:
+        """
+        Args:
+            budget (int, optional): The maximum number of tokens of the context (num_ctx). Defaults to DEFAULT_BUDGET.
+            reserve (int, optional): The tokens kept free for the response. Defaults to 1024.
+        """
+        self.budget = budget
+        self.reserve = reserve
+        self.chars_per_token = 4.0
+        self.prompt_tokens = None
+        self.dropped = 0
+        self.num_ctx = None
+
+    def count(self, message: dict) -> int:
+        """
+        Estimate the number of tokens of a message.
+
+        Args:
+            message (dict): The message.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return int(len(message['content']) / self.chars_per_token) + MESSAGE_OVERHEAD
+
+    def total(self, messages: List[dict]) -> int:
+        """
+        Estimate the number of tokens of a list of messages.
+        """
+        return sum(self.count(message) for message in messages)
+
+    def calibrate(self, messages: List[dict], prompt_eval_count: int | None) -> None:
+        """
+        Update the number of characters per token from the prompt tokens counted by Ollama.
+
+        Args:
+            messages (List[dict]): The messages sent to the model.
+            prompt_eval_count (int | None): The prompt_eval_count of the response.
+        """
+        if not prompt_eval_count:
+            return
+        self.prompt_tokens = prompt_eval_count
+        chars = sum(len(message['content']) for message in messages)
+        tokens = prompt_eval_count - MESSAGE_OVERHEAD * len(messages)
+        # Ollama reuses the cached prompt and may count fewer tokens, ignore these values
+        if chars == 0 or tokens <= 0 or chars / tokens > MAX_CHARS_PER_TOKEN:
+            return
+        # Short or CJK-heavy requests may count more tokens than characters
+        self.chars_per_token = max(MIN_CHARS_PER_TOKEN, 0.7 * self.chars_per_token + 0.3 * chars / tokens)
+
+    def fit(self, messages: List[dict], reserve: int | None = None) -> List[dict]:
+        """
+        Get the messages to send to the model, inside the budget.
+
+        Args:
+            messages (List[dict]): The whole conversation, starting with the prompt system.
+            reserve (int, optional): The tokens kept free for the response. Defaults to self.reserve.
+
+        Returns:
+            List[dict]: The prompt system, with a reminder of the dropped requests if any,
+                and the most recent messages fitting in the budget.
+        """
+        limit = self.budget - (self.reserve if reserve is None else reserve)
+        if self.total(messages) <= limit or len(messages) < 3:
+            self.dropped = 0
+            return messages
+
+        system, history = messages[0], messages[1:]
+        kept = [history[-1]]
+        used = self.count(system) + self.count(history[-1]) + int(SUMMARY_LENGTH / max(self.chars_per_token, MIN_CHARS_PER_TOKEN))
+        for message in reversed(history[:-1]):
+            used += self.count(message)
+            if used > limit:
+                break
+            kept.insert(0, message)
+
+        # A turn starts with a request
+        while len(kept) > 1 and kept[0]['role'] != 'user':
+            kept.pop(0)
+
+        dropped = history[:len(history) - len(kept)]
+        self.dropped = len(dropped)
+        system = {
+            "role": "system",
+            "content": f"{system['content']}\n\n{summarize(dropped)}".strip()
+        }
+        return [system] + kept
+
+    def get_num_ctx(self, messages: List[dict], prompt_mode: str, count: int = 1) -> int:
+        """
+        Select the size of the context from the size of the messages and of the expected response.
+
+        The size is rounded up to a bucket and does not shrink during a conversation,
+        so Ollama does not reload the model on every request.
+
+        Args:
+            messages (List[dict]): The messages sent to the model.
+            prompt_mode (str): The prompt mode, "chat" for the chat mode.
+            count (int, optional): The number of prompts requested. Defaults to 1.
+
+        Returns:
+            int: The num_ctx of the request.
+        """
+        needed = self.total(messages) + expected_output(prompt_mode, count)
+        if self.num_ctx is not None and needed <= self.num_ctx <= self.budget:
+            return self.num_ctx
+        self.num_ctx = select_num_ctx(needed, self.budget)
+        return self.num_ctx
+
+    def reset(self) -> None:
+        """
+        Forget the size of the context, when the history is cleared.
+        """
+        self.num_ctx = None
+        self.dropped = 0
+
+def expected_output(prompt_mode: str, count: int = 1) -> int:
+    """
+    Get the expected number of tokens of a response.
+
+    Args:
+        prompt_mode (str): The prompt mode, "chat" for the chat mode.
+        count (int, optional): The number of prompts requested. Defaults to 1.
+
+    Returns:
+        int: The expected number of tokens.
+    """
+    if prompt_mode in ("chat", "Sequential"):
+        return EXPECTED_OUTPUT[prompt_mode]
+    return EXPECTED_OUTPUT.get(prompt_mode, 300) * max(1, count)
+
+def select_num_ctx(tokens: int, budget: int) -> int:
+    """
+    Get the smallest bucket holding the tokens, without exceeding the budget.
+
+    Args:
+        tokens (int): The tokens of the prompt and of the expected response.
+        budget (int): The maximum size of the context.
+
+    Returns:
+        int: The size of the context.
+    """
+    for size in NUM_CTX_BUCKETS:
+        if size >= tokens:
+            return min(size, budget)
+    return budget
+
+def summarize(messages: List[dict]) -> str:
+    """
+    Summarize the dropped messages as a reminder of the previous requests.
+
+    Args:
+        messages (List[dict]): The dropped messages.
+
+    Returns:
+        str: The dropped requests, most recent last.
+    """
+    requests = [message['content'].strip().splitlines()[0] for message in messages
+                if message['role'] == 'user' and message['content'].strip()]
+    summary = "; ".join(requests)
+    if len(summary) > SUMMARY_LENGTH:
+        summary = "..." + summary[-SUMMARY_LENGTH:]
+    return f"Earlier in the conversation, the user asked: {summary}"
@@ -0,0 +1,348 @@
+''' dedup.py
+
+This module contains the detection of near-duplicate prompts: MinHash signatures over character shingles
+(or Ollama embeddings), indexed with locality-sensitive hashing in the prompt store.
+'''
+import contextlib
+import hashlib
+import json
+import math
+import random
+import re
+import sqlite3
+import struct
+import threading
+from typing import Iterable, Iterator, List
+
+import ollama
+
+DEFAULT_THRESHOLD = 0.8
+
+# Length of the signatures: MinHash values or bits of the random hyperplanes of the embeddings
+NUM_PERM = 64
+
+SHINGLE_SIZE = 5
+
+# Mersenne prime used by the hash functions of MinHash
+PRIME = (1 << 61) - 1
+
+def normalize(text: str) -> str:
+    """
+    Lowercase the text and keep the words only, so the punctuation and the spacing do not hide duplicates.
+    """
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def get_bands(num_perm: int, probability: float) -> tuple[int, int]:
+    """
+    Select the number of bands and of rows per band of the index.
+
+    Two signatures share a bucket if all the rows of one of their bands are equal. The
+    similarity where this happens with a probability of 1/2 is about (1/bands)^(1/rows),
+    the bands and rows are selected to put it just under the threshold.
+
+    Args:
+        num_perm (int): The length of the signatures.
+        probability (float): The probability of two values to be equal at the threshold.
+
+    Returns:
+        tuple[int, int]: The number of bands and of rows per band.
+    """
+    candidates = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    below = [candidate for candidate in candidates if (1 / candidate[0]) ** (1 / candidate[1]) <= probability]
+    return max(below or candidates, key=lambda candidate: (1 / candidate[0]) ** (1 / candidate[1]))
+
+class MinHasher:
+    """
+    MinHash signatures of the character shingles of the prompts, the share of equal values estimates their Jaccard similarity.
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = 1) -> None:
+        """
+        Args:
+            num_perm (int, optional): The length of the signatures. Defaults to NUM_PERM.
+            shingle_size (int, optional): The number of characters of the shingles. Defaults to SHINGLE_SIZE.
+            seed (int, optional): The seed of the hash functions. Defaults to 1.
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        generator = random.Random(seed)
+        self.permutations = [(generator.randrange(1, PRIME), generator.randrange(0, PRIME)) for _ in range(num_perm)]
+        self.name = f"minhash-{num_perm}-{shingle_size}-{seed}"
+
+    def shingles(self, text: str) -> set:
+        """
+        Get the hashes of the shingles of a text.
+        """
+        text = normalize(text)
+        if len(text) <= self.shingle_size:
+            text = text.ljust(self.shingle_size)
+        return {
+            struct.unpack('<Q', hashlib.blake2b(text[index:index + self.shingle_size].encode('utf-8'), digest_size=8).digest())[0]
+            for index in range(len(text) - self.shingle_size + 1)
+        }
+
+    def signatures(self, texts: List[str]) -> List[List[int]]:
+        """
+        Get the MinHash signatures of texts.
+        """
+        result = []
+        for text in texts:
+            hashes = self.shingles(text)
+            result.append([min((a * value + b) % PRIME for value in hashes) for a, b in self.permutations])
+        return result
+
+    def band_values(self, signature: List[int]) -> List[int]:
+        """
+        Get the values hashed in the bands of the index.
+        """
+        return signature
+
+    def similarity(self, first: List[int], second: List[int]) -> float:
+        """
+        Estimate the Jaccard similarity of two texts from their signatures.
+        """
+        return sum(a == b for a, b in zip(first, second)) / self.num_perm
+
+    def probability(self, threshold: float) -> float:
+        """
+        Get the probability of two values of the signatures to be equal at the threshold.
+        """
+        return threshold
+
+class EmbeddingHasher:
+    """
+    Embeddings of the prompts computed by an Ollama model, indexed with the signs of random projections.
+    """
+
+    def __init__(self, model: str, client: ollama.Client | None = None, num_perm: int = NUM_PERM, seed: int = 1) -> None:
+        """
+        Args:
+            model (str): The name of the embedding model, e.g. nomic-embed-text.
+            client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+            num_perm (int, optional): The number of random hyperplanes. Defaults to NUM_PERM.
+            seed (int, optional): The seed of the hyperplanes. Defaults to 1.
+        """
+        self.model = model
+        self.client = client or ollama
+        self.num_perm = num_perm
+        self.seed = seed
+        self.hyperplanes = None
+        self.name = f"embedding-{model}-{num_perm}-{seed}"
+
+    def signatures(self, texts: List[str]) -> List[List[float]]:
+        """
+        Get the normalized embeddings of texts.
+        """
+        if not texts:
+            return []
+        embeddings = self.client.embed(model=self.model, input=[normalize(text) for text in texts])['embeddings']
+        result = []
+        for embedding in embeddings:
+            norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+            result.append([value / norm for value in embedding])
+        return result
+
+    def band_values(self, signature: List[float]) -> List[int]:
+        """
+        Get the side of each random hyperplane the embedding is on.
+        """
+        if self.hyperplanes is None or len(self.hyperplanes[0]) != len(signature):
+            generator = random.Random(self.seed)
+            self.hyperplanes = [[generator.gauss(0, 1) for _ in signature] for _ in range(self.num_perm)]
+        return [int(sum(a * b for a, b in zip(plane, signature)) >= 0) for plane in self.hyperplanes]
+
+    def similarity(self, first: List[float], second: List[float]) -> float:
+        """
+        Get the cosine similarity of two embeddings.
+        """
+        return sum(a * b for a, b in zip(first, second))
+
+    def probability(self, threshold: float) -> float:
+        """
+        Get the probability of two embeddings to be on the same side of a random hyperplane at the threshold.
+        """
+        return 1 - math.acos(max(-1.0, min(1.0, threshold))) / math.pi
+
+class DuplicateIndex:
+    """
+    Locality-sensitive hashing index of the signatures of the saved prompts.
+
+    The signatures are split in bands and each band is hashed to a bucket stored in an
+    indexed table, so a query reads the few prompts sharing a bucket with the new one
+    instead of comparing it with the whole history. The tables are in the SQLite file
+    of the prompt store, one index per hasher.
+    """
+
+    def __init__(self, path: str, hasher: MinHasher | EmbeddingHasher, threshold: float = DEFAULT_THRESHOLD) -> None:
+        """
+        Args:
+            path (str): The path of the SQLite file of the prompt store.
+            hasher (MinHasher | EmbeddingHasher): The signatures of the prompts.
+            threshold (float, optional): The similarity from which prompts are duplicates. Defaults to DEFAULT_THRESHOLD.
+        """
+        self.path = path
+        self.hasher = hasher
+        self.threshold = threshold
+        self.bands, self.rows = get_bands(hasher.num_perm, hasher.probability(threshold))
+        self.lock = threading.Lock()
+
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS dedup_signatures ("
+                "hasher TEXT NOT NULL, id INTEGER NOT NULL, signature TEXT NOT NULL, PRIMARY KEY (hasher, id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS dedup_buckets ("
+                "hasher TEXT NOT NULL, band INTEGER NOT NULL, bucket TEXT NOT NULL, id INTEGER NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS dedup_buckets_bucket ON dedup_buckets (hasher, band, bucket)")
+            connection.execute("CREATE INDEX IF NOT EXISTS dedup_buckets_id ON dedup_buckets (hasher, id)")
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a connection, one per operation so the index can be used from several threads.
+
+        The operation is committed (or rolled back on error) and the connection is closed at the end of the block.
+        """
+        with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as connection, connection:
+            yield connection
+
+    @property
+    def key(self) -> str:
+        """
+        The name of the index in the tables, the bands depend on the threshold.
+        """
+        return f"{self.hasher.name}-{self.bands}x{self.rows}"
+
+    def buckets(self, signature: list) -> List[str]:
+        """
+        Get the bucket of each band of a signature.
+        """
+        values = self.hasher.band_values(signature)
+        return [
+            hashlib.blake2b(json.dumps(values[band * self.rows:(band + 1) * self.rows]).encode('utf-8'), digest_size=8).hexdigest()
+            for band in range(self.bands)
+        ]
+
+    def find(self, signature: list) -> tuple[int, float] | None:
+        """
+        Find the saved prompt most similar to a signature, above the threshold.
+
+        Args:
+            signature (list): The signature of the new prompt.
+
+        Returns:
+            tuple[int, float] | None: The id of the saved prompt and the similarity, None if there is no duplicate.
+        """
+        buckets = self.buckets(signature)
+        with self.connect() as connection:
+            candidates = {
+                id for band, bucket in enumerate(buckets) for (id,) in connection.execute(
+                    "SELECT id FROM dedup_buckets WHERE hasher = ? AND band = ? AND bucket = ?", (self.key, band, bucket)
+                )
+            }
+            best = None
+            for id in candidates:
+                row = connection.execute(
+                    "SELECT signature FROM dedup_signatures WHERE hasher = ? AND id = ?", (self.key, id)
+                ).fetchone()
+                similarity = self.hasher.similarity(signature, json.loads(row[0]))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (id, similarity)
+        return best
+
+    def add(self, ids: Iterable[int], signatures: Iterable[list]) -> None:
+        """
+        Index the signatures of saved prompts.
+
+        Args:
+            ids (Iterable[int]): The ids of the prompts in the store.
+            signatures (Iterable[list]): Their signatures.
+        """
+        with self.lock, self.connect() as connection:
+            for id, signature in zip(ids, signatures):
+                connection.execute(
+                    "INSERT OR REPLACE INTO dedup_signatures (hasher, id, signature) VALUES (?, ?, ?)",
+                    (self.key, id, json.dumps(signature))
+                )
+                connection.execute("DELETE FROM dedup_buckets WHERE hasher = ? AND id = ?", (self.key, id))
+                connection.executemany(
+                    "INSERT INTO dedup_buckets (hasher, band, bucket, id) VALUES (?, ?, ?, ?)",
+                    [(self.key, band, bucket, id) for band, bucket in enumerate(self.buckets(signature))]
+                )
+
+    def sync(self, batch_size: int = 256) -> int:
+        """
+        Index the prompts of the store not indexed yet, e.g. imported from a backup or saved while the detection was off.
+
+        Args:
+            batch_size (int, optional): The number of prompts read and hashed at once. Defaults to 256.
+
+        Returns:
+            int: The number of prompts indexed.
+        """
+        count = 0
+        while True:
+            with self.connect() as connection:
+                rows = connection.execute(
+                    "SELECT prompts.id, prompts.positive FROM prompts LEFT JOIN dedup_signatures "
+                    "ON dedup_signatures.hasher = ? AND dedup_signatures.id = prompts.id "
+                    "WHERE dedup_signatures.id IS NULL ORDER BY prompts.id LIMIT ?", (self.key, batch_size)
+                ).fetchall()
+            if not rows:
+                return count
+            self.add([id for id, _ in rows], self.hasher.signatures([positive for _, positive in rows]))
+            count += len(rows)
+
+    def sync_in_background(self) -> None:
+        """
+        Index the prompts not indexed yet in a background thread, the errors are printed.
+        """
+        def run() -> None:
+            try:
+                count = self.sync()
+                if count:
+                    print(f"{count} saved prompts indexed for the detection of duplicates")
+            except Exception as e:
+                print(f"Error when indexing the saved prompts: {e}")
+
+        threading.Thread(target=run, daemon=True, name="duplicate-index").start()
+
+def find_duplicates(
+        index: DuplicateIndex,
+        texts: List[str],
+        signatures: List[list] | None = None
+    ) -> dict[int, tuple[int | None, float]]:
+    """
+    Find the texts that are near-duplicates of a saved prompt or of a previous text of the list.
+
+    Args:
+        index (DuplicateIndex): The index of the saved prompts.
+        texts (List[str]): The new prompts.
+        signatures (List[list], optional): Their signatures, computed if None. Defaults to None.
+
+    Returns:
+        dict[int, tuple[int | None, float]]: For each duplicate, its position in the list, the id
+            of the saved prompt (None for a duplicate inside the list) and the similarity.
+    """
+    signatures = index.hasher.signatures(texts) if signatures is None else signatures
+    duplicates = {}
+    for position, signature in enumerate(signatures):
+        for previous in range(position):
+            similarity = index.hasher.similarity(signature, signatures[previous])
+            if previous not in duplicates and similarity >= index.threshold:
+                duplicates[position] = (None, similarity)
+                break
+        if position in duplicates:
+            continue
+        found = index.find(signature)
+        if found is not None:
+            duplicates[position] = found
+    return duplicates
+
+def get_hasher(model: str = '', client: ollama.Client | None = None) -> MinHasher | EmbeddingHasher:
+    """
+    Get the hasher of the prompts: MinHash, or the embeddings of an Ollama model if a model is set.
+    """
+    return EmbeddingHasher(model, client) if model else MinHasher()
@@ -0,0 +1,1051 @@
+''' engine.py
+
+This module contains the headless prompts generation engine of ISA.
+It can be used without Streamlit, for example to generate prompts in batch from a list of subjects.
+'''
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Iterable, Iterator, List
+
+import ollama
+from pydantic import BaseModel, ValidationError
+
+from modules.prompts_system import (
+    prompt_system_chat,
+    prompt_system_finetuned,
+    prompt_system_create,
+    prompt_system_flux,
+    prompt_system_flux2,
+    prompt_system_lolo,
+    prompt_system_vision,
+    prompt_vision,
+)
+from modules.cache import DiskCache, hash_key
+from modules.context import ContextManager
+from modules.telemetry import Telemetry
+from modules.inventory import ModelInventory
+from modules.metrics import GENERATION_REQUESTS, GENERATION_LATENCY, IN_FLIGHT, RETRIES, TOKENS_GENERATED, VALIDATION_FAILURES, VISION_REQUESTS
+from modules.json_repair import repair_json, record_repairs
+from modules.stream_parser import PromptsStreamParser
+from modules.schemas import PromptsList, PromptsFluxList, STRUCTURED_MODES, get_prompts_class
+
+# Prompt modes supported by the batch generation (Sequential is interactive)
+BATCH_MODES = ["None", "SDXL", "Flux", "Flux2"]
+
+NUM_CTX = 4096
+MAX_RETRIES = 3
+
+# Statistics of the validation retries, per model, prompt mode and format
+retry_stats = {}
+retry_stats_lock = threading.Lock()
+
+# Number of requests sent at the same time to Ollama, should match the OLLAMA_NUM_PARALLEL of the server
+MAX_IN_FLIGHT = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+
+# Pattern of the requests asking for several prompts, e.g. "Create 3 prompts about: a sporting car"
+PATTERN_COUNT = re.compile(r'\b(\d+)\s+prompts?\b', re.IGNORECASE)
+
+@lru_cache
+def get_prompt_schema() -> str:
+    '''
+    Returns the JSON schema for the prompts list.
+
+    Returns:
+        str: The JSON schema for the prompts list.
+    '''
+    return json.dumps(PromptsList.model_json_schema())
+
+@lru_cache
+def get_prompt_flux_schema() -> str:
+    '''
+    Returns the JSON schema for the prompts flux list.
+
+    Returns:
+        str: The JSON schema for the prompts flux list.
+    '''
+    return json.dumps(PromptsFluxList.model_json_schema())
+
+def get_prompt_system(generate_prompt: bool = True, prompt_model: str = 'SDXL') -> str:
+    """
+    Get prompt system.
+
+    This function returns the prompt system based on the value of the generate_prompt
+    parameter.
+
+    Args:
+        generate_prompt (bool, optional): Whether to generate the prompt system. Defaults to True.
+        prompt_model (str, optional): The prompt mode. Defaults to 'SDXL'.
+
+    Returns:
+        str: The prompt system.
+    """
+    if generate_prompt:
+        if prompt_model == 'SDXL':
+            schema = get_prompt_schema()
+            prompt_system = prompt_system_create.replace(r'{schema}', schema)
+        elif prompt_model == 'Flux':
+            schema = get_prompt_flux_schema()
+            prompt_system = prompt_system_flux.replace(r'{schema}', schema)
+        elif prompt_model == 'Flux2':
+            schema = get_prompt_flux_schema()
+            prompt_system = prompt_system_flux2.replace(r'{schema}', schema)
+        elif prompt_model == 'Sequential':
+            prompt_system = prompt_system_lolo
+        elif prompt_model == 'None':
+            prompt_system = prompt_system_finetuned
+        return prompt_system
+    else:
+        return prompt_system_chat
+
+def calculate_seed(seed: int) -> int:
+    """
+    Calculate seed."""
+    if seed == 0:
+        return random.randint(0, 2**32)
+
+    return seed
+
+def parse_prompts(content: str, prompt_mode: str) -> BaseModel | dict:
+    """
+    Parse the content returned by the model.
+
+    Args:
+        content (str): The content of the model response.
+        prompt_mode (str): The prompt mode used for the generation.
+
+    Raises:
+        ValidationError: If the content does not match the schema of the prompt mode.
+
+    Returns:
+        BaseModel | dict: A PromptsList or PromptsFluxList for the structured modes,
+            a dict with the same shape for the None mode.
+    """
+    if prompt_mode in STRUCTURED_MODES:
+        return get_prompts_class(prompt_mode).model_validate_json(content)
+
+    return {
+        "prompts":
+            [
+                {"positive": content}
+            ]
+    }
+
+def validate_prompts(content: str, prompt_mode: str) -> BaseModel | dict:
+    """
+    Parse the content returned by the model, repairing it locally if it is malformed.
+
+    The local repairs (code fences, trailing commas, unescaped quotes, missing brackets,
+    bare list...) are tried before the caller asks the model to correct its output.
+
+    Args:
+        content (str): The content of the model response.
+        prompt_mode (str): The prompt mode used for the generation.
+
+    Raises:
+        ValidationError: If the content does not match the schema, even after the repairs.
+
+    Returns:
+        BaseModel | dict: The prompts, see parse_prompts.
+    """
+    try:
+        return parse_prompts(content, prompt_mode)
+    except ValidationError as e:
+        repaired, repairs = repair_json(content)
+        if not repairs:
+            raise
+        try:
+            prompts = parse_prompts(repaired, prompt_mode)
+        except ValidationError:
+            record_repairs(repairs, success=False)
+            raise e
+        record_repairs(repairs, success=True)
+        return prompts
+
+def dump_prompts(prompts: BaseModel | dict) -> str:
+    """
+    Serialize prompts to a JSON string.
+
+    Args:
+        prompts (BaseModel | dict): The prompts returned by parse_prompts.
+
+    Returns:
+        str: The prompts as a JSON string.
+    """
+    if isinstance(prompts, BaseModel):
+        return prompts.model_dump_json()
+    return json.dumps(prompts)
+
+def generate_prompts(
+        model: str,
+        messages: List[dict],
+        prompt_mode: str,
+        seed: int,
+        temperature: float,
+        client: ollama.Client | None = None,
+        max_retries: int = MAX_RETRIES,
+        on_retry: Callable[[int, ValidationError], None] | None = None,
+        constrained: bool = True,
+        on_prompt: Callable[[dict], None] | None = None,
+        on_response: Callable[[dict, int], None] | None = None,
+        num_ctx: int = NUM_CTX,
+        keep_alive: int | str | None = None
+    ) -> BaseModel | dict | None:
+    """
+    Generate prompts with the ollama chat API.
+
+    The response is validated against the schema of the prompt mode. When the
+    validation fails, the model is asked to correct its output, up to max_retries times.
+    With on_prompt, the response is streamed and each prompt is given to on_prompt
+    as soon as it is complete, before the validation of the whole list.
+
+    Args:
+        model (str): The name of the LLM model.
+        messages (List[dict]): The messages, starting with the prompt system.
+        prompt_mode (str): The prompt mode (None, SDXL, Flux or Flux2).
+        seed (int): The seed used for the generation.
+        temperature (float): The temperature used for the generation.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        max_retries (int, optional): The maximum number of retries. Defaults to MAX_RETRIES.
+        on_retry (Callable, optional): Called with the attempt number and the error before each retry.
+        constrained (bool, optional): Whether to constrain the output with the JSON schema. Defaults to True.
+        on_prompt (Callable, optional): Called with each prompt (dict) of a structured mode as soon as it is streamed.
+        on_response (Callable, optional): Called with each response of Ollama (the last chunk when streamed,
+            with the token counts and durations) and the attempt number.
+        num_ctx (int, optional): The size of the context. Defaults to NUM_CTX.
+        keep_alive (int | str, optional): The time the LLM stays loaded. Defaults to None (default of Ollama).
+
+    Returns:
+        BaseModel | dict | None: The prompts, None if the validation failed after max_retries.
+    """
+    client = client or ollama
+    conversation = messages
+    attempt = 0
+    start = time.time()
+    response_format = get_format(prompt_mode, constrained)
+
+    while True:
+        stream = on_prompt is not None and prompt_mode in STRUCTURED_MODES
+        with IN_FLIGHT.track():
+            response = client.chat(
+                model=model,
+                messages=conversation,
+                stream=stream,
+                format=response_format,
+                options=get_options(seed, temperature, num_ctx),
+                keep_alive=keep_alive
+            )
+            if stream:
+                content, response = read_stream(response, on_prompt)
+            else:
+                content = response['message']['content']
+        TOKENS_GENERATED.inc(response.get('eval_count') or 0, model=model, mode=prompt_mode)
+        if on_response is not None:
+            on_response(response, attempt)
+
+        # validate response
+        try:
+            prompts = validate_prompts(content, prompt_mode)
+            record_attempts(model, prompt_mode, get_format_name(response_format), attempt, failed=False, duration=time.time() - start)
+            return prompts
+        except ValidationError as e:
+            attempt += 1
+            if not report_error(e, attempt, max_retries):
+                record_attempts(model, prompt_mode, get_format_name(response_format), attempt - 1, failed=True, duration=time.time() - start)
+                return None
+            if on_retry is not None:
+                on_retry(attempt, e)
+            conversation = get_correction_messages(messages, e)
+
+async def agenerate_prompts(
+        model: str,
+        messages: List[dict],
+        prompt_mode: str,
+        seed: int,
+        temperature: float,
+        client: ollama.AsyncClient,
+        max_retries: int = MAX_RETRIES,
+        on_retry: Callable[[int, ValidationError], None] | None = None,
+        constrained: bool = True,
+        on_response: Callable[[dict, int], None] | None = None,
+        num_ctx: int = NUM_CTX,
+        keep_alive: int | str | None = None
+    ) -> BaseModel | dict | None:
+    """
+    Generate prompts with the asynchronous ollama chat API.
+
+    Same as generate_prompts, but the request does not block the event loop
+    so several generations can run concurrently.
+
+    Args:
+        model (str): The name of the LLM model.
+        messages (List[dict]): The messages, starting with the prompt system.
+        prompt_mode (str): The prompt mode (None, SDXL, Flux or Flux2).
+        seed (int): The seed used for the generation.
+        temperature (float): The temperature used for the generation.
+        client (ollama.AsyncClient): The asynchronous ollama client.
+        max_retries (int, optional): The maximum number of retries. Defaults to MAX_RETRIES.
+        on_retry (Callable, optional): Called with the attempt number and the error before each retry.
+        constrained (bool, optional): Whether to constrain the output with the JSON schema. Defaults to True.
+        on_response (Callable, optional): Called with each response of Ollama and the attempt number.
+        num_ctx (int, optional): The size of the context. Defaults to NUM_CTX.
+        keep_alive (int | str, optional): The time the LLM stays loaded. Defaults to None (default of Ollama).
+
+    Returns:
+        BaseModel | dict | None: The prompts, None if the validation failed after max_retries.
+    """
+    conversation = messages
+    attempt = 0
+    start = time.time()
+    response_format = get_format(prompt_mode, constrained)
+
+    while True:
+        with IN_FLIGHT.track():
+            response = await client.chat(
+                model=model,
+                messages=conversation,
+                stream=False,
+                format=response_format,
+                options=get_options(seed, temperature, num_ctx),
+                keep_alive=keep_alive
+            )
+        TOKENS_GENERATED.inc(response.get('eval_count') or 0, model=model, mode=prompt_mode)
+        if on_response is not None:
+            on_response(response, attempt)
+
+        try:
+            prompts = validate_prompts(response['message']['content'], prompt_mode)
+            record_attempts(model, prompt_mode, get_format_name(response_format), attempt, failed=False, duration=time.time() - start)
+            return prompts
+        except ValidationError as e:
+            attempt += 1
+            if not report_error(e, attempt, max_retries):
+                record_attempts(model, prompt_mode, get_format_name(response_format), attempt - 1, failed=True, duration=time.time() - start)
+                return None
+            if on_retry is not None:
+                on_retry(attempt, e)
+            conversation = get_correction_messages(messages, e)
+
+def read_stream(stream: Iterable[dict], on_prompt: Callable[[dict], None]) -> tuple[str, dict]:
+    """
+    Read a streamed chat response, giving each prompt to on_prompt as soon as it is complete.
+
+    Args:
+        stream (Iterable[dict]): The chunks of the response.
+        on_prompt (Callable): Called with each prompt (dict).
+
+    Returns:
+        tuple[str, dict]: The whole content of the response and the last chunk (token counts and durations).
+    """
+    parser = PromptsStreamParser()
+    chunk = {}
+    for chunk in stream:
+        for prompt in parser.feed(chunk['message']['content']):
+            on_prompt(prompt)
+    return parser.content, chunk
+
+def get_format(prompt_mode: str, constrained: bool = True) -> str | dict:
+    """
+    Get the format requested to Ollama for a prompt mode.
+
+    With constrained, Ollama receives the JSON schema of the prompts list and
+    can only decode a response matching it.
+
+    Args:
+        prompt_mode (str): The prompt mode.
+        constrained (bool, optional): Whether to constrain the output with the JSON schema. Defaults to True.
+
+    Returns:
+        str | dict: The JSON schema (constrained) or 'json' for the structured modes, an empty string otherwise.
+    """
+    if prompt_mode not in STRUCTURED_MODES:
+        return ''
+    if not constrained:
+        return 'json'
+    if prompt_mode == 'SDXL':
+        return json.loads(get_prompt_schema())
+    return json.loads(get_prompt_flux_schema())
+
+def get_format_name(format: str | dict) -> str:
+    """
+    Get the name of a format returned by get_format, for the retry statistics.
+
+    Returns:
+        str: "schema" for a JSON schema, "json" for plain JSON, "none" when no format is sent (None and Sequential modes).
+    """
+    if isinstance(format, dict):
+        return "schema"
+    return format or "none"
+
+def record_attempts(model: str, prompt_mode: str, format: str, retries: int, failed: bool, duration: float = 0) -> None:
+    """
+    Record the number of retries of a generation in retry_stats and in the metrics.
+
+    Args:
+        model (str): The name of the LLM model.
+        prompt_mode (str): The prompt mode.
+        format (str): The name of the format sent to Ollama, see get_format_name.
+        retries (int): The number of retries of the generation.
+        failed (bool): Whether the generation was aborted.
+        duration (float, optional): The duration of the generation, retries included, in seconds. Defaults to 0.
+    """
+    GENERATION_REQUESTS.inc(mode=prompt_mode)
+    GENERATION_LATENCY.observe(duration, mode=prompt_mode)
+    RETRIES.inc(retries, model=model, mode=prompt_mode)
+    VALIDATION_FAILURES.inc(retries + (1 if failed else 0), model=model, mode=prompt_mode)
+
+    key = (model, prompt_mode, format)
+    with retry_stats_lock:
+        stats = retry_stats.setdefault(key, {"requests": 0, "retried": 0, "retries": 0, "failed": 0})
+        stats["requests"] += 1
+        stats["retried"] += 1 if retries > 0 else 0
+        stats["retries"] += retries
+        stats["failed"] += 1 if failed else 0
+
+def get_retry_stats() -> List[dict]:
+    """
+    Get the retry statistics of the generations since the start.
+
+    Returns:
+        List[dict]: One row per model, prompt mode and format with the number of requests,
+            the number of retries and the retry rate (share of requests that needed at least one retry).
+    """
+    with retry_stats_lock:
+        return [
+            {
+                "model": model,
+                "mode": prompt_mode,
+                "format": format,
+                **stats,
+                "retry_rate": round(stats["retried"] / stats["requests"], 3)
+            }
+            for (model, prompt_mode, format), stats in sorted(retry_stats.items())
+        ]
+
+def get_options(seed: int, temperature: float, num_ctx: int = NUM_CTX) -> dict:
+    """
+    Get the options of a generation request.
+
+    Args:
+        seed (int): The seed.
+        temperature (float): The temperature.
+        num_ctx (int, optional): The size of the context. Defaults to NUM_CTX.
+
+    Returns:
+        dict: The options sent to Ollama.
+    """
+    return {
+        "seed": seed,
+        "temperature": temperature,
+        "num_ctx": num_ctx
+    }
+
+def get_correction_messages(messages: List[dict], error: ValidationError) -> List[dict]:
+    """
+    Get the messages asking the model to correct its output.
+
+    Args:
+        messages (List[dict]): The messages of the failed request.
+        error (ValidationError): The validation error.
+
+    Returns:
+        List[dict]: The messages with the correction request.
+    """
+    return messages + [{'role': 'user', 'content': f"Please correct the JSON output; errors encountered:\n{error}"}]
+
+def report_error(error: ValidationError, attempt: int, max_retries: int) -> bool:
+    """
+    Print a validation error.
+
+    Args:
+        error (ValidationError): The validation error.
+        attempt (int): The number of failed attempts.
+        max_retries (int): The maximum number of retries.
+
+    Returns:
+        bool: True if the request can be retried, False if aborted.
+    """
+    print()
+    print("Error when parsing prompts.")
+    print(error)
+    if attempt > max_retries:
+        print("Aborded.")
+        print()
+        return False
+    print("Attempt", attempt, "Retrying...")
+    print()
+    return True
+
+def split_request(request: str) -> tuple[int, str]:
+    """
+    Split a request asking for several prompts into single prompt requests.
+
+    Args:
+        request (str): The user request, e.g. "Create 3 prompts about: a sporting car".
+
+    Returns:
+        tuple[int, str]: The number of prompts requested and the request for one prompt,
+            e.g. (3, "Create 1 prompt about: a sporting car"). (1, request) if no number is found.
+    """
+    match = PATTERN_COUNT.search(request)
+    if match is None:
+        return 1, request
+
+    single = request[:match.start()] + "1 prompt" + request[match.end():]
+    return int(match.group(1)), single
+
+def merge_prompts(results: Iterable[BaseModel | dict | None], prompt_mode: str) -> BaseModel | dict | None:
+    """
+    Merge the prompts of several generations in one list.
+
+    Args:
+        results (Iterable[BaseModel | dict | None]): The prompts of each generation, None for failed ones.
+        prompt_mode (str): The prompt mode.
+
+    Returns:
+        BaseModel | dict | None: A PromptsList or PromptsFluxList for the structured modes,
+            a dict for the None mode. None if every generation failed.
+    """
+    results = [result for result in results if result is not None]
+    if not results:
+        return None
+
+    if prompt_mode in STRUCTURED_MODES:
+        return get_prompts_class(prompt_mode)(
+            prompts=[prompt for result in results for prompt in result.prompts]
+        )
+    return {"prompts": [prompt for result in results for prompt in result["prompts"]]}
+
+async def afan_out(
+        model: str,
+        messages: List[dict],
+        prompt_mode: str,
+        seeds: List[int],
+        temperature: float,
+        host: str | None = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+        on_retry: Callable[[int, ValidationError], None] | None = None,
+        constrained: bool = True,
+        on_response: Callable[[dict, int, int], None] | None = None,
+        num_ctx: int = NUM_CTX,
+        keep_alive: int | str | None = None
+    ) -> BaseModel | dict | None:
+    """
+    Send the same request with different seeds, at most max_in_flight at the same time,
+    and merge the results.
+
+    Args:
+        model (str): The name of the LLM model.
+        messages (List[dict]): The messages, starting with the prompt system.
+        prompt_mode (str): The prompt mode (None, SDXL, Flux or Flux2).
+        seeds (List[int]): One seed per request.
+        temperature (float): The temperature.
+        host (str, optional): The Ollama host. Defaults to OLLAMA_HOST or http://localhost:11434.
+        max_in_flight (int, optional): The maximum number of concurrent requests. Defaults to MAX_IN_FLIGHT.
+        max_retries (int, optional): The maximum number of retries per request. Defaults to MAX_RETRIES.
+        on_retry (Callable, optional): Called with the attempt number and the error before each retry.
+        constrained (bool, optional): Whether to constrain the output with the JSON schema. Defaults to True.
+        on_response (Callable, optional): Called with each response of Ollama, the attempt number and the seed of the request.
+        num_ctx (int, optional): The size of the context. Defaults to NUM_CTX.
+        keep_alive (int | str, optional): The time the LLM stays loaded. Defaults to None (default of Ollama).
+
+    Returns:
+        BaseModel | dict | None: The merged prompts, None if every request failed.
+    """
+    client = ollama.AsyncClient(host=host)
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+
+    async def generate(seed: int) -> BaseModel | dict | None:
+        # The callback gets the seed of the request, so each response can be reproduced
+        callback = None if on_response is None else lambda response, attempt: on_response(response, attempt, seed)
+        async with semaphore:
+            return await agenerate_prompts(
+                model, messages, prompt_mode, seed, temperature, client, max_retries, on_retry, constrained,
+                callback, num_ctx, keep_alive
+            )
+
+    results = await asyncio.gather(*[generate(seed) for seed in seeds])
+    return merge_prompts(results, prompt_mode)
+
+def fan_out(
+        model: str,
+        messages: List[dict],
+        prompt_mode: str,
+        seeds: List[int],
+        temperature: float,
+        host: str | None = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+        on_retry: Callable[[int, ValidationError], None] | None = None,
+        constrained: bool = True,
+        on_response: Callable[[dict, int, int], None] | None = None,
+        num_ctx: int = NUM_CTX,
+        keep_alive: int | str | None = None
+    ) -> BaseModel | dict | None:
+    """
+    Blocking version of afan_out, see afan_out for the arguments.
+    """
+    return asyncio.run(afan_out(
+        model, messages, prompt_mode, seeds, temperature, host, max_in_flight, max_retries, on_retry, constrained,
+        on_response, num_ctx, keep_alive
+    ))
+
+def get_model_digest(model: str, client: ollama.Client | None = None) -> str:
+    """
+    Get the digest of a model, so the cache entries are not reused after the model is updated.
+
+    Args:
+        model (str): The name of the model, with or without the ":latest" tag.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+
+    Returns:
+        str: The digest of the model, an empty string if the model is not found.
+    """
+    return ModelInventory(client).digest(model)
+
+def get_generation_key(
+        model: str,
+        digest: str,
+        messages: List[dict],
+        prompt_mode: str,
+        seed: int,
+        temperature: float,
+        constrained: bool = True,
+        count: int = 1,
+        num_ctx: int = NUM_CTX
+    ) -> str:
+    """
+    Get the cache key of a generation.
+
+    Args:
+        model (str): The name of the LLM model.
+        digest (str): The digest of the model.
+        messages (List[dict]): The messages, starting with the prompt system.
+        prompt_mode (str): The prompt mode, "chat" for the chat mode.
+        seed (int): The seed.
+        temperature (float): The temperature.
+        constrained (bool, optional): Whether the output is constrained with the JSON schema. Defaults to True.
+        count (int, optional): The number of concurrent requests of a fan out. Defaults to 1.
+        num_ctx (int, optional): The size of the context. Defaults to NUM_CTX.
+
+    Returns:
+        str: The cache key.
+    """
+    system = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ''
+    history = messages[1:] if messages and messages[0]['role'] == 'system' else messages
+    return hash_key({
+        "model": model,
+        "digest": digest,
+        "system": hashlib.sha256(system.encode('utf-8')).hexdigest(),
+        "messages": [{"role": message['role'], "content": message['content']} for message in history],
+        "prompt_mode": prompt_mode,
+        "seed": seed,
+        "temperature": temperature,
+        "num_ctx": num_ctx,
+        "constrained": constrained,
+        "count": count
+    })
+
+def get_cached_prompts(cache: DiskCache | None, key: str, prompt_mode: str) -> BaseModel | dict | None:
+    """
+    Get prompts from the cache.
+
+    Args:
+        cache (DiskCache | None): The generation cache, None to bypass the cache.
+        key (str): The key returned by get_generation_key.
+        prompt_mode (str): The prompt mode.
+
+    Returns:
+        BaseModel | dict | None: The cached prompts, None on a cache miss.
+    """
+    if cache is None:
+        return None
+    content = cache.get(key)
+    if content is None:
+        return None
+    try:
+        if prompt_mode in STRUCTURED_MODES:
+            return get_prompts_class(prompt_mode).model_validate_json(content)
+        return json.loads(content)
+    except (ValidationError, json.decoder.JSONDecodeError):
+        return None
+
+def set_cached_prompts(cache: DiskCache | None, key: str, prompts: BaseModel | dict | None) -> None:
+    """
+    Store prompts in the cache. Failed generations are not stored.
+
+    Args:
+        cache (DiskCache | None): The generation cache, None to bypass the cache.
+        key (str): The key returned by get_generation_key.
+        prompts (BaseModel | dict | None): The prompts.
+    """
+    if cache is not None and prompts is not None:
+        cache.set(key, dump_prompts(prompts))
+
+# Request sent to the LLM with the description of an image
+VISION_CONTENT = """
+{query}
+
+Reply to user's query using the following context:
+
+{context}"""
+
+def generate_description(
+        model: str,
+        image: bytes,
+        client: ollama.Client | None = None,
+        keep_alive: int | str = 0,
+        telemetry: Telemetry | None = None,
+        mode: str = "vision"
+    ) -> dict:
+    """
+    Describe an image with a vision model.
+
+    Args:
+        model (str): The name of the vision model.
+        image (bytes): The image.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        keep_alive (int | str, optional): The time the vision model stays loaded. Defaults to 0 (unloaded after the request).
+        telemetry (Telemetry, optional): The telemetry recording the timings of the request. Defaults to None.
+        mode (str, optional): The mode of the telemetry record. Defaults to "vision".
+
+    Returns:
+        dict: The response of Ollama, the description is in response['response'].
+    """
+    client = client or ollama
+    VISION_REQUESTS.inc(model=model)
+    with IN_FLIGHT.track():
+        response = client.generate(
+            model=model,
+            prompt=prompt_vision,
+            images=[image],
+            system=prompt_system_vision,
+            stream=False,
+            keep_alive=keep_alive,
+        )
+    TOKENS_GENERATED.inc(response.get('eval_count') or 0, model=model, mode="vision")
+    if telemetry is not None:
+        telemetry.record(response, model, mode, kind="generate")
+    return response
+
+def get_description(
+        model: str,
+        image: bytes,
+        digest: str = '',
+        cache: DiskCache | None = None,
+        client: ollama.Client | None = None,
+        keep_alive: int | str = 0,
+        telemetry: Telemetry | None = None,
+        mode: str = "vision"
+    ) -> tuple[str, dict | None]:
+    """
+    Get the description of an image from the cache, or from the vision model.
+
+    Args:
+        model (str): The name of the vision model.
+        image (bytes): The image.
+        digest (str, optional): The digest of the vision model, part of the cache key. Defaults to ''.
+        cache (DiskCache, optional): The cache of the descriptions. Defaults to None (no cache).
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        keep_alive (int | str, optional): The time the vision model stays loaded. Defaults to 0.
+        telemetry (Telemetry, optional): The telemetry recording the timings of the request. Defaults to None.
+        mode (str, optional): The mode of the telemetry record. Defaults to "vision".
+
+    Returns:
+        tuple[str, dict | None]: The description and the response of Ollama, None if the description was cached.
+    """
+    key = get_vision_key(image, model, digest, prompt_system_vision, prompt_vision)
+    description = cache.get(key) if cache is not None else None
+    if description is not None:
+        return description, None
+
+    response = generate_description(model, image, client, keep_alive, telemetry, mode)
+    if cache is not None:
+        cache.set(key, response['response'])
+    return response['response'], response
+
+def get_vision_content(query: str, description: str) -> str:
+    """
+    Build the request sent to the LLM from the user query and the description of an image.
+    """
+    return VISION_CONTENT.format(query=query, context=description)
+
+def get_vision_key(image: bytes, model: str, digest: str, prompt_system: str, prompt: str) -> str:
+    """
+    Get the cache key of an image description.
+
+    The image is identified by the hash of its bytes, so the same image uploaded
+    again gets the same key whatever its file name.
+
+    Args:
+        image (bytes): The image sent to the vision model.
+        model (str): The name of the vision model.
+        digest (str): The digest of the vision model.
+        prompt_system (str): The prompt system of the vision request.
+        prompt (str): The prompt of the vision request.
+
+    Returns:
+        str: The cache key.
+    """
+    return hash_key({
+        "image": hashlib.sha256(image).hexdigest(),
+        "model": model,
+        "digest": digest,
+        "system": hashlib.sha256(prompt_system.encode('utf-8')).hexdigest(),
+        "prompt": hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    })
+
+def build_messages(subject: str, prompt_mode: str) -> List[dict]:
+    """
+    Build the messages used to generate prompts about a subject, without history.
+
+    Args:
+        subject (str): The user request, e.g. "Create 3 prompts about: a sporting car".
+        prompt_mode (str): The prompt mode.
+
+    Returns:
+        List[dict]: The prompt system and the user request.
+    """
+    return [
+        {"role": "system", "content": get_prompt_system(True, prompt_mode)},
+        {"role": "user", "content": subject}
+    ]
+
+def load_subjects(path: str) -> List[str]:
+    """
+    Load a list of subjects from a file.
+
+    The file can be a Python module with the same shape as modules/subjects.py
+    (a list assigned to a variable named subjects), a JSON list or a text file
+    with one subject per line.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        List[str]: The subjects.
+    """
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.py':
+        tree = ast.parse(source, filename=path)
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and \
+                any(isinstance(target, ast.Name) and target.id == 'subjects' for target in node.targets):
+                return [str(subject) for subject in ast.literal_eval(node.value)]
+        raise ValueError(f"No subjects list found in {path}")
+    if extension == '.json':
+        return [str(subject) for subject in json.loads(source)]
+
+    return [line.strip() for line in source.splitlines() if line.strip()]
+
+def run_batch(
+        subjects: Iterable[str],
+        model: str,
+        prompt_mode: str,
+        seed: int = 0,
+        temperature: float = 0.8,
+        client: ollama.Client | None = None,
+        max_retries: int = MAX_RETRIES,
+        constrained: bool = True,
+        cache: DiskCache | None = None,
+        telemetry: Telemetry | None = None
+    ) -> Iterator[dict]:
+    """
+    Generate prompts for each subject, one request per subject.
+
+    Args:
+        subjects (Iterable[str]): The subjects.
+        model (str): The name of the LLM model.
+        prompt_mode (str): The prompt mode (None, SDXL, Flux or Flux2).
+        seed (int, optional): The seed, 0 for a random seed per subject. Defaults to 0.
+        temperature (float, optional): The temperature. Defaults to 0.8.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        max_retries (int, optional): The maximum number of retries per subject. Defaults to MAX_RETRIES.
+        constrained (bool, optional): Whether to constrain the output with the JSON schema. Defaults to True.
+        cache (DiskCache, optional): The generation cache. Defaults to None (no cache).
+        telemetry (Telemetry, optional): The telemetry recording the timings of the requests. Defaults to None.
+
+    Yields:
+        dict: One record per subject. prompts is None if the generation failed.
+    """
+    digest = get_model_digest(model, client) if cache is not None else ''
+    context = ContextManager()
+    for subject in subjects:
+        subject_seed = calculate_seed(seed)
+        messages = build_messages(subject, prompt_mode)
+        num_ctx = context.get_num_ctx(messages, prompt_mode, split_request(subject)[0])
+        key = get_generation_key(model, digest, messages, prompt_mode, subject_seed, temperature, constrained, num_ctx=num_ctx)
+        prompts = get_cached_prompts(cache, key, prompt_mode)
+        if prompts is None:
+            prompts = generate_prompts(
+                model=model,
+                messages=messages,
+                prompt_mode=prompt_mode,
+                seed=subject_seed,
+                temperature=temperature,
+                client=client,
+                max_retries=max_retries,
+                constrained=constrained,
+                on_response=get_batch_on_response(context, telemetry, messages, model, prompt_mode, subject_seed),
+                num_ctx=num_ctx
+            )
+            set_cached_prompts(cache, key, prompts)
+        yield get_record(subject, model, prompt_mode, subject_seed, temperature, prompts)
+
+async def arun_batch(
+        subjects: Iterable[str],
+        model: str,
+        prompt_mode: str,
+        seed: int = 0,
+        temperature: float = 0.8,
+        host: str | None = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+        constrained: bool = True,
+        cache: DiskCache | None = None,
+        telemetry: Telemetry | None = None
+    ) -> AsyncIterator[dict]:
+    """
+    Generate prompts for each subject, up to max_in_flight subjects at the same time.
+
+    The records are yielded in completion order, see run_batch for the arguments.
+
+    Yields:
+        dict: One record per subject. prompts is None if the generation failed.
+    """
+    client = ollama.AsyncClient(host=host)
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+    digest = get_model_digest(model, ollama.Client(host=host)) if cache is not None else ''
+    context = ContextManager()
+
+    async def generate(subject: str) -> dict:
+        subject_seed = calculate_seed(seed)
+        messages = build_messages(subject, prompt_mode)
+        num_ctx = context.get_num_ctx(messages, prompt_mode, split_request(subject)[0])
+        key = get_generation_key(model, digest, messages, prompt_mode, subject_seed, temperature, constrained, num_ctx=num_ctx)
+        prompts = get_cached_prompts(cache, key, prompt_mode)
+        if prompts is None:
+            async with semaphore:
+                prompts = await agenerate_prompts(
+                    model=model,
+                    messages=messages,
+                    prompt_mode=prompt_mode,
+                    seed=subject_seed,
+                    temperature=temperature,
+                    client=client,
+                    max_retries=max_retries,
+                    constrained=constrained,
+                    on_response=get_batch_on_response(context, telemetry, messages, model, prompt_mode, subject_seed),
+                    num_ctx=num_ctx
+                )
+            set_cached_prompts(cache, key, prompts)
+        return get_record(subject, model, prompt_mode, subject_seed, temperature, prompts)
+
+    tasks = [asyncio.ensure_future(generate(subject)) for subject in subjects]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def run_batch_concurrent(
+        subjects: Iterable[str],
+        model: str,
+        prompt_mode: str,
+        seed: int = 0,
+        temperature: float = 0.8,
+        host: str | None = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+        constrained: bool = True,
+        cache: DiskCache | None = None,
+        telemetry: Telemetry | None = None
+    ) -> Iterator[dict]:
+    """
+    Blocking iterator over arun_batch, so the records can be written with write_batch.
+
+    Yields:
+        dict: One record per subject, in completion order.
+    """
+    loop = asyncio.new_event_loop()
+    records = arun_batch(subjects, model, prompt_mode, seed, temperature, host, max_in_flight, max_retries, constrained, cache, telemetry)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(records.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(records.aclose())
+        loop.close()
+
+def get_batch_on_response(
+        context: ContextManager,
+        telemetry: Telemetry | None,
+        messages: List[dict],
+        model: str,
+        prompt_mode: str,
+        seed: int
+    ) -> Callable[[dict, int], None]:
+    """
+    Get the on_response callback of a batch request, calibrating the context and recording the timings.
+    """
+    def on_response(response: dict, attempt: int) -> None:
+        context.calibrate(messages, response.get('prompt_eval_count'))
+        if telemetry is not None:
+            telemetry.record(response, model, prompt_mode, seed, attempt)
+    return on_response
+
+def get_record(subject: str, model: str, prompt_mode: str, seed: int, temperature: float, prompts: BaseModel | dict | None) -> dict:
+    """
+    Build the record of a subject written by write_batch.
+
+    Returns:
+        dict: The subject, the settings of the generation and the prompts (None if the generation failed).
+    """
+    return {
+        "subject": subject,
+        "model": model,
+        "prompt_mode": prompt_mode,
+        "seed": seed,
+        "temperature": temperature,
+        "prompts": json.loads(dump_prompts(prompts))['prompts'] if prompts is not None else None
+    }
+
+def write_batch(records: Iterable[dict], path: str) -> tuple[int, int]:
+    """
+    Append the records to a JSONL file, one line per record, as soon as they are generated.
+
+    Args:
+        records (Iterable[dict]): The records returned by run_batch.
+        path (str): The path of the JSONL file.
+
+    Returns:
+        tuple[int, int]: The number of successful and failed records.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    success, failed = 0, 0
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            if record['prompts'] is None:
+                failed += 1
+            else:
+                success += 1
+    return success, failed
@@ -0,0 +1,232 @@
+''' hotfolder.py
+
+This module contains the ingestion of a folder of images: each new image is described by the vision model and turned into prompts.
+'''
+import json
+import os
+import time
+from concurrent.futures import Executor, as_completed
+from typing import Iterator, List
+
+import ollama
+
+from modules.context import ContextManager
+from modules.engine import MAX_RETRIES, build_messages, calculate_seed, generate_description, generate_prompts, \
+    get_batch_on_response, get_record, get_vision_content, split_request
+from modules.images import DEFAULT_QUALITY, preprocess_image
+from modules.pipeline import Pipeline
+from modules.telemetry import Telemetry
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+
+# Time without change before a file is considered completely copied, in seconds
+MIN_AGE = 2
+
+class Checkpoint:
+    """
+    Files already processed, stored in a text file with one key per line.
+
+    A key is added only after the record of the file is written, so a file
+    interrupted in the middle of its processing is processed again at restart.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): The path of the checkpoint file, the folder is created if needed.
+        """
+        self.path = path
+        self.done = set()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.done = {line.rstrip('\n') for line in f if line.strip()}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.done
+
+    def add(self, key: str) -> None:
+        """
+        Mark a file as processed, the key is written to the disk before returning.
+        """
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(key + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.add(key)
+
+def file_key(path: str) -> str:
+    """
+    Identify a file by its name, size and modification time, so an image replaced by a new one is processed again.
+    """
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def scan(folder: str, checkpoint: Checkpoint, min_age: float = MIN_AGE) -> List[str]:
+    """
+    List the images of a folder not processed yet.
+
+    Args:
+        folder (str): The input folder.
+        checkpoint (Checkpoint): The files already processed.
+        min_age (float, optional): The images modified more recently are skipped, they may still be copied. Defaults to MIN_AGE.
+
+    Returns:
+        List[str]: The paths of the new images, oldest first.
+    """
+    now = time.time()
+    paths = []
+    for entry in os.scandir(folder):
+        if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if now - entry.stat().st_mtime < min_age or file_key(entry.path) in checkpoint:
+            continue
+        paths.append(entry.path)
+    return sorted(paths, key=os.path.getmtime)
+
+def decode(path: str, max_size: int, quality: int = DEFAULT_QUALITY) -> tuple[str, str, bytes, dict]:
+    """
+    Read and preprocess an image, run in the process pool.
+
+    Returns:
+        tuple[str, str, bytes, dict]: The path, the key of the file, the image to send and the preprocessing statistics.
+    """
+    key = file_key(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    image, stats = preprocess_image(data, max_size, quality)
+    return path, key, image, stats
+
+def process_images(
+        paths: List[str],
+        executor: Executor,
+        model: str,
+        vision_model: str,
+        prompt_mode: str,
+        request: str,
+        max_size: int,
+        quality: int = DEFAULT_QUALITY,
+        seed: int = 0,
+        temperature: float = 0.8,
+        client: ollama.Client | None = None,
+        keep_alive: int | str = "10m",
+        max_retries: int = MAX_RETRIES,
+        constrained: bool = True,
+        telemetry: Telemetry | None = None
+    ) -> Iterator[dict]:
+    """
+    Describe images and generate prompts from the descriptions.
+
+    The images are decoded in the executor (a process pool), in the order they are decoded
+    the vision model describes the next image while the LLM generates the prompts of the current one.
+
+    Args:
+        paths (List[str]): The images.
+        executor (Executor): The pool decoding the images.
+        model (str): The name of the LLM model.
+        vision_model (str): The name of the vision model.
+        prompt_mode (str): The prompt mode (None, SDXL, Flux or Flux2).
+        request (str): The user request sent with each description, e.g. "Create 2 prompts about: the image".
+        max_size (int): The longest side of the images sent to the vision model.
+        quality (int, optional): The JPEG quality. Defaults to DEFAULT_QUALITY.
+        seed (int, optional): The seed, 0 for a random seed per image. Defaults to 0.
+        temperature (float, optional): The temperature. Defaults to 0.8.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        keep_alive (int | str, optional): The time the vision model stays loaded. Defaults to 10 minutes.
+        max_retries (int, optional): The maximum number of retries per image. Defaults to MAX_RETRIES.
+        constrained (bool, optional): Whether to constrain the output with the JSON schema. Defaults to True.
+        telemetry (Telemetry, optional): The telemetry recording the timings of the requests. Defaults to None.
+
+    Yields:
+        dict: One record per image with the key of the file, the description and the prompts
+            (None if the generation failed, with the error if the image could not be processed).
+    """
+    context = ContextManager()
+    count = split_request(request)[0]
+    futures = [executor.submit(decode, path, max_size, quality) for path in paths]
+
+    def describe(future) -> tuple:
+        try:
+            path, key, image, stats = future.result()
+        except Exception as e:
+            return paths[futures.index(future)], None, None, e
+        description = generate_description(vision_model, image, client, keep_alive, telemetry)['response']
+        return path, key, stats, description
+
+    def generate(future, result: tuple) -> dict:
+        path, key, stats, description = result
+        image_seed = calculate_seed(seed)
+        if key is None:
+            return get_record(request, model, prompt_mode, image_seed, temperature, None) | {
+                "image": os.path.basename(path),
+                "key": file_key(path),
+                "error": f"decoding failed: {description}",
+            }
+
+        messages = build_messages(get_vision_content(request, description), prompt_mode)
+        num_ctx = context.get_num_ctx(messages, prompt_mode, count)
+        prompts = generate_prompts(
+            model=model,
+            messages=messages,
+            prompt_mode=prompt_mode,
+            seed=image_seed,
+            temperature=temperature,
+            client=client,
+            max_retries=max_retries,
+            constrained=constrained,
+            on_response=get_batch_on_response(context, telemetry, messages, model, prompt_mode, image_seed),
+            num_ctx=num_ctx
+        )
+        return get_record(request, model, prompt_mode, image_seed, temperature, prompts) | {
+            "image": os.path.basename(path),
+            "key": key,
+            "vision_model": vision_model,
+            "description": description,
+            "bytes": stats['bytes'],
+            "original_bytes": stats['original_bytes'],
+        }
+
+    pipeline = Pipeline(describe, generate)
+    for future, record, error in pipeline.run(as_completed(futures)):
+        if error is not None:
+            if not isinstance(error, (ollama.ResponseError, ConnectionError)):
+                raise error
+            # Ollama is not available, the image is not marked as processed
+            print(f"Error when processing {os.path.basename(paths[futures.index(future)])}: {error}")
+            continue
+        yield record
+    print(f"Pipeline: {pipeline.summary()}")
+
+def write_records(records: Iterator[dict], path: str, checkpoint: Checkpoint) -> tuple[int, int]:
+    """
+    Append the records to a JSONL file and mark their images as processed.
+
+    Args:
+        records (Iterator[dict]): The records returned by process_images.
+        path (str): The path of the JSONL file.
+        checkpoint (Checkpoint): The files already processed.
+
+    Returns:
+        tuple[int, int]: The number of successful and failed records.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    success, failed = 0, 0
+    for record in records:
+        key = record.pop('key')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        checkpoint.add(key)
+        status = "OK" if record['prompts'] is not None else "FAILED"
+        print(f"{status} - {record['image']}")
+        if record['prompts'] is None:
+            failed += 1
+        else:
+            success += 1
+    return success, failed
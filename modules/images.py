@@ -0,0 +1,117 @@
+''' images.py
+
+This module contains the preprocessing of the images sent to the vision models: orientation, resizing and JPEG encoding.
+'''
+import io
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+# Longest side of the images seen by the vision models, larger images are resized by the server anyway
+NATIVE_SIZES = {
+    'llava': 672,
+    'moondream': 756,
+    'GFalcon-UA/nous-hermes-2-vision': 672,
+    'minicpm-v': 1344,
+    'granite3.2-vision': 1152,
+    'llama3.2-vision': 1120,
+    'gemma3': 896,
+    'mistral-small3.1': 1540,
+}
+
+DEFAULT_NATIVE_SIZE = 1024
+
+DEFAULT_QUALITY = 85
+
+# One worker, the images are preprocessed one at a time outside the Streamlit script
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-preprocessing")
+
+def get_native_size(model: str) -> int:
+    """
+    Get the longest side of the images seen by a vision model.
+
+    Args:
+        model (str): The name of the vision model.
+
+    Returns:
+        int: The size in pixels.
+    """
+    for prefix, size in NATIVE_SIZES.items():
+        if model.startswith(prefix):
+            return size
+    return DEFAULT_NATIVE_SIZE
+
+def preprocess_image(data: bytes, max_size: int, quality: int = DEFAULT_QUALITY) -> tuple[bytes, dict]:
+    """
+    Prepare an image for a vision model.
+
+    The EXIF orientation is applied, the image is downscaled so its longest side is
+    max_size (never upscaled) and encoded in JPEG. The original bytes are kept if the
+    JPEG is not smaller and the image did not need to be resized or rotated.
+
+    Args:
+        data (bytes): The uploaded image.
+        max_size (int): The longest side of the image, in pixels.
+        quality (int, optional): The JPEG quality, 1 to 95. Defaults to DEFAULT_QUALITY.
+
+    Returns:
+        tuple[bytes, dict]: The image to send and the statistics: original and final size
+            in bytes and pixels, and the preprocessing time in seconds.
+    """
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    # 0x0112 is the EXIF orientation tag, 1 is the normal orientation
+    changed = image.getexif().get(0x0112, 1) != 1
+    image = ImageOps.exif_transpose(image)
+
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        changed = True
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    result = output.getvalue()
+    if not changed and len(result) >= len(data):
+        result = data
+
+    return result, {
+        "original_bytes": len(data),
+        "bytes": len(result),
+        "original_size": original_size,
+        "size": image.size,
+        "seconds": time.perf_counter() - start,
+    }
+
+def preprocess_in_background(data: bytes, max_size: int, quality: int = DEFAULT_QUALITY) -> Future:
+    """
+    Prepare an image in the worker thread.
+
+    Args:
+        data (bytes): The uploaded image.
+        max_size (int): The longest side of the image, in pixels.
+        quality (int, optional): The JPEG quality, 1 to 95. Defaults to DEFAULT_QUALITY.
+
+    Returns:
+        Future: The future of preprocess_image.
+    """
+    return executor.submit(preprocess_image, data, max_size, quality)
+
+def format_bytes(size: int) -> str:
+    """
+    Format a size in bytes, e.g. 1.5 MB.
+    """
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
@@ -0,0 +1,142 @@
+''' inventory.py
+
+This module contains the inventory of the models installed in Ollama, shared by the whole app.
+'''
+import re
+import threading
+import time
+from typing import List
+
+import ollama
+
+# Models only able to describe images, not listed as text models
+VISION_ONLY_PREFIXES = [
+    'llava',
+    'moondream',
+    'GFalcon-UA/nous-hermes-2-vision',
+    'minicpm-v',
+]
+
+# Models able to read images
+VISION_PREFIXES = VISION_ONLY_PREFIXES + [
+    'granite3.2-vision',
+    'llama3.2-vision',
+    'gemma3',
+    'mistral-small3.1',
+]
+
+# Models not able to chat
+PATTERN_EMBED = re.compile('embed', re.IGNORECASE)
+
+class ModelInventory:
+    """
+    Models installed in Ollama, fetched from /api/tags with a single request.
+
+    The inventory is cached for ttl seconds. When it expires, the cached models are
+    still returned while a background thread fetches the new list, so pulling a model
+    does not need a restart and the UI never waits for Ollama after the first load.
+    """
+
+    def __init__(self, client: ollama.Client | None = None, ttl: float = 60) -> None:
+        """
+        Args:
+            client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+            ttl (float, optional): The time before the inventory is refreshed, in seconds. Defaults to 60.
+        """
+        self.client = client or ollama
+        self.ttl = ttl
+        self.models = {}
+        self.updated = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """
+        Fetch the models from Ollama and classify them.
+        """
+        models = {}
+        for item in self.client.list()['models']:
+            name = item['model']
+            if PATTERN_EMBED.search(name):
+                continue
+            short_name = name[:-7] if name.endswith(':latest') else name
+            models[short_name] = {
+                "name": short_name,
+                "model": name,
+                "digest": item.get('digest') or '',
+                "size": item.get('size') or 0,
+                "text": not name.startswith(tuple(VISION_ONLY_PREFIXES)),
+                "vision": name.startswith(tuple(VISION_PREFIXES)),
+            }
+        with self.lock:
+            self.models = models
+            self.updated = time.time()
+
+    def refresh_in_background(self) -> None:
+        """
+        Refresh the inventory in a background thread, the errors are printed and the cached models kept.
+        """
+        def run() -> None:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error when listing the Ollama models: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing = False
+
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=run, daemon=True, name="model-inventory").start()
+
+    def get(self) -> dict:
+        """
+        Get the models, loaded at the first call and refreshed in background when expired.
+
+        Returns:
+            dict: The models by name (without the ":latest" tag) with their full name, digest, size
+                and whether they can be used as text model and as vision model.
+        """
+        if self.updated is None:
+            self.refresh()
+        elif time.time() - self.updated > self.ttl:
+            self.refresh_in_background()
+        with self.lock:
+            return dict(self.models)
+
+    def text_models(self) -> List[str]:
+        """
+        Get the names of the models suitable to generate prompts.
+        """
+        return [name for name, model in self.get().items() if model['text']]
+
+    def vision_models(self) -> List[str]:
+        """
+        Get the names of the models suitable for image reading.
+        """
+        return [name for name, model in self.get().items() if model['vision']]
+
+    def info(self, model: str) -> dict | None:
+        """
+        Get a model, with or without the ":latest" tag, None if it is not installed.
+        """
+        models = self.get()
+        if model.endswith(':latest'):
+            model = model[:-7]
+        return models.get(model)
+
+    def digest(self, model: str) -> str:
+        """
+        Get the digest of a model, an empty string if it is not installed.
+        """
+        info = self.info(model)
+        return info['digest'] if info is not None else ''
+
+    def size(self, model: str) -> int:
+        """
+        Get the size of a model in bytes, 0 if it is not installed.
+        """
+        info = self.info(model)
+        return info['size'] if info is not None else 0
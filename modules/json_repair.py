@@ -0,0 +1,200 @@
+''' json_repair.py
+
+This module contains a local repair of the malformed JSON responses, tried before asking the model to correct its output.
+'''
+import json
+import re
+import threading
+from typing import Callable, List
+
+# Number of times each repair fixed a response
+repair_stats = {}
+repair_stats_lock = threading.Lock()
+
+PATTERN_FENCE = re.compile(r'```(?:json)?\s*(.*?)\s*(?:```|$)', re.DOTALL | re.IGNORECASE)
+
+def strip_fences(text: str) -> str:
+    """
+    Remove the markdown code fences around the JSON, e.g. ```json ... ```.
+    """
+    match = PATTERN_FENCE.search(text)
+    if match is None:
+        return text
+    return match.group(1)
+
+def strip_text(text: str) -> str:
+    """
+    Remove the text before the first { or [ and after the last } or ].
+
+    The end is kept if it looks like a truncated JSON (quotes after the last bracket).
+    """
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        return text
+    text = text[min(starts):]
+    end = max(text.rfind('}'), text.rfind(']'))
+    if end >= 0 and '"' not in text[end + 1:]:
+        text = text[:end + 1]
+    return text.strip()
+
+def next_char(text: str, index: int) -> str:
+    """
+    Get the first non blank character after index, an empty string at the end of the text.
+    """
+    for char in text[index:]:
+        if not char.isspace():
+            return char
+    return ''
+
+def escape_strings(text: str) -> str:
+    """
+    Escape the quotes and the control characters inside the strings.
+
+    A quote is considered as the end of a string only if it is followed by , : } ] or the end of the text.
+    """
+    result = []
+    in_string = False
+    escape = False
+    for index, char in enumerate(text):
+        if not in_string:
+            in_string = char == '"'
+            result.append(char)
+            continue
+        if escape:
+            escape = False
+            result.append(char)
+        elif char == '\\':
+            escape = True
+            result.append(char)
+        elif char == '"':
+            if next_char(text, index + 1) in (',', ':', '}', ']', ''):
+                in_string = False
+                result.append(char)
+            else:
+                result.append('\\"')
+        elif char == '\n':
+            result.append('\\n')
+        elif char == '\r':
+            result.append('\\r')
+        elif char == '\t':
+            result.append('\\t')
+        else:
+            result.append(char)
+    return ''.join(result)
+
+def remove_trailing_commas(text: str) -> str:
+    """
+    Remove the commas before a closing } or ].
+    """
+    result = []
+    in_string = False
+    escape = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ',' and next_char(text, index + 1) in ('}', ']'):
+            continue
+        result.append(char)
+    return ''.join(result)
+
+def close_brackets(text: str) -> str:
+    """
+    Close the string, the objects and the lists left open at the end of a truncated response.
+    """
+    stack = []
+    in_string = False
+    escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+
+    if in_string:
+        text += '"'
+    if not stack:
+        return text
+    return text.rstrip().rstrip(',') + ''.join(reversed(stack))
+
+def wrap_list(text: str) -> str:
+    """
+    Wrap a bare list of prompts in the prompts object: [...] becomes {"prompts": [...]}.
+    """
+    try:
+        data = json.loads(text)
+    except json.decoder.JSONDecodeError:
+        return text
+    if isinstance(data, list):
+        return json.dumps({"prompts": data})
+    return text
+
+# Repairs, in the order they are applied
+REPAIRS: List[tuple[str, Callable[[str], str]]] = [
+    ("code_fences", strip_fences),
+    ("surrounding_text", strip_text),
+    ("unescaped_characters", escape_strings),
+    ("trailing_commas", remove_trailing_commas),
+    ("missing_brackets", close_brackets),
+    ("bare_list", wrap_list),
+]
+
+def repair_json(text: str) -> tuple[str, List[str]]:
+    """
+    Apply the local repairs to a malformed JSON response.
+
+    Args:
+        text (str): The content of the model response.
+
+    Returns:
+        tuple[str, List[str]]: The repaired text and the names of the repairs that changed it.
+    """
+    applied = []
+    for name, repair in REPAIRS:
+        repaired = repair(text)
+        if repaired != text:
+            applied.append(name)
+            text = repaired
+    return text, applied
+
+def record_repairs(repairs: List[str], success: bool) -> None:
+    """
+    Record the repairs of a response in repair_stats.
+
+    Args:
+        repairs (List[str]): The names of the repairs applied.
+        success (bool): Whether the repaired response was valid.
+    """
+    with repair_stats_lock:
+        if not success:
+            repair_stats["failed"] = repair_stats.get("failed", 0) + 1
+            return
+        repair_stats["repaired"] = repair_stats.get("repaired", 0) + 1
+        for name in repairs:
+            repair_stats[name] = repair_stats.get(name, 0) + 1
+
+def get_repair_stats() -> dict:
+    """
+    Get the repair statistics since the start.
+
+    Returns:
+        dict: The number of repaired responses (repaired), of responses the repairs could not fix (failed)
+            and the number of times each repair was needed.
+    """
+    with repair_stats_lock:
+        return dict(repair_stats)
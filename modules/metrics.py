@@ -0,0 +1,268 @@
+''' metrics.py
+
+This module exports the generation metrics of ISA in the OpenMetrics text format, to be scraped by Prometheus.
+The HTTP endpoint is optional, it is started with the ISA_METRICS_PORT environment variable.
+'''
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300]
+
+# A session is active if it had a rerun in this delay, in seconds
+SESSION_TIMEOUT = 300
+
+def escape(value: str) -> str:
+    """
+    Escape a label value.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: dict) -> str:
+    """
+    Format the labels of a sample, e.g. {mode="SDXL"}.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items())) + "}"
+
+def format_value(value: float) -> str:
+    """
+    Format the value of a sample.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    """
+    Base class of the metrics, values are stored per labels.
+    """
+    type = "unknown"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [
+                f"{self.name}{format_labels(dict(key))} {format_value(value)}"
+                for key, value in sorted(self.values.items())
+            ]
+
+    def expose(self) -> str:
+        lines = [f"# TYPE {self.name} {self.type}", f"# HELP {self.name} {self.help}"]
+        return "\n".join(lines + self.samples())
+
+class Counter(Metric):
+    """
+    Monotonic counter, exposed with the _total suffix.
+    """
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if amount <= 0:
+            return
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [
+                f"{self.name}_total{format_labels(dict(key))} {format_value(value)}"
+                for key, value in sorted(self.values.items())
+            ]
+
+class Gauge(Metric):
+    """
+    Value that can go up and down. The value can also be computed at scrape time with set_function.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.function = None
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.function = function
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            return [f"{self.name} {format_value(self.function())}"]
+        return super().samples()
+
+    def track(self, **labels) -> "GaugeTracker":
+        """
+        Increment the gauge while a block of code runs: with gauge.track(): ...
+        """
+        return GaugeTracker(self, labels)
+
+class GaugeTracker:
+    """
+    Context manager incrementing a gauge on enter and decrementing it on exit.
+    """
+
+    def __init__(self, gauge: Gauge, labels: dict) -> None:
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.gauge.inc(**self.labels)
+
+    def __exit__(self, *args) -> None:
+        self.gauge.dec(**self.labels)
+
+class Histogram(Metric):
+    """
+    Distribution of values in cumulative buckets, with the sum and the count.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: List[float]) -> None:
+        super().__init__(name, help)
+        self.buckets = sorted(buckets) + [float("inf")]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [count + 1 if value <= bound else count for count, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = dict(key)
+                for count, bound in zip(counts, self.buckets):
+                    lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {count}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+        return lines
+
+GENERATION_REQUESTS = Counter("isa_generation_requests", "Generation requests by prompt mode")
+GENERATION_LATENCY = Histogram("isa_generation_latency_seconds", "End-to-end latency of the generations, retries included", LATENCY_BUCKETS)
+VALIDATION_FAILURES = Counter("isa_validation_failures", "Responses failing the prompts validation")
+RETRIES = Counter("isa_retries", "Requests sent again to the model after a validation failure")
+VISION_REQUESTS = Counter("isa_vision_requests", "Image analysis requests to the vision model")
+TOKENS_GENERATED = Counter("isa_tokens_generated", "Tokens generated by the models")
+ACTIVE_SESSIONS = Gauge("isa_active_sessions", f"Streamlit sessions with an interaction in the last {SESSION_TIMEOUT} seconds")
+IN_FLIGHT = Gauge("isa_ollama_in_flight_requests", "Requests sent to Ollama and not completed yet")
+
+REGISTRY: List[Metric] = [
+    GENERATION_REQUESTS,
+    GENERATION_LATENCY,
+    VALIDATION_FAILURES,
+    RETRIES,
+    VISION_REQUESTS,
+    TOKENS_GENERATED,
+    ACTIVE_SESSIONS,
+    IN_FLIGHT,
+]
+
+# Last interaction of each session
+sessions = {}
+sessions_lock = threading.Lock()
+
+def touch_session(session_id: str) -> None:
+    """
+    Record an interaction of a session, for the active sessions gauge.
+
+    Args:
+        session_id (str): The id of the session.
+    """
+    with sessions_lock:
+        sessions[session_id] = time.time()
+
+def count_active_sessions() -> int:
+    """
+    Count the sessions with an interaction in the last SESSION_TIMEOUT seconds.
+    """
+    limit = time.time() - SESSION_TIMEOUT
+    with sessions_lock:
+        for session_id in [session_id for session_id, last in sessions.items() if last < limit]:
+            del sessions[session_id]
+        return len(sessions)
+
+ACTIVE_SESSIONS.set_function(count_active_sessions)
+IN_FLIGHT.set(0)
+
+def expose() -> str:
+    """
+    Get all the metrics in the OpenMetrics text format.
+
+    Returns:
+        str: The exposition, ending with # EOF.
+    """
+    return "\n".join(metric.expose() for metric in REGISTRY) + "\n# EOF\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics on /metrics.
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+server = None
+
+def start_server(port: int | None = None, host: str = "127.0.0.1") -> ThreadingHTTPServer | None:
+    """
+    Start the metrics endpoint in a background thread, once per process.
+
+    Args:
+        port (int, optional): The port. Defaults to the ISA_METRICS_PORT environment variable.
+        host (str, optional): The address to listen on. Defaults to localhost only.
+
+    Returns:
+        ThreadingHTTPServer | None: The server, None if no port is configured.
+    """
+    global server
+    if server is not None:
+        return server
+
+    port = port or int(os.environ.get('ISA_METRICS_PORT', 0))
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="isa-metrics").start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return server
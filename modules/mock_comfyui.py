@@ -0,0 +1,190 @@
+''' mock_comfyui.py
+
+This module contains a local stand-in for the ComfyUI HTTP server, used to test the submission of prompts.
+
+It answers /prompt, /queue and /history: the jobs are queued and "rendered" one at a time
+by a worker thread with a fixed delay. No image is generated.
+
+Example:
+    python -m modules.mock_comfyui --port 8189 --render-delay 2
+    python comfyui.py --url http://127.0.0.1:8189 -n 20
+'''
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockComfyUIServer:
+    """
+    ComfyUI server running in a background thread.
+
+    The jobs received are kept in self.jobs with their submission and completion times,
+    and the maximum depth of the queue is tracked in self.max_depth.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, render_delay: float = 0.5) -> None:
+        """
+        Args:
+            host (str, optional): The address to listen on. Defaults to localhost only.
+            port (int, optional): The port, 0 for a free port. Defaults to 0.
+            render_delay (float, optional): The time to render a job, in seconds. Defaults to 0.5.
+        """
+        self.render_delay = render_delay
+        self.pending = deque()
+        self.running = None
+        self.jobs = {}
+        self.max_depth = 0
+        self.number = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+        self.server = ThreadingHTTPServer((host, port), MockComfyUIHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.threads = []
+
+    @property
+    def url(self) -> str:
+        """
+        The URL of the server.
+        """
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockComfyUIServer":
+        """
+        Start the server and the worker in daemon threads.
+        """
+        self.threads = [
+            threading.Thread(target=self.server.serve_forever, daemon=True, name="mock-comfyui"),
+            threading.Thread(target=self.work, daemon=True, name="mock-comfyui-worker"),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop the server and the worker.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "MockComfyUIServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def depth(self) -> int:
+        """
+        Get the number of jobs running or pending.
+        """
+        return len(self.pending) + (self.running is not None)
+
+    def queue(self, workflow: dict) -> dict:
+        """
+        Add a job to the queue.
+
+        Returns:
+            dict: The response of /prompt.
+        """
+        with self.lock:
+            prompt_id = str(uuid.uuid4())
+            self.number += 1
+            self.jobs[prompt_id] = {"prompt": workflow, "number": self.number, "submitted": time.perf_counter(), "completed": None}
+            self.pending.append(prompt_id)
+            self.max_depth = max(self.max_depth, self.depth())
+        self.wakeup.set()
+        return {"prompt_id": prompt_id, "number": self.number, "node_errors": {}}
+
+    def work(self) -> None:
+        """
+        Render the jobs one at a time.
+        """
+        while not self.stopped.is_set():
+            with self.lock:
+                if self.pending:
+                    self.running = self.pending.popleft()
+                else:
+                    self.wakeup.clear()
+            if self.running is None:
+                self.wakeup.wait()
+                continue
+            time.sleep(self.render_delay)
+            with self.lock:
+                self.jobs[self.running]["completed"] = time.perf_counter()
+                self.running = None
+
+class MockComfyUIHandler(BaseHTTPRequestHandler):
+    """
+    Serve the ComfyUI API of a MockComfyUIServer (self.server.mock).
+    """
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        mock = self.server.mock
+        path = self.path.split('?')[0]
+        if path == '/queue':
+            with mock.lock:
+                running = [mock.running] if mock.running is not None else []
+                pending = list(mock.pending)
+            self.send_json({
+                "queue_running": [[mock.jobs[id]["number"], id] for id in running],
+                "queue_pending": [[mock.jobs[id]["number"], id] for id in pending],
+            })
+        elif path.startswith('/history'):
+            with mock.lock:
+                done = {id: {"status": {"completed": True}} for id, job in mock.jobs.items() if job["completed"] is not None}
+            prompt_id = path[len('/history/'):]
+            self.send_json({prompt_id: done[prompt_id]} if prompt_id in done else ({} if prompt_id else done))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self) -> None:
+        path = self.path.split('?')[0]
+        if path != '/prompt':
+            self.send_json({"error": "not found"}, 404)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        workflow = body.get('prompt')
+        if not isinstance(workflow, dict) or not workflow:
+            self.send_json({"error": {"type": "invalid_prompt", "message": "Invalid prompt"}}, 400)
+            return
+        self.send_json(self.server.mock.queue(workflow))
+
+def main() -> None:
+    '''Run the mock server until interrupted.'''
+    parser = argparse.ArgumentParser(description="Local stand-in for the ComfyUI server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8189, help="Port (default: 8189)")
+    parser.add_argument("--render-delay", type=float, default=0.5, help="Time to render a job, in seconds (default: 0.5)")
+    args = parser.parse_args()
+
+    mock = MockComfyUIServer(host=args.host, port=args.port, render_delay=args.render_delay).start()
+    print(f"Mock ComfyUI listening on {mock.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,494 @@
+''' mock_ollama.py
+
+This module contains a local stand-in for the Ollama HTTP server, used by the benchmarks.
+
+It answers /api/chat, /api/generate, /api/tags, /api/ps, /api/show and /api/version, streamed or not,
+with a simulated model load, prompt evaluation and token rate, and can inject malformed JSON responses.
+No model runs: the prompts returned are built from the request.
+
+Example:
+    python -m modules.mock_ollama --port 11435 --token-rate 30 --malformed-rate 0.2
+    OLLAMA_HOST=http://127.0.0.1:11435 streamlit run app.py
+'''
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List
+
+# Models listed by /api/tags, one text model and one vision model
+DEFAULT_MODELS = ["llama3.2:latest", "llava:latest"]
+
+# Malformations injected in the JSON responses
+MALFORMATIONS = ["code_fences", "trailing_comma", "truncated", "text"]
+
+PATTERN_COUNT = re.compile(r'\b(\d+)\s+prompts?\b', re.IGNORECASE)
+PATTERN_TOKEN = re.compile(r'\S+\s*|\s+')
+
+VERSION = "0.0.0-mock"
+
+class MockOllamaServer:
+    """
+    Scriptable Ollama server running in a background thread.
+
+    The behavior can be changed between requests by setting the attributes.
+    Each request is logged in self.requests with its timings, measured with time.perf_counter().
+    """
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            models: List[str] | None = None,
+            token_rate: float = 100.0,
+            prompt_rate: float = 2000.0,
+            load_delay: float = 0.0,
+            malformed_rate: float = 0.0,
+            malformations: List[str] | None = None,
+            seed: int = 0
+        ) -> None:
+        """
+        Args:
+            host (str, optional): The address to listen on. Defaults to localhost only.
+            port (int, optional): The port, 0 for a free port. Defaults to 0.
+            models (List[str], optional): The models installed. Defaults to DEFAULT_MODELS.
+            token_rate (float, optional): The generated tokens per second. Defaults to 100.
+            prompt_rate (float, optional): The prompt tokens evaluated per second. Defaults to 2000.
+            load_delay (float, optional): The time to load a model not in memory, in seconds. Defaults to 0.
+            malformed_rate (float, optional): The probability of a malformed JSON response. Defaults to 0.
+            malformations (List[str], optional): The malformations injected. Defaults to MALFORMATIONS.
+            seed (int, optional): The seed of the malformed responses. Defaults to 0.
+        """
+        self.models = models or list(DEFAULT_MODELS)
+        self.token_rate = token_rate
+        self.prompt_rate = prompt_rate
+        self.load_delay = load_delay
+        self.malformed_rate = malformed_rate
+        self.malformations = malformations or list(MALFORMATIONS)
+        self.random = random.Random(seed)
+        self.loaded = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), MockOllamaHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        The URL of the server, to use as OLLAMA_HOST.
+        """
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockOllamaServer":
+        """
+        Start the server in a daemon thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name="mock-ollama")
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop the server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "MockOllamaServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def reset(self) -> None:
+        """
+        Clear the request log and unload the models.
+        """
+        with self.lock:
+            self.requests = []
+            self.loaded = {}
+
+    def find_model(self, name: str) -> str | None:
+        """
+        Get the installed model matching a name, with or without the ":latest" tag.
+        """
+        for model in self.models:
+            if model == name or model == f"{name}:latest":
+                return model
+        return None
+
+    def load(self, model: str) -> float:
+        """
+        Load a model if needed.
+
+        Returns:
+            float: The load duration, in seconds.
+        """
+        with self.lock:
+            loaded = model in self.loaded
+            self.loaded[model] = time.time()
+        if loaded:
+            return 0.0
+        time.sleep(self.load_delay)
+        return self.load_delay
+
+    def unload(self, model: str) -> None:
+        with self.lock:
+            self.loaded.pop(model, None)
+
+    def malformation(self) -> str | None:
+        """
+        Draw the malformation of a JSON response, None for a valid response.
+        """
+        with self.lock:
+            if self.random.random() >= self.malformed_rate:
+                return None
+            return self.random.choice(self.malformations)
+
+    def log(self, record: dict) -> None:
+        with self.lock:
+            self.requests.append(record)
+
+def digest(model: str) -> str:
+    """
+    Get a stable fake digest of a model.
+    """
+    return hashlib.sha256(model.encode('utf-8')).hexdigest()
+
+def details(model: str) -> dict:
+    return {
+        "parent_model": "",
+        "format": "gguf",
+        "family": model.split(':')[0],
+        "families": [model.split(':')[0]],
+        "parameter_size": "3B",
+        "quantization_level": "Q4_K_M",
+    }
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text, 4 characters per token.
+    """
+    return max(1, len(text) // 4)
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a response into the tokens streamed, one word with its trailing spaces per token.
+    """
+    return PATTERN_TOKEN.findall(text) or [text]
+
+def wants_json(body: dict, system: str) -> bool:
+    """
+    Whether the request expects a JSON list of prompts: a format is requested,
+    the prompt system asks for JSON or there is no prompt system (fine-tuned model).
+    """
+    return bool(body.get('format')) or 'json' in system.lower() or not system.strip()
+
+def wants_negative(body: dict, system: str) -> bool:
+    """
+    Whether the prompts have a negative prompt (SDXL) or not (Flux).
+    """
+    if isinstance(body.get('format'), dict):
+        return 'negative' in json.dumps(body['format'])
+    return 'negative' in system or not system.strip()
+
+def build_prompts(request: str, negative: bool) -> str:
+    """
+    Build a valid JSON list of prompts for a request such as "Create 3 prompts about: a cat".
+    """
+    match = PATTERN_COUNT.search(request)
+    count = int(match.group(1)) if match else 1
+    subject = request.split(':', 1)[-1].strip() or "a landscape"
+    prompts = []
+    for index in range(count):
+        prompt = {
+            "positive": f"{subject}, variation {index + 1}, cinematic lighting, highly detailed, sharp focus, "
+                        f"rich colors, professional photography, 8k"
+        }
+        if negative:
+            prompt["negative"] = "blurry, low quality, distorted, watermark, text"
+        prompts.append(prompt)
+    return json.dumps({"prompts": prompts}, indent=2)
+
+def malform(content: str, malformation: str) -> str:
+    """
+    Break a JSON response the way the models do.
+    """
+    if malformation == "code_fences":
+        return f"Here are your prompts:\n```json\n{content}\n```"
+    if malformation == "trailing_comma":
+        return content.replace('    }\n  ]', '    },\n  ]')
+    if malformation == "truncated":
+        return content[:len(content) * 2 // 3]
+    return "I'm sorry, I can only describe the scene: a quiet landscape at dawn."
+
+def build_response(body: dict, mock: MockOllamaServer, chat: bool) -> tuple[str, str | None]:
+    """
+    Build the content of a response.
+
+    Returns:
+        tuple[str, str | None]: The content and the malformation injected, if any.
+    """
+    if chat:
+        messages = body.get('messages') or []
+        system = next((message.get('content', '') for message in messages if message.get('role') == 'system'), '')
+        request = next((message.get('content', '') for message in reversed(messages) if message.get('role') == 'user'), '')
+    else:
+        system = body.get('system') or ''
+        request = body.get('prompt') or ''
+
+    if body.get('images'):
+        return "Subject: a figure in a landscape. Style: oil painting, soft light, muted colors. " \
+               "Description: a lone figure walking along a river at dusk.", None
+
+    if not chat or not wants_json(body, system):
+        return f"Here is an idea for {request.strip()[:80] or 'your image'}: a wide shot at golden hour, " \
+               "with soft shadows, warm tones and a shallow depth of field.", None
+
+    content = build_prompts(request, wants_negative(body, system))
+    malformation = mock.malformation()
+    if malformation is not None:
+        content = malform(content, malformation)
+    return content, malformation
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Serve the Ollama API of a MockOllamaServer (self.server.mock).
+    """
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        mock = self.server.mock
+        path = self.path.split('?')[0]
+        if path == '/':
+            body = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/api/version':
+            self.send_json({"version": VERSION})
+        elif path == '/api/tags':
+            self.send_json({"models": [
+                {
+                    "name": model,
+                    "model": model,
+                    "modified_at": now(),
+                    "size": 2_000_000_000,
+                    "digest": digest(model),
+                    "details": details(model),
+                }
+                for model in mock.models
+            ]})
+        elif path == '/api/ps':
+            with mock.lock:
+                loaded = list(mock.loaded.items())
+            self.send_json({"models": [
+                {
+                    "name": model,
+                    "model": model,
+                    "size": 2_000_000_000,
+                    "digest": digest(model),
+                    "details": details(model),
+                    "expires_at": datetime.fromtimestamp(last + 300, timezone.utc).isoformat(),
+                    "size_vram": 2_000_000_000,
+                }
+                for model, last in loaded
+            ]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self) -> None:
+        path = self.path.split('?')[0]
+        try:
+            body = self.read_json()
+        except json.decoder.JSONDecodeError:
+            self.send_json({"error": "invalid JSON body"}, 400)
+            return
+
+        if path == '/api/show':
+            model = self.server.mock.find_model(body.get('model') or body.get('name') or '')
+            if model is None:
+                self.send_json({"error": "model not found"}, 404)
+                return
+            self.send_json({"modelfile": "", "parameters": "", "template": "", "details": details(model),
+                            "model_info": {}, "capabilities": ["completion"]})
+        elif path in ('/api/chat', '/api/generate'):
+            self.generate(body, chat=path == '/api/chat')
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def generate(self, body: dict, chat: bool) -> None:
+        """
+        Answer a chat or generate request, streamed by default like Ollama.
+        """
+        mock = self.server.mock
+        start = time.perf_counter()
+        name = body.get('model') or ''
+        model = mock.find_model(name)
+        if model is None:
+            self.send_json({"error": f"model '{name}' not found"}, 404)
+            return
+
+        # Request without messages or prompt: load or unload the model only
+        if not (body.get('messages') if chat else body.get('prompt')):
+            if body.get('keep_alive') == 0:
+                mock.unload(model)
+                done_reason = "unload"
+            else:
+                mock.load(model)
+                done_reason = "load"
+            self.send_json(self.chunk(name, "", chat, done=True) | {"done_reason": done_reason})
+            return
+
+        load_duration = mock.load(model)
+        content, malformation = build_response(body, mock, chat)
+
+        if chat:
+            prompt = "".join(message.get('content', '') for message in body.get('messages') or [])
+        else:
+            prompt = (body.get('system') or '') + (body.get('prompt') or '')
+        prompt_tokens = count_tokens(prompt)
+        prompt_duration = prompt_tokens / mock.prompt_rate
+        time.sleep(prompt_duration)
+
+        tokens = tokenize(content)
+        stream = body.get('stream', True)
+        record = {
+            "path": "/api/chat" if chat else "/api/generate",
+            "model": name,
+            "stream": stream,
+            "start": start,
+            "first_token": None,
+            "end": None,
+            "prompt_tokens": prompt_tokens,
+            "eval_count": len(tokens),
+            "load_duration": load_duration,
+            "malformation": malformation,
+        }
+
+        if stream:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for token in tokens:
+                time.sleep(1 / mock.token_rate)
+                if record["first_token"] is None:
+                    record["first_token"] = time.perf_counter()
+                self.write_line(self.chunk(name, token, chat))
+        else:
+            time.sleep(len(tokens) / mock.token_rate)
+            record["first_token"] = time.perf_counter()
+
+        total = time.perf_counter() - start
+        final = self.chunk(name, "" if stream else content, chat, done=True) | {
+            "done_reason": "stop",
+            "total_duration": int(total * 1e9),
+            "load_duration": int(load_duration * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_duration * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int(len(tokens) / mock.token_rate * 1e9),
+        }
+        if stream:
+            self.write_line(final)
+        else:
+            self.send_json(final)
+
+        if body.get('keep_alive') == 0:
+            mock.unload(model)
+        record["end"] = time.perf_counter()
+        mock.log(record)
+
+    def chunk(self, model: str, content: str, chat: bool, done: bool = False) -> dict:
+        chunk = {"model": model, "created_at": now(), "done": done}
+        if chat:
+            chunk["message"] = {"role": "assistant", "content": content}
+        else:
+            chunk["response"] = content
+        return chunk
+
+    def write_line(self, data: dict) -> None:
+        self.wfile.write((json.dumps(data) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+def iter_requests(mock: MockOllamaServer, since: float, path: str | None = None) -> Iterator[dict]:
+    """
+    Iterate over the requests logged after a time.perf_counter() value.
+
+    Args:
+        mock (MockOllamaServer): The server.
+        since (float): The start of the measure.
+        path (str, optional): Only the requests of an endpoint, e.g. "/api/chat". Defaults to all.
+    """
+    with mock.lock:
+        records = list(mock.requests)
+    for record in records:
+        if record["start"] >= since and (path is None or record["path"] == path):
+            yield record
+
+def main() -> None:
+    '''Run the mock server until interrupted.'''
+    parser = argparse.ArgumentParser(description="Local stand-in for the Ollama server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=11435, help="Port (default: 11435)")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS, help="Models listed by /api/tags")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="Generated tokens per second (default: 100)")
+    parser.add_argument("--prompt-rate", type=float, default=2000.0, help="Prompt tokens evaluated per second (default: 2000)")
+    parser.add_argument("--load-delay", type=float, default=0.0, help="Model load time in seconds (default: 0)")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Probability of a malformed JSON response (default: 0)")
+    parser.add_argument("--malformations", nargs="+", choices=MALFORMATIONS, default=MALFORMATIONS, help="Malformations injected")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the malformed responses (default: 0)")
+    args = parser.parse_args()
+
+    mock = MockOllamaServer(
+        host=args.host,
+        port=args.port,
+        models=args.models,
+        token_rate=args.token_rate,
+        prompt_rate=args.prompt_rate,
+        load_delay=args.load_delay,
+        malformed_rate=args.malformed_rate,
+        malformations=args.malformations,
+        seed=args.seed
+    )
+    print(f"Mock Ollama listening on {mock.url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+''' pipeline.py
+
+This module contains a two-stage pipeline: the first stage (vision) runs in a background thread and feeds the second stage (text) through a bounded queue.
+'''
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+# End of the items of the first stage
+DONE = object()
+
+class Pipeline:
+    """
+    Run two stages on a list of items, the first stage working on item k+1 while the second stage works on item k.
+
+    The queue between the stages is bounded, so the first stage does not run far ahead
+    of the second one (e.g. descriptions of images computed but not used yet).
+    The time each stage is busy is measured to report its utilization.
+    """
+
+    def __init__(
+            self,
+            first: Callable[[Any], Any],
+            second: Callable[[Any, Any], Any],
+            maxsize: int = 1,
+            names: tuple[str, str] = ("vision", "text")
+        ) -> None:
+        """
+        Args:
+            first (Callable[[Any], Any]): The first stage, called with an item in the background thread.
+            second (Callable[[Any, Any], Any]): The second stage, called with the item and the result of the first stage in the calling thread.
+            maxsize (int, optional): The number of results of the first stage waiting for the second stage. Defaults to 1.
+            names (tuple[str, str], optional): The names of the stages in the statistics. Defaults to ("vision", "text").
+        """
+        self.first = first
+        self.second = second
+        self.maxsize = maxsize
+        self.names = names
+        self.busy = {name: 0.0 for name in names}
+        self.elapsed = 0.0
+        self.count = 0
+
+    def produce(self, items: Iterable, results: queue.Queue, stop: threading.Event) -> None:
+        """
+        Run the first stage on each item and put (item, result, error) in the queue.
+        """
+        for item in items:
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                result, error = self.first(item), None
+            except Exception as e:
+                result, error = None, e
+            self.busy[self.names[0]] += time.perf_counter() - start
+            if not self.put(results, (item, result, error), stop):
+                return
+        self.put(results, DONE, stop)
+
+    def put(self, results: queue.Queue, entry: Any, stop: threading.Event) -> bool:
+        """
+        Put an entry in the queue, waiting for a free slot until the consumer stops.
+
+        Returns:
+            bool: True if the entry was put, False if the consumer stopped.
+        """
+        while not stop.is_set():
+            try:
+                results.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self, items: Iterable) -> Iterator[tuple[Any, Any, Exception | None]]:
+        """
+        Run the pipeline.
+
+        Args:
+            items (Iterable): The items.
+
+        Yields:
+            tuple[Any, Any, Exception | None]: The item, the result of the second stage and the error
+                raised by one of the stages (the result is None in this case), in the order of the items.
+        """
+        results = queue.Queue(maxsize=self.maxsize)
+        stop = threading.Event()
+        start = time.perf_counter()
+        thread = threading.Thread(target=self.produce, args=[items, results, stop], daemon=True, name="pipeline")
+        thread.start()
+        try:
+            while True:
+                entry = results.get()
+                if entry is DONE:
+                    break
+                item, result, error = entry
+                output = None
+                if error is None:
+                    stage_start = time.perf_counter()
+                    try:
+                        output = self.second(item, result)
+                    except Exception as e:
+                        error = e
+                    self.busy[self.names[1]] += time.perf_counter() - stage_start
+                self.count += 1
+                self.elapsed = time.perf_counter() - start
+                yield item, output, error
+        finally:
+            stop.set()
+            self.elapsed = time.perf_counter() - start
+
+    def utilization(self) -> dict:
+        """
+        Get the part of the time each stage was busy.
+
+        Returns:
+            dict: The utilization of each stage, from 0 to 1.
+        """
+        if not self.elapsed:
+            return {name: 0.0 for name in self.names}
+        return {name: min(1.0, busy / self.elapsed) for name, busy in self.busy.items()}
+
+    def summary(self) -> str:
+        """
+        Describe the run, e.g. "4 items in 12.3s, vision busy 45%, text busy 92%".
+        """
+        stages = ", ".join(f"{name} busy {value:.0%}" for name, value in self.utilization().items())
+        return f"{self.count} items in {self.elapsed:.1f}s, {stages}"
@@ -0,0 +1,123 @@
+''' residency.py
+
+This module contains the residency policies of the vision model: how long Ollama keeps it in memory after an image analysis,
+and the LLM with the keep_both policy.
+'''
+from typing import List
+
+import ollama
+
+# Residency policies of the vision model
+RESIDENCY_POLICIES = {
+    "unload": "Unload after use",
+    "keep_hot": "Keep hot",
+    "keep_both": "Keep both models",
+    "memory_pressure": "Unload on memory pressure",
+}
+
+# Default time the vision model is kept in memory with the keep_hot policy, in minutes
+KEEP_HOT_MINUTES = 10
+
+def get_keep_alive(policy: str, minutes: int = KEEP_HOT_MINUTES, pressure: bool = False) -> int | str:
+    """
+    Get the keep_alive of the vision requests.
+
+    Args:
+        policy (str): The residency policy, a key of RESIDENCY_POLICIES.
+        minutes (int, optional): The time the model is kept with the keep_hot and memory_pressure policies. Defaults to KEEP_HOT_MINUTES.
+        pressure (bool, optional): Whether the models already do not fit in the GPU memory, see get_memory_pressure. Defaults to False.
+
+    Returns:
+        int | str: 0 to unload the model after the request, a duration like "10m", or -1 to keep it loaded.
+    """
+    if policy == "keep_hot" or (policy == "memory_pressure" and not pressure):
+        return f"{max(1, minutes)}m"
+    if policy == "keep_both":
+        return -1
+    return 0
+
+def get_text_keep_alive(policy: str) -> int | None:
+    """
+    Get the keep_alive of the LLM requests.
+
+    Returns:
+        int | None: -1 to keep the LLM loaded with the keep_both policy, None for the default of Ollama (5 minutes).
+    """
+    return -1 if policy == "keep_both" else None
+
+def is_loaded(model: str, models: List[dict]) -> bool:
+    """
+    Check if a model is in the models loaded by Ollama, with or without the ":latest" tag.
+    """
+    name = model if ':' in model else f"{model}:latest"
+    return any(loaded.get('model') in (model, name) for loaded in models)
+
+def get_memory_pressure(client: ollama.Client | None = None, max_vram: float = 0, models: List[dict] | None = None) -> List[str]:
+    """
+    Detect the memory pressure from the models loaded in Ollama (/api/ps).
+
+    A model partly loaded in the system memory (size_vram lower than size) means the GPU
+    memory is full. With max_vram, the total memory of the loaded models is also checked.
+
+    Args:
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        max_vram (float, optional): The GPU memory available to the models in GB, 0 for no limit. Defaults to 0.
+        models (List[dict], optional): The models of /api/ps, read if None. Defaults to None.
+
+    Returns:
+        List[str]: The reasons of the memory pressure, empty if there is none.
+    """
+    if models is None:
+        models = (client or ollama).ps()['models']
+    reasons = [
+        f"{model['model']} is {1 - model['size_vram'] / model['size']:.0%} in system memory"
+        for model in models
+        if model.get('size') and model.get('size_vram') is not None and model['size_vram'] < model['size']
+    ]
+    total = sum(model.get('size_vram') or 0 for model in models) / 1024 ** 3
+    if max_vram and total > max_vram:
+        reasons.append(f"the models use {total:.1f} GB of GPU memory, more than {max_vram} GB")
+    return reasons
+
+def apply_policy(policy: str, model: str, client: ollama.Client | None = None, max_vram: float = 0) -> str | None:
+    """
+    Apply the residency policy after a vision request or a generation of the LLM.
+
+    With the memory_pressure policy, the vision model is unloaded when it is loaded
+    and Ollama reports memory pressure, e.g. once the LLM is loaded next to it.
+
+    Args:
+        policy (str): The residency policy, a key of RESIDENCY_POLICIES.
+        model (str): The vision model.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+        max_vram (float, optional): The GPU memory available to the models in GB, 0 for no limit. Defaults to 0.
+
+    Returns:
+        str | None: The reason why the model was unloaded, None if it is kept.
+    """
+    if policy != "memory_pressure":
+        return None
+    client = client or ollama
+    try:
+        models = client.ps()['models']
+    except (ollama.ResponseError, ConnectionError) as e:
+        print(f"Error when reading the loaded models: {e}")
+        return None
+    if not is_loaded(model, models):
+        return None
+    reasons = get_memory_pressure(client, max_vram, models)
+    if not reasons:
+        return None
+    unload(model, client)
+    return "; ".join(reasons)
+
+def unload(model: str, client: ollama.Client | None = None) -> None:
+    """
+    Unload a model from the memory.
+
+    Args:
+        model (str): The model.
+        client (ollama.Client, optional): The ollama client. Defaults to the ollama module.
+    """
+    client = client or ollama
+    client.generate(model, keep_alive=0)
@@ -0,0 +1,41 @@
+''' schemas.py
+
+This module contains the Pydantic models used to validate the prompts generated by ISA.
+'''
+from typing import List
+from pydantic import BaseModel, Field
+
+# Prompt modes available in ISA
+PROMPT_MODES = ["None", "SDXL", "Flux", "Flux2", "Sequential"]
+
+# Prompt modes answering with a JSON list of prompts
+STRUCTURED_MODES = ["SDXL", "Flux", "Flux2"]
+
+# create class to strore prompts
+class Prompt(BaseModel):
+    positive: str = Field(..., description="Positive prompt to generate image from query")
+    negative: str = Field(..., description="Negative prompt to generate image from query")
+
+class PromptsList(BaseModel):
+    prompts: List[Prompt] = Field(..., description="List of prompts")
+
+
+class PromptFlux(BaseModel):
+    positive: str = Field(..., description="Positive prompt to generate image from query")
+
+class PromptsFluxList(BaseModel):
+    prompts: List[PromptFlux] = Field(..., description="List of prompts")
+
+def get_prompts_class(prompt_mode: str) -> type[BaseModel]:
+    """
+    Get the Pydantic class used to validate the prompts of a mode.
+
+    Args:
+        prompt_mode (str): The prompt mode (SDXL, Flux or Flux2).
+
+    Returns:
+        type[BaseModel]: PromptsList for SDXL, PromptsFluxList for Flux and Flux2.
+    """
+    if prompt_mode == 'SDXL':
+        return PromptsList
+    return PromptsFluxList
@@ -0,0 +1,275 @@
+''' store.py
+
+This module contains the store of the saved prompts: a SQLite file in WAL mode with one row per prompt and its metadata.
+'''
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, List
+
+# Separator of the prompts in prompts_backup.txt
+BACKUP_SEPARATOR = '-' * 20
+
+COLUMNS = ('id', 'created', 'request', 'model', 'mode', 'seed', 'temperature', 'position', 'positive', 'negative', 'source')
+
+# Full-text index of the prompts, kept up to date by triggers on the prompts table
+FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE prompts_fts USING fts5("
+    "positive, negative, request, content='prompts', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS prompts_fts_insert AFTER INSERT ON prompts BEGIN "
+    "INSERT INTO prompts_fts (rowid, positive, negative, request) VALUES (new.id, new.positive, new.negative, new.request); END",
+    "CREATE TRIGGER IF NOT EXISTS prompts_fts_delete AFTER DELETE ON prompts BEGIN "
+    "INSERT INTO prompts_fts (prompts_fts, rowid, positive, negative, request) VALUES ('delete', old.id, old.positive, old.negative, old.request); END",
+    "CREATE TRIGGER IF NOT EXISTS prompts_fts_update AFTER UPDATE ON prompts BEGIN "
+    "INSERT INTO prompts_fts (prompts_fts, rowid, positive, negative, request) VALUES ('delete', old.id, old.positive, old.negative, old.request); "
+    "INSERT INTO prompts_fts (rowid, positive, negative, request) VALUES (new.id, new.positive, new.negative, new.request); END",
+)
+
+class PromptStore:
+    """
+    Saved prompts with the request, model, mode, seed and temperature they were generated with.
+
+    The file is in WAL mode, so the app, the command line tools and a reader
+    (e.g. an export during a save) do not block each other.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): The path of the SQLite file, the folder is created if needed.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, request TEXT NOT NULL DEFAULT '', "
+                "model TEXT NOT NULL DEFAULT '', mode TEXT NOT NULL DEFAULT '', seed INTEGER, temperature REAL, "
+                "position INTEGER NOT NULL DEFAULT 0, positive TEXT NOT NULL, negative TEXT, "
+                "source TEXT NOT NULL DEFAULT 'app')"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS prompts_model ON prompts (model)")
+            connection.execute("CREATE INDEX IF NOT EXISTS prompts_mode ON prompts (mode)")
+            connection.execute("CREATE INDEX IF NOT EXISTS prompts_created ON prompts (created)")
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'prompts_fts'").fetchone() is None:
+                for statement in FTS_SCHEMA:
+                    connection.execute(statement)
+                # Index the prompts saved before the full-text search
+                connection.execute("INSERT INTO prompts_fts (prompts_fts) VALUES ('rebuild')")
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a connection, one per operation so the store can be used from several threads.
+
+        The operation is committed (or rolled back on error) and the connection is closed at the end of the block.
+        """
+        with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as connection, connection:
+            connection.execute("PRAGMA synchronous=NORMAL")
+            yield connection
+
+    def add(
+            self,
+            prompts: List[dict],
+            request: str = '',
+            model: str = '',
+            mode: str = '',
+            seed: int | None = None,
+            temperature: float | None = None,
+            created: float | None = None,
+            source: str = 'app'
+        ) -> List[int]:
+        """
+        Save the prompts of a response.
+
+        Args:
+            prompts (List[dict]): The prompts, with a positive and, except for Flux, a negative.
+            request (str, optional): The user request. Defaults to ''.
+            model (str, optional): The name of the LLM model. Defaults to ''.
+            mode (str, optional): The prompt mode. Defaults to ''.
+            seed (int, optional): The seed of the generation. Defaults to None.
+            temperature (float, optional): The temperature of the generation. Defaults to None.
+            created (float, optional): The timestamp of the prompts. Defaults to now.
+            source (str, optional): Where the prompts come from, e.g. app or backup. Defaults to 'app'.
+
+        Returns:
+            List[int]: The ids of the prompts, in order.
+        """
+        created = time.time() if created is None else created
+        ids = []
+        with self.lock, self.connect() as connection:
+            for position, prompt in enumerate(prompts):
+                cursor = connection.execute(
+                    "INSERT INTO prompts (created, request, model, mode, seed, temperature, position, positive, negative, source) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (created, request, model, mode, seed, temperature, position, prompt['positive'], prompt.get('negative'), source)
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def get(self, ids: Iterable[int]) -> List[dict]:
+        """
+        Get prompts by id.
+
+        Args:
+            ids (Iterable[int]): The ids.
+
+        Returns:
+            List[dict]: The prompts found, in the order of the ids.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        with self.connect() as connection:
+            rows = connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM prompts WHERE id IN ({', '.join('?' * len(ids))})", ids
+            ).fetchall()
+        found = {row[0]: dict(zip(COLUMNS, row)) for row in rows}
+        return [found[id] for id in ids if id in found]
+
+    def query(
+            self,
+            model: str | None = None,
+            mode: str | None = None,
+            since: float | None = None,
+            until: float | None = None,
+            limit: int | None = None
+        ) -> List[dict]:
+        """
+        Get the prompts matching the filters, oldest first.
+
+        Args:
+            model (str, optional): The name of the LLM model. Defaults to None (all models).
+            mode (str, optional): The prompt mode. Defaults to None (all modes).
+            since (float, optional): The first timestamp. Defaults to None.
+            until (float, optional): The timestamp after the last prompt. Defaults to None.
+            limit (int, optional): The maximum number of prompts, the most recent ones are kept. Defaults to None (no limit).
+
+        Returns:
+            List[dict]: The prompts.
+        """
+        conditions, parameters = [], []
+        for condition, value in (("model = ?", model), ("mode = ?", mode), ("created >= ?", since), ("created < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        sql = f"SELECT {', '.join(COLUMNS)} FROM prompts {where} ORDER BY created DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        with self.connect() as connection:
+            rows = connection.execute(sql, parameters).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in reversed(rows)]
+
+    def search(self, text: str, limit: int = 20) -> List[dict]:
+        """
+        Search the prompts and their requests, best matches first.
+
+        Each word of the text must match (the last one as a prefix, so the results
+        follow the typing), e.g. "steampunk airsh" finds "a steampunk city with airships".
+
+        Args:
+            text (str): The words to search.
+            limit (int, optional): The maximum number of prompts. Defaults to 20.
+
+        Returns:
+            List[dict]: The prompts found.
+        """
+        query = get_fts_query(text)
+        if not query:
+            return []
+        columns = ', '.join(f"prompts.{column}" for column in COLUMNS)
+        with self.connect() as connection:
+            rows = connection.execute(
+                f"SELECT {columns} FROM prompts_fts JOIN prompts ON prompts.id = prompts_fts.rowid "
+                "WHERE prompts_fts MATCH ? ORDER BY bm25(prompts_fts, 1.0, 0.5, 0.5) LIMIT ?",
+                (query, limit)
+            ).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def count(self) -> int:
+        """
+        Get the number of prompts.
+        """
+        with self.connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+    def import_backup(self, path: str) -> int:
+        """
+        Import a prompts_backup.txt file.
+
+        The file has no metadata: each prompt is its positive line, followed by its negative
+        line except for Flux, and a separator line. The prompts already imported are skipped,
+        so a file can be imported again after new prompts were appended to it.
+
+        Args:
+            path (str): The path of the backup file.
+
+        Returns:
+            int: The number of prompts imported.
+        """
+        created = os.path.getmtime(path)
+        with open(path, encoding='utf-8') as f:
+            prompts = parse_backup(f)
+
+        count = 0
+        with self.lock, self.connect() as connection:
+            imported = {
+                (positive, negative) for positive, negative in connection.execute(
+                    "SELECT positive, negative FROM prompts WHERE source = 'backup'"
+                )
+            }
+            for position, prompt in enumerate(prompts):
+                key = (prompt['positive'], prompt.get('negative'))
+                if key in imported:
+                    continue
+                imported.add(key)
+                connection.execute(
+                    "INSERT INTO prompts (created, mode, position, positive, negative, source) VALUES (?, ?, ?, ?, ?, 'backup')",
+                    (created, "SDXL" if prompt.get('negative') is not None else "Flux", position, *key)
+                )
+                count += 1
+        return count
+
+def parse_backup(lines: Iterable[str]) -> List[dict]:
+    """
+    Parse the lines of a prompts_backup.txt file.
+
+    Returns:
+        List[dict]: The prompts, with a positive and, if the block has two lines, a negative.
+    """
+    prompts, block = [], []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == BACKUP_SEPARATOR:
+            if block:
+                prompt = {'positive': block[0]}
+                if len(block) > 1:
+                    prompt['negative'] = block[1]
+                prompts.append(prompt)
+            block = []
+        elif line.strip():
+            block.append(line)
+    return prompts
+
+def get_fts_query(text: str) -> str:
+    """
+    Turn the text typed by the user into a FTS5 query, the FTS5 syntax characters are ignored.
+
+    Returns:
+        str: The words quoted, the last one as a prefix, e.g. '"steampunk" "airsh"*'.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    return " ".join(f'"{word}"' for word in words) + ("*" if text[-1:].isalnum() else "")
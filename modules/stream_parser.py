@@ -0,0 +1,67 @@
+''' stream_parser.py
+
+This module contains an incremental JSON parser used to display the prompts while the model is still generating.
+'''
+import json
+from typing import List
+
+class PromptsStreamParser:
+    """
+    Incremental parser of a prompts list: {"prompts": [{...}, {...}]}.
+
+    The chunks of the response are given to feed() as they are received. Each
+    prompt object is returned as soon as its closing brace is received, without
+    waiting for the end of the response. A bare list of prompts is also accepted.
+    The whole response is kept in content for the final validation.
+    """
+
+    def __init__(self) -> None:
+        self.content = ""
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.start = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        """
+        Parse a chunk of the response.
+
+        Args:
+            chunk (str): The chunk of the response.
+
+        Returns:
+            List[dict]: The prompt objects closed in this chunk.
+        """
+        prompts = []
+        offset = len(self.content)
+        self.content += chunk
+
+        for index, char in enumerate(chunk, start=offset):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                # A prompt is an object directly inside the prompts list
+                if char == '{' and self.stack in (['{', '['], ['[']):
+                    self.start = index
+                self.stack.append(char)
+            elif char in '}]' and self.stack:
+                self.stack.pop()
+                if char == '}' and self.start is not None and self.stack in (['{', '['], ['[']):
+                    try:
+                        prompt = json.loads(self.content[self.start:index + 1])
+                        if isinstance(prompt, dict):
+                            prompts.append(prompt)
+                    except json.decoder.JSONDecodeError:
+                        pass
+                    self.start = None
+
+        return prompts
@@ -0,0 +1,140 @@
+''' telemetry.py
+
+This module records the timings returned by Ollama for each request in a JSONL log and summarizes them.
+'''
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import List
+
+# Timings and token counts returned by Ollama, the durations are in nanoseconds
+TIMING_FIELDS = [
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+]
+
+# Number of records kept in memory for the summary
+MAX_RECORDS = 10000
+
+class Telemetry:
+    """
+    Record the timings of the Ollama requests.
+
+    Each record is appended to a JSONL file and kept in memory to compute the
+    summary per model and mode. The last records of the file are reloaded at start.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): The path of the JSONL log, the folder is created if needed.
+        """
+        self.path = path
+        self.records = deque(maxlen=MAX_RECORDS)
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line))
+                    except json.decoder.JSONDecodeError:
+                        continue
+
+    def record(self, response: dict, model: str, mode: str, seed: int | None = None, attempt: int = 0, kind: str = "chat") -> dict:
+        """
+        Record the timings of a response.
+
+        Args:
+            response (dict): The response of Ollama, the last chunk for a streamed response.
+            model (str): The name of the model.
+            mode (str): The prompt mode, "chat" for the chat mode, "vision" for the image analysis.
+            seed (int, optional): The seed of the request. Defaults to None.
+            attempt (int, optional): The retry attempt, 0 for the first request. Defaults to 0.
+            kind (str, optional): The API called, "chat" or "generate". Defaults to "chat".
+
+        Returns:
+            dict: The record.
+        """
+        record = {
+            "time": round(time.time(), 3),
+            "model": model,
+            "mode": mode,
+            "kind": kind,
+            "seed": seed,
+            "attempt": attempt,
+        }
+        for field in TIMING_FIELDS:
+            record[field] = response.get(field)
+
+        with self.lock:
+            self.records.append(record)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    def summary(self) -> List[dict]:
+        """
+        Summarize the records per model and mode.
+
+        Returns:
+            List[dict]: One row per model and mode with the number of requests, the decoding
+                and prompt evaluation speeds (tokens/s), the mean load time and the p50/p95 latency (s).
+        """
+        with self.lock:
+            records = list(self.records)
+
+        groups = {}
+        for record in records:
+            groups.setdefault((record["model"], record["mode"]), []).append(record)
+
+        rows = []
+        for (model, mode), group in sorted(groups.items()):
+            latencies = sorted(seconds(record["total_duration"]) for record in group if record["total_duration"])
+            loads = [seconds(record["load_duration"]) for record in group if record["load_duration"]]
+            rows.append({
+                "model": model,
+                "mode": mode,
+                "requests": len(group),
+                "tokens/s": rate(group, "eval_count", "eval_duration"),
+                "prompt tokens/s": rate(group, "prompt_eval_count", "prompt_eval_duration"),
+                "load (s)": round(sum(loads) / len(loads), 2) if loads else None,
+                "p50 (s)": percentile(latencies, 50),
+                "p95 (s)": percentile(latencies, 95),
+            })
+        return rows
+
+def seconds(nanoseconds: int) -> float:
+    """
+    Convert a duration returned by Ollama to seconds.
+    """
+    return nanoseconds / 1e9
+
+def rate(records: List[dict], count_field: str, duration_field: str) -> float | None:
+    """
+    Get the number of tokens per second of a group of records.
+    """
+    count = sum(record[count_field] or 0 for record in records if record[duration_field])
+    duration = sum(record[duration_field] or 0 for record in records)
+    if not duration:
+        return None
+    return round(count / seconds(duration), 1)
+
+def percentile(values: List[float], percent: int) -> float | None:
+    """
+    Get a percentile of sorted values (nearest rank).
+    """
+    if not values:
+        return None
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return round(values[index], 2)
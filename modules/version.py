@@ -1,8 +1,27 @@
+import json
+import os
+import re
+import threading
+import time
+
 import requests
-import subprocess
 
 VERSION = '0.3.6'
 
+# Timeout of the version requests, in seconds
+TIMEOUT = 3
+
+# Time before the versions are checked again, in seconds
+MAX_AGE = 24 * 3600
+
+# Time before a failed check is tried again, in seconds
+RETRY_DELAY = 300
+
+DEFAULT_OLLAMA_HOST = 'http://127.0.0.1:11434'
+
+# Only one check at a time
+check_lock = threading.Lock()
+
 def compare_version(a: str, b: str) -> int:
     """
     Compare two version numbers.    
@@ -22,9 +41,12 @@ def compare_version(a: str, b: str) -> int:
             va.append('0')
         if i >= len(vb):
             vb.append('0')
-        if int(va[i]) < int(vb[i]):
+        # Ignore the suffixes like -rc1
+        na = int(re.match(r'\d*', va[i]).group() or 0)
+        nb = int(re.match(r'\d*', vb[i]).group() or 0)
+        if na < nb:
             return -1
-        elif int(va[i]) > int(vb[i]):
+        elif na > nb:
             return 1
     return 0
 
@@ -35,11 +57,11 @@ def isa_latest() -> str:
         str: The version number of ISA.
     """
     try:
-        response = requests.get('https://github.com/Franck-Demongin/ISA/releases/latest')
+        response = requests.get('https://github.com/Franck-Demongin/ISA/releases/latest', timeout=TIMEOUT)
         if response.status_code != 200:
             return 'unknown'
         return response.url.split('/')[-1][1:]
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         return 'unknown'
 
 def version() -> str:
@@ -58,22 +80,43 @@ def ollama_latest() -> str:
         str: The version number of Ollama.
     """
     try:
-        response = requests.get('https://github.com/ollama/ollama/releases/latest')
+        response = requests.get('https://github.com/ollama/ollama/releases/latest', timeout=TIMEOUT)
         if response.status_code != 200:
             return 'unknown'
         return response.url.split('/')[-1][1:]
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         return 'unknown'
 
+def ollama_url() -> str:
+    """
+    Get the URL of the Ollama server from OLLAMA_HOST, like the ollama client.
+
+    Returns:
+        str: The URL of the Ollama server.
+    """
+    host = os.environ.get('OLLAMA_HOST', '').strip() or DEFAULT_OLLAMA_HOST
+    if '://' not in host:
+        host = f"http://{host}"
+    scheme, address = host.split('://', 1)
+    address = address.rstrip('/')
+    if scheme == 'http' and ':' not in address.split('/')[0]:
+        address = address.replace('/', ':11434/', 1) if '/' in address else f"{address}:11434"
+    return f"{scheme}://{address.replace('0.0.0.0', '127.0.0.1')}"
+
 def ollama_version() -> str:
     """
-    Get the version number of Ollama.
+    Get the version number of the Ollama server, from /api/version.
 
     Returns:
         str: The version number of Ollama.
     """
-    version = subprocess.check_output(['ollama', '--version']).decode('utf-8')
-    return version.strip().split(' ')[-1]
+    try:
+        response = requests.get(f"{ollama_url()}/api/version", timeout=TIMEOUT)
+        if response.status_code != 200:
+            return 'unknown'
+        return response.json().get('version') or 'unknown'
+    except (requests.exceptions.RequestException, ValueError):
+        return 'unknown'
 
 def strealit_latest() -> str:
     """
@@ -83,11 +126,11 @@ def strealit_latest() -> str:
         str: The version number of Streamlit.
     """
     try:
-        response = requests.get('https://github.com/streamlit/streamlit/releases/latest')
+        response = requests.get('https://github.com/streamlit/streamlit/releases/latest', timeout=TIMEOUT)
         if response.status_code != 200:
             return 'unknown'
         return response.url.split('/')[-1]
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         return 'unknown'
 
 def streamlit_version() -> str:
@@ -100,6 +143,79 @@ def streamlit_version() -> str:
     import streamlit as st
     return st.__version__
 
+def read_versions(path: str) -> dict:
+    """
+    Read the versions cached on disk.
+
+    Args:
+        path (str): The path of the JSON cache.
+
+    Returns:
+        dict: The time of the check (checked) and the versions, an empty dict if there is no cache.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+def check_versions(path: str) -> None:
+    """
+    Check the versions and write them in the cache.
+
+    Args:
+        path (str): The path of the JSON cache, the folder is created if needed.
+    """
+    if not check_lock.acquire(blocking=False):
+        return
+    try:
+        versions = {
+            "checked": time.time(),
+            "isa_latest": isa_latest(),
+            "ollama": ollama_version(),
+            "ollama_latest": ollama_latest(),
+            "streamlit_latest": strealit_latest(),
+        }
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(versions, f)
+        os.replace(f"{path}.tmp", path)
+    finally:
+        check_lock.release()
+
+def get_versions(path: str, max_age: float = MAX_AGE) -> tuple[str, str, str, str, str, str]:
+    """
+    Get the versions without waiting for the network.
+
+    The versions come from the cache on disk. When the cache is missing or expired, the
+    versions are checked in a background thread and the cached ones (or 'unknown') are returned.
+    A check with an unknown version is tried again after RETRY_DELAY.
+
+    Args:
+        path (str): The path of the JSON cache.
+        max_age (float, optional): The time before the versions are checked again, in seconds. Defaults to MAX_AGE.
+
+    Returns:
+        tuple[str, str, str, str, str, str]: The versions of ISA, ISA latest, Ollama, Ollama latest,
+            Streamlit and Streamlit latest.
+    """
+    cached = read_versions(path)
+    age = time.time() - cached.get("checked", 0)
+    complete = all(cached.get(name, 'unknown') != 'unknown' for name in ("isa_latest", "ollama", "ollama_latest", "streamlit_latest"))
+    if age > max_age or (not complete and age > RETRY_DELAY):
+        threading.Thread(target=check_versions, args=[path], daemon=True, name="version-check").start()
+
+    return (
+        version(),
+        cached.get("isa_latest", 'unknown'),
+        cached.get("ollama", 'unknown'),
+        cached.get("ollama_latest", 'unknown'),
+        streamlit_version(),
+        cached.get("streamlit_latest", 'unknown'),
+    )
+
 if __name__ == '__main__':
     print(f"ISA: {version()}")
     print(f"Ollama: {ollama_version()}")
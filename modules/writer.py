@@ -0,0 +1,223 @@
+''' writer.py
+
+This module contains the writing of the prompts files read by the MultiPromptsLoader node of workflow/wf_ISA_1.json:
+prompts_positive.txt and prompts_negative.txt, with one prompt per line and the lines of the two files aligned.
+
+The two files are written one after the other: the loader does not take the lock, so it may
+read them in the middle of a save and pair prompts of two different saves.
+'''
+import os
+import re
+import tempfile
+import threading
+from typing import List
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Size of the positive file before it is moved to a numbered shard, in bytes
+MAX_BYTES = 16 * 1024 * 1024
+
+# One writer at a time in the process, the lock file serializes the processes
+write_lock = threading.Lock()
+
+def get_lines(prompts: List[dict]) -> tuple[str, str]:
+    """
+    Get the lines of the positive and negative files.
+
+    A prompt without negative (Flux) gets an empty negative line, and the line breaks
+    inside the prompts are replaced by spaces, so the line N of both files is the prompt N.
+
+    Args:
+        prompts (List[dict]): The prompts, with a positive and, except for Flux, a negative.
+
+    Returns:
+        tuple[str, str]: The positive and the negative lines.
+    """
+    def line(text: str | None) -> str:
+        return re.sub(r'\s*[\r\n]+\s*', ' ', text or '').strip() + '\n'
+
+    return (
+        ''.join(line(prompt['positive']) for prompt in prompts),
+        ''.join(line(prompt.get('negative')) for prompt in prompts),
+    )
+
+def write_atomic(path: str, text: str) -> None:
+    """
+    Replace a file: the text is written to a temporary file of the same folder, which is renamed to the file.
+
+    A reader sees the old or the new content, never a partial file.
+    """
+    folder = os.path.dirname(path) or '.'
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    fd, temp = tempfile.mkstemp(dir=folder, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+def append_synced(path: str, text: str) -> None:
+    """
+    Append to a file and wait for the data to be on the disk.
+    """
+    with open(path, 'a', encoding='utf-8', newline='\n') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+class FileLock:
+    """
+    Exclusive lock on a file shared by the processes writing the prompts (the app sessions and the command line tools).
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): The path of the lock file, created if needed.
+        """
+        self.path = path
+        self.file = None
+
+    def __enter__(self) -> "FileLock":
+        write_lock.acquire()
+        try:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self.file = open(self.path, 'a+')
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        except BaseException:
+            if self.file is not None:
+                self.file.close()
+            write_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args) -> None:
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            write_lock.release()
+
+def get_shard_path(path: str, number: int) -> str:
+    """
+    Get the path of a numbered shard, e.g. prompts_positive.0003.txt.
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{number:04d}{extension}"
+
+class PromptsWriter:
+    """
+    Writer of the positive and negative files.
+
+    Each file is replaced atomically (write) or appended under a lock (append), so a reader
+    never sees a partial file. The two files are not updated as one unit: a reader without the
+    lock, like the MultiPromptsLoader node, may read the new negative file with the old positive
+    one during a save. In append mode, the files are moved to numbered shards when the
+    positive file reaches max_bytes, so a long batch never grows one file forever.
+    """
+
+    def __init__(self, path_positive: str, path_negative: str, max_bytes: int = MAX_BYTES) -> None:
+        """
+        Args:
+            path_positive (str): The file of the positive prompts.
+            path_negative (str): The file of the negative prompts.
+            max_bytes (int, optional): The size of the positive file before the rotation. Defaults to MAX_BYTES.
+        """
+        self.path_positive = path_positive
+        self.path_negative = path_negative
+        self.max_bytes = max_bytes
+        self.aligned = False
+        self.lock = FileLock(os.path.join(os.path.dirname(path_positive), ".prompts.lock"))
+
+    def write(self, prompts: List[dict]) -> None:
+        """
+        Replace the files with the prompts.
+        """
+        positive, negative = get_lines(prompts)
+        with self.lock:
+            write_atomic(self.path_negative, negative)
+            write_atomic(self.path_positive, positive)
+
+    def append(self, prompts: List[dict]) -> None:
+        """
+        Append the prompts to the files, after a rotation if the positive file is full.
+        """
+        positive, negative = get_lines(prompts)
+        with self.lock:
+            size = os.path.getsize(self.path_positive) if os.path.exists(self.path_positive) else 0
+            if size and size + len(positive.encode('utf-8')) > self.max_bytes:
+                self.rotate()
+            if not self.aligned:
+                self.align()
+                self.aligned = True
+            append_synced(self.path_negative, negative)
+            append_synced(self.path_positive, positive)
+
+    def align(self) -> None:
+        """
+        Pad the negative file with empty lines if it has less lines than the positive file,
+        e.g. written by a previous version without the lines of the Flux prompts.
+
+        The files are read, so it is done once per writer: the appends keep them aligned.
+        """
+        if not os.path.exists(self.path_positive):
+            return
+        counts = []
+        for path in (self.path_positive, self.path_negative):
+            if not os.path.exists(path):
+                counts.append(0)
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            counts.append(data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0))
+        if counts[1] < counts[0]:
+            append_synced(self.path_negative, '\n' * (counts[0] - counts[1]))
+
+    def rotate(self) -> int:
+        """
+        Move the files to the next numbered shards.
+
+        Returns:
+            int: The number of the shards.
+        """
+        folder = os.path.dirname(self.path_positive) or '.'
+        root, extension = os.path.splitext(os.path.basename(self.path_positive))
+        pattern = re.compile(rf"^{re.escape(root)}\.(\d+){re.escape(extension)}$")
+        numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(folder)) if match]
+        number = max(numbers, default=0) + 1
+        os.replace(self.path_positive, get_shard_path(self.path_positive, number))
+        if os.path.exists(self.path_negative):
+            os.replace(self.path_negative, get_shard_path(self.path_negative, number))
+        return number
+
+def export_prompts(prompts: List[dict], path_positive: str, path_negative: str) -> None:
+    """
+    Replace the files read by the MultiPromptsLoader node of workflow/wf_ISA_1.json with the prompts.
+
+    Args:
+        prompts (List[dict]): The prompts, e.g. returned by PromptStore.query.
+        path_positive (str): The file of the positive prompts, one per line.
+        path_negative (str): The file of the negative prompts, one per line (empty for the Flux prompts).
+    """
+    PromptsWriter(path_positive, path_negative).write(prompts)
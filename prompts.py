@@ -0,0 +1,68 @@
+''' prompts.py
+Command line tool to manage the store of the saved prompts (output/prompts.sqlite).
+
+Example:
+    python prompts.py import output/prompts_backup.txt
+    python prompts.py export --model llama3 --mode SDXL --since 2025-04-01
+'''
+
+import argparse
+import os
+import time
+
+from modules.store import PromptStore
+from modules.writer import export_prompts
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+PATH_OUTPUT = os.path.join(BASEDIR, "output")
+PATH_STORE = os.path.join(PATH_OUTPUT, "prompts.sqlite")
+PATH_POSTIVE = os.path.join(PATH_OUTPUT, "prompts_positive.txt")
+PATH_NEGATIVE = os.path.join(PATH_OUTPUT, "prompts_negative.txt")
+PATH_BACKUP = os.path.join(PATH_OUTPUT, "prompts_backup.txt")
+
+def parse_date(value: str) -> float:
+    '''Parse a date like 2025-04-01 into a timestamp.'''
+    return time.mktime(time.strptime(value, "%Y-%m-%d"))
+
+def parse_args() -> argparse.Namespace:
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser(description="Manage the saved prompts of ISA.")
+    parser.add_argument("--store", default=PATH_STORE, help="SQLite file of the prompts (default: output/prompts.sqlite)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_import = commands.add_parser("import", help="Import a prompts_backup.txt file")
+    parser_import.add_argument("backup", nargs="?", default=PATH_BACKUP, help="Backup file (default: output/prompts_backup.txt)")
+
+    parser_export = commands.add_parser("export", help="Write the prompts to the files read by the ComfyUI workflow")
+    parser_list = commands.add_parser("list", help="Print the prompts")
+    for subparser in (parser_export, parser_list):
+        subparser.add_argument("-m", "--model", default=None, help="Only the prompts of this model")
+        subparser.add_argument("--mode", default=None, help="Only the prompts of this mode (SDXL, Flux or Flux2)")
+        subparser.add_argument("--since", type=parse_date, default=None, help="Only the prompts saved from this date (YYYY-MM-DD)")
+        subparser.add_argument("--until", type=parse_date, default=None, help="Only the prompts saved before this date (YYYY-MM-DD)")
+        subparser.add_argument("-n", "--limit", type=int, default=None, help="Only the most recent prompts")
+    parser_export.add_argument("--positive", default=PATH_POSTIVE, help="File of the positive prompts (default: output/prompts_positive.txt)")
+    parser_export.add_argument("--negative", default=PATH_NEGATIVE, help="File of the negative prompts (default: output/prompts_negative.txt)")
+    return parser.parse_args()
+
+def main() -> None:
+    '''Run the command.'''
+    args = parse_args()
+    store = PromptStore(args.store)
+
+    if args.command == "import":
+        count = store.import_backup(args.backup)
+        print(f"{count} prompts imported from {args.backup} ({store.count()} prompts in {args.store})")
+        return
+
+    prompts = store.query(model=args.model, mode=args.mode, since=args.since, until=args.until, limit=args.limit)
+    if args.command == "export":
+        export_prompts(prompts, args.positive, args.negative)
+        print(f"{len(prompts)} prompts exported to {args.positive} and {args.negative}")
+    else:
+        for prompt in prompts:
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(prompt['created']))
+            print(f"[{prompt['id']}] {date} {prompt['model'] or '-'} {prompt['mode'] or '-'} seed {prompt['seed']}: {prompt['positive']}")
+
+if __name__ == '__main__':
+    main()